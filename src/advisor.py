@@ -0,0 +1,150 @@
+from __future__ import annotations
+import json
+import re
+
+from edgedb_helpers import get_client
+from plan import RulePlan
+from utils import print_info, print_success, print_warn
+
+# Finds the properties rules look objects up by (`<Type> filter .<prop> = ...`) or insert with
+# `unless conflict on .<prop>`, and checks the EdgeDB schema for what keeps those fast: an index or exclusive
+# constraint for filters, and an exclusive constraint (which EdgeDB requires anyway) for conflicts.
+filter_regex = re.compile(r'\b([A-Z]\w*(?:::\w+)?)(?:\s*\{[^{}]*\})?\s+filter\s+\.(\w+)\s*=')
+insert_regex = re.compile(r'\binsert\s+([A-Z]\w*(?:::\w+)?)\s*\{')
+conflict_regex = re.compile(r'\s*unless\s+conflict\s+on\s+\.(\w+)')
+
+# Always indexed.
+IMPLICIT_KEYS = ('id',)
+
+INTROSPECTION_QUERY = '''
+  select schema::ObjectType {
+    name,
+    properties: { name, constraints: { name } },
+    constraints: { name, subjectexpr },
+    indexes: { expr },
+  }
+  filter .name in array_unpack(<array<str>>$names)
+'''
+
+
+def rule_strings(value):
+  # Every string in a rule (queries, suffixes, resolutions), however deeply nested.
+  if type(value) == str:
+    yield value
+  elif type(value) == dict:
+    for v in value.values():
+      yield from rule_strings(v)
+  elif type(value) in (list, tuple):
+    for v in value:
+      yield from rule_strings(v)
+
+
+def closing_brace(query, start):
+  depth = 0
+  for i in range(start, len(query)):
+    if query[i] == '{':
+      depth += 1
+    elif query[i] == '}':
+      depth -= 1
+      if depth == 0:
+        return i
+  return None
+
+
+def query_keys(query):
+  # Yields (type, property, usage) for the filters and conflict clauses of an EdgeQL query.
+  for match in filter_regex.finditer(query):
+    yield match.group(1), match.group(2), 'filter'
+  for match in insert_regex.finditer(query):
+    end = closing_brace(query, match.end() - 1)
+    conflict = conflict_regex.match(query, end + 1) if end is not None else None
+    if conflict:
+      yield match.group(1), conflict.group(1), 'conflict'
+
+
+def rule_keys(plan: RulePlan, rule: dict):
+  # Returns { (type, property, usage): number of occurrences } for a rule.
+  # The suffix is handled separately, since the type it applies to is the table name.
+  keys = {}
+  for query in rule_strings({ k: v for k, v in rule.items() if k != 'edgedb_query_suffix' }):
+    for key in query_keys(query):
+      keys[key] = keys.get(key, 0) + 1
+  if plan.table_name:
+    conflict = conflict_regex.match(plan.query_suffix)
+    if conflict:
+      key = (plan.table_name, conflict.group(1), 'conflict')
+      keys[key] = keys.get(key, 0) + 1
+  return { key: count for key, count in keys.items() if key[1] not in IMPLICIT_KEYS }
+
+
+def qualified_name(type_name):
+  return type_name if '::' in type_name else f'default::{type_name}'
+
+
+def fetch_introspection(type_names):
+  return json.loads(get_client().query_json(INTROSPECTION_QUERY, names=sorted(set(map(qualified_name, type_names)))))
+
+
+def indexed_properties(object_type: dict):
+  # Returns (properties with an exclusive constraint, properties with an index) of an introspected type.
+  exclusive = set()
+  indexed = set()
+  for prop in object_type.get('properties', []):
+    if any(c['name'] == 'std::exclusive' for c in prop.get('constraints', [])):
+      exclusive.add(prop['name'])
+  for constraint in object_type.get('constraints', []):
+    expr = (constraint.get('subjectexpr') or '').strip().strip('()').strip()
+    if constraint['name'] == 'std::exclusive' and re.fullmatch(r'\.\w+', expr):
+      exclusive.add(expr[1:])
+  for index in object_type.get('indexes', []):
+    expr = (index.get('expr') or '').strip().strip('()').strip()
+    if re.fullmatch(r'\.\w+', expr):
+      indexed.add(expr[1:])
+  return exclusive, indexed
+
+
+def check_keys(keys: dict, introspection: list):
+  # Returns findings sorted by type and property: dicts with type, property, usage, count, status and fix.
+  types = { object_type['name']: object_type for object_type in introspection }
+  findings = []
+  for (type_name, prop, usage), count in sorted(keys.items()):
+    finding = { 'type': type_name, 'property': prop, 'usage': usage, 'count': count, 'status': 'ok', 'fix': None }
+    object_type = types.get(qualified_name(type_name), None)
+    if object_type is None:
+      finding['status'] = 'unknown type'
+    elif prop not in [p['name'] for p in object_type.get('properties', [])]:
+      finding['status'] = 'unknown property'
+    else:
+      exclusive, indexed = indexed_properties(object_type)
+      if usage == 'conflict' and prop not in exclusive:
+        finding['status'] = 'missing exclusive constraint'
+        finding['fix'] = f'alter type {type_name} {{ alter property {prop} {{ create constraint exclusive; }} }};'
+      elif usage == 'filter' and prop not in exclusive and prop not in indexed:
+        finding['status'] = 'missing index'
+        finding['fix'] = f'alter type {type_name} {{ create index on (.{prop}); }};'
+    findings.append(finding)
+  return findings
+
+
+def advise_indexes(plan: RulePlan, rule: dict, introspection: list = None):
+  # Prints a report for a rule and returns the findings which need attention. introspection is the result of
+  # INTROSPECTION_QUERY as JSON (fetched from EdgeDB if not given).
+  keys = rule_keys(plan, rule)
+  if not keys:
+    print_info(f'Rule {plan.collection}: no filter or conflict properties found in its queries.')
+    return []
+  if introspection is None:
+    introspection = fetch_introspection({ type_name for type_name, _, _ in keys })
+  findings = check_keys(keys, introspection)
+  for finding in findings:
+    message = f'{finding["type"]}.{finding["property"]} ({finding["usage"]}, {finding["count"]}x): {finding["status"]}'
+    if finding['status'] == 'ok':
+      print_success(message)
+    else:
+      print_warn(message + (f'\n  {finding["fix"]}' if finding['fix'] else ''))
+  problems = [finding for finding in findings if finding['status'] != 'ok']
+  if problems:
+    print_warn(f'Rule {plan.collection}: {len(problems)} of {len(findings)} lookup properties need attention.')
+  else:
+    print_success(f'Rule {plan.collection}: all {len(findings)} lookup properties are indexed.')
+  return problems
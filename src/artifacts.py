@@ -0,0 +1,164 @@
+from __future__ import annotations
+import gzip
+import json
+from collections import deque
+from datetime import datetime
+
+from batching import AdaptiveBatcher
+from edgedb_helpers import run_bulk_payloads, run_bulk_queries, run_resolved_queries
+from serialization import dumpb
+from utils import print_info, print_success, print_warn
+
+# Build artifacts: the requests the EdgeDB backend sends, written to a gzipped JSON lines log by --save-artifacts
+# so that a failed load can be retried with --replay, without fetching and transforming again. The log starts
+# with a header line; each load (one per chunk, or per set of complete groups) is a line naming its strategy,
+# followed by one line per request:
+#   {"kind": "load", "strategy": "queries"}                  then {"q": <query>, "v": <variables>} per row
+#   {"kind": "load", "strategy": "bulk", "q": <query>}       then {"data": <JSON array>} per bulk request
+#   {"kind": "load", "strategy": "resolved"}                 then {"q": <resolver>, "data": <JSON row>} per row
+# Each load is a separate gzip member, completed once all its requests are written, so the log of a run which
+# crashed is readable up to its last complete load. Query variables are stored as JSON, so datetimes in them are
+# replayed as RFC 3339 strings.
+ARTIFACT_VERSION = 1
+STRATEGIES = ('queries', 'bulk', 'resolved')
+
+
+class ArtifactWriter:
+
+  def __init__(self, path, collection, append=False):
+    self.path = path
+    self.collection = collection
+    # gzip members can be concatenated, so appending (--resume) keeps the file readable as a whole.
+    self.file = open(path, 'ab' if append else 'wb')
+    self.member = None
+    self.stats = { 'loads': 0, 'requests': 0 }
+    self.write({ 'kind': 'header', 'version': ARTIFACT_VERSION, 'collection': collection, 'created': datetime.now().isoformat() })
+    self.end_member()
+
+  def write(self, record: dict):
+    if self.member is None:
+      self.member = gzip.GzipFile(fileobj=self.file, mode='wb')
+    self.member.write(dumpb(record) + b'\n')
+
+  def end_member(self):
+    if self.member is not None:
+      self.member.close()
+      self.member = None
+      self.file.flush()
+
+  def record(self, strategy, items, to_record, query=None):
+    # Writes a load and passes its items through, writing each one before it is sent.
+    load = { 'kind': 'load', 'strategy': strategy }
+    if query is not None:
+      load['q'] = query
+    self.write(load)
+    self.stats['loads'] += 1
+    for item in items:
+      self.write(to_record(item))
+      self.stats['requests'] += 1
+      yield item
+    self.end_member()
+
+  def queries(self, queries):
+    return self.record('queries', queries, lambda q: { 'q': q['__q'], 'v': q['__v'] })
+
+  def bulk(self, iterated_query, payloads):
+    return self.record('bulk', payloads, lambda payload: { 'data': payload[0] }, iterated_query)
+
+  def resolved(self, queries):
+    return self.record('resolved', queries, lambda query: { 'q': query[0], 'data': query[1] })
+
+  def close(self):
+    self.end_member()
+    self.file.close()
+    print_success(f'--save-artifacts: {self.stats["requests"]} requests in {self.stats["loads"]} loads written to {self.path}.')
+
+
+class ArtifactReader:
+
+  def __init__(self, path):
+    self.path = path
+    self.file = gzip.open(path, 'rb')
+    self.pending = None
+    self.headers = []
+
+  def read(self):
+    try:
+      line = self.file.readline()
+    except EOFError:
+      print_warn(f'--replay: {self.path} ends in the middle of a load (the run writing it was interrupted); its last load is incomplete.')
+      return None
+    return json.loads(line) if line else None
+
+  def items(self):
+    # Yields the lines of the current load, and keeps the line which ends it.
+    while True:
+      record = self.read()
+      if record is None or 'kind' in record:
+        self.pending = record
+        return
+      yield record
+
+  def loads(self):
+    # Yields (load line, generator of its request lines); a load's requests must be consumed before the next one.
+    record = self.read()
+    while record is not None:
+      if record['kind'] == 'header':
+        if record.get('version', None) != ARTIFACT_VERSION:
+          raise Exception(f'--replay: {self.path} was written by an unsupported version ({record.get("version", None)}).')
+        self.headers.append(record)
+        record = self.read()
+        continue
+      if record['kind'] != 'load' or record.get('strategy', None) not in STRATEGIES:
+        raise Exception(f'--replay: unexpected line in {self.path}: {record}')
+      items = self.items()
+      yield record, items
+      deque(items, maxlen=0)
+      record = self.pending
+
+  def close(self):
+    self.file.close()
+
+
+def replay(path, collection_name, no_transaction=False, batcher: AdaptiveBatcher = None, dry_run=False):
+  # Sends the requests of an artifact log in order, one transaction per load for per-row queries (unless
+  # no_transaction). With dry_run, the log is only read and counted.
+  reader = ArtifactReader(path)
+  stats = { strategy: { 'loads': 0, 'requests': 0, 'failed': 0 } for strategy in STRATEGIES }
+
+  def counted(strategy, items):
+    for item in items:
+      stats[strategy]['requests'] += 1
+      yield item
+
+  try:
+    for load, items in reader.loads():
+      if reader.headers[-1]['collection'] != collection_name:
+        raise Exception(f'--replay: {path} was written for {reader.headers[-1]["collection"]}, not {collection_name}.')
+      strategy = load['strategy']
+      stats[strategy]['loads'] += 1
+      items = counted(strategy, items)
+      if dry_run:
+        deque(items, maxlen=0)
+        continue
+      # Rows are not keyed in the log, so failures are counted per request.
+      if strategy == 'queries':
+        failed = run_bulk_queries(({ '__q': item['q'], '__v': item['v'] } for item in items), no_transaction)
+      elif strategy == 'bulk':
+        failed = run_bulk_payloads(((item['data'], [None]) for item in items), load['q'], batcher)
+      else:
+        failed = run_resolved_queries((item['q'], item['data'], None) for item in items)
+      stats[strategy]['failed'] += len(failed)
+  finally:
+    reader.close()
+
+  if not reader.headers:
+    print_warn(f'--replay: {path} is empty.')
+    return stats
+  print_info(f'--replay: {path} was written at {", ".join(header["created"] for header in reader.headers)}.')
+  for strategy, counts in stats.items():
+    if counts['failed']:
+      print_warn(f'--replay: {counts["failed"]} of {counts["requests"]} {strategy} requests failed.')
+    elif counts['loads']:
+      print_success(f'--replay: {"read" if dry_run else "sent"} {counts["requests"]} {strategy} requests in {counts["loads"]} loads.')
+  return stats
@@ -0,0 +1,325 @@
+from __future__ import annotations
+import csv
+import json
+import os
+import sqlite3
+from collections import deque
+from datetime import datetime
+
+from batching import AdaptiveBatcher
+from edgedb_helpers import bulk_payloads, build_queries, resolved_queries, run_bulk_payloads, run_bulk_queries, run_resolved_queries, should_skip
+from plan import METADATA_COLUMN, RulePlan
+from serialization import datetime_to_json, dumps
+from utils import is_null, iter_rows, lazy_import, print_info, print_success, print_warn, trim_whitespace
+
+pandas = lazy_import('pandas')
+
+# Columns used as the primary key of relational targets, in order of preference (see edgedb_helpers.row_id).
+KEY_COLUMNS = ('firebase_uid', 'firebase_id')
+
+# Written for nulls in CSV output; load with COPY ... (FORMAT csv, HEADER, NULL '\N').
+CSV_NULL = '\\N'
+
+
+class LoadBackend:
+  # Loads transformed rows into a target. `load` is called one or more times per run with a DataFrame (or a
+  # DataFrameGroupBy of complete groups, for rules with group_by). Backends append to their own output after the
+  # first load; `append` is set when the run continues an earlier one (--resume, --follow).
+  # `load` returns the keys (edgedb_helpers.row_key, or group_key for groups) of rows which failed to load, None
+  # for rows without a key; backends which raise on errors return nothing.
+  name = None
+  # Whether the rule's edgedb_prereq_queries can be run against this target before loading.
+  runs_prerequisites = False
+
+  def load(self, plan: RulePlan, output, dry_run=False, append=False, upsert_ids: set = None):
+    raise NotImplementedError
+
+  def close(self):
+    pass
+
+
+class EdgeDBBackend(LoadBackend):
+  name = 'edgedb'
+  runs_prerequisites = True
+
+  def __init__(self, bulk_insert=False, no_transaction=False, dump_invalid=False, batcher: AdaptiveBatcher = None, artifacts=None):
+    self.bulk_insert = bulk_insert
+    self.no_transaction = no_transaction
+    self.dump_invalid = dump_invalid
+    self.batcher = batcher or AdaptiveBatcher()
+    # An artifacts.ArtifactWriter (--save-artifacts), which records every request before it is sent.
+    self.artifacts = artifacts
+    self.loads = 0
+
+  def load(self, plan: RulePlan, output, dry_run=False, append=False, upsert_ids: set = None):
+    failed = []
+    if self.bulk_insert:
+      print(f'Query: {plan.iterated_query} (with bulk insert)')
+      payloads = bulk_payloads(output, self.batcher, list(plan.group_by) if plan.group_by else None)
+      if self.artifacts is not None:
+        payloads = self.artifacts.bulk(plan.iterated_query, payloads)
+      if not dry_run:
+        print(f'will run on {len(output)} rows')
+        failed = run_bulk_payloads(payloads, plan.iterated_query, self.batcher)
+      elif self.artifacts is not None:
+        deque(payloads, maxlen=0)
+    elif plan.row_resolver_function:
+      print(f'Query: {plan.row_resolver_function} (with row resolvers)')
+      queries = resolved_queries(output, plan.row_resolver_function, plan.row_resolvers)
+      if self.artifacts is not None:
+        queries = self.artifacts.resolved(queries)
+      if not dry_run:
+        print(f'will run on {len(output)} rows')
+        failed = run_resolved_queries(queries)
+      elif self.artifacts is not None:
+        deque(queries, maxlen=0)
+    else:
+      built_queries = build_queries(
+        output,
+        plan.table_name,
+        plan.type_casts,
+        plan.query_suffix,
+        plan.skip_row_if_empty,
+        self.dump_invalid,
+        append_invalid=append or self.loads > 0,
+        upsert_ids=upsert_ids,
+      )
+      preview = { 'head': [], 'tail': deque(maxlen=5) }
+      built_queries = preview_queries(built_queries, preview)
+      if self.artifacts is not None:
+        built_queries = self.artifacts.queries(built_queries)
+        if not dry_run and not self.no_transaction:
+          # A failing query aborts the run, so the whole load is recorded before its transaction starts.
+          built_queries = list(built_queries)
+      if dry_run:
+        deque(built_queries, maxlen=0)
+      else:
+        failed = run_bulk_queries(built_queries, self.no_transaction)
+
+      print('\nQueries (head):')
+      print(trim_whitespace(json.dumps(preview['head'])))
+      print('\nQueries (tail):')
+      print(trim_whitespace(json.dumps(list(preview['tail']))))
+    self.loads += 1
+    if failed:
+      print_warn(f'{len(failed)} rows failed to load.')
+    return failed
+
+  def close(self):
+    self.batcher.summary('bulk insert')
+    if self.artifacts is not None:
+      self.artifacts.close()
+
+
+def preview_queries(queries, preview, size=5):
+  for query in queries:
+    if len(preview['head']) < size:
+      preview['head'].append(query)
+    preview['tail'].append(query)
+    yield query
+
+
+def relational_value(value):
+  # Flattens a transformed cell into a scalar a relational target can store.
+  if type(value) == dict:
+    if '__query' in value:
+      # EdgeQL subqueries (resolvers) cannot be run against other targets; store the value they would resolve.
+      return relational_value(value.get('__sourceValue', value.get('__sourceValues', None)))
+    return dumps(value) if value else None
+  if type(value) == list:
+    return dumps(value)
+  if is_null(value):
+    return None
+  if isinstance(value, datetime):
+    return datetime_to_json(value)
+  if hasattr(value, 'item'):
+    # numpy scalars
+    return value.item()
+  return value
+
+
+def loaded_rows(plan: RulePlan, output, stats: dict):
+  # Returns (columns, rows as dicts) with the rows the EdgeDB query builder would skip left out:
+  # rows flagged by metadata, and rows with an empty skip_row_if_empty column.
+  if type(output) == pandas.core.groupby.DataFrameGroupBy:
+    groups = [group_df for _, group_df in output]
+    output = pandas.concat(groups) if groups else pandas.DataFrame()
+  columns = [column for column in output.columns if column != METADATA_COLUMN]
+  rows = []
+  for row in iter_rows(output):
+    stats['processed'] += 1
+    metadata = row.get(METADATA_COLUMN, None)
+    if type(metadata) == dict and should_skip(metadata):
+      stats['skipped'] += 1
+      continue
+    if any(is_null(row[column]) for column in plan.skip_row_if_empty if column in row):
+      stats['skipped'] += 1
+      continue
+    rows.append(row)
+  return columns, rows
+
+
+def relational_rows(plan: RulePlan, output, stats: dict):
+  # Returns (columns, rows as tuples of flat values), see loaded_rows.
+  columns, rows = loaded_rows(plan, output, stats)
+  return columns, [tuple(relational_value(row[column]) for column in columns) for row in rows]
+
+
+def row_size(row):
+  # Approximate size of a relational row in bytes, for batching.
+  return sum(len(v) if type(v) == str else 8 for v in row)
+
+
+def quote_identifier(name):
+  return '"' + str(name).replace('"', '""') + '"'
+
+
+class SQLiteBackend(LoadBackend):
+  # Inserts rows into a table named after edgedb_table_name (or the collection) in a SQLite database file,
+  # with executemany in one transaction per batch (sized by the batcher). Tables are created, and missing columns added, on the fly.
+  # If a key column (firebase_uid/firebase_id) is present it becomes the primary key and rows are upserted.
+  name = 'sqlite'
+
+  def __init__(self, target, batcher: AdaptiveBatcher = None):
+    self.target = target
+    self.batcher = batcher or AdaptiveBatcher()
+    self.conn = None
+    self.stats = { 'processed': 0, 'skipped': 0, 'written': 0 }
+
+  def connect(self):
+    if self.conn is None:
+      os.makedirs(os.path.dirname(os.path.abspath(self.target)), exist_ok=True)
+      self.conn = sqlite3.connect(self.target)
+      self.conn.execute('pragma journal_mode = wal')
+      self.conn.execute('pragma synchronous = normal')
+    return self.conn
+
+  def ensure_table(self, table, columns):
+    conn = self.connect()
+    existing = [info[1] for info in conn.execute(f'pragma table_info({quote_identifier(table)})')]
+    key = next((column for column in KEY_COLUMNS if column in columns), None)
+    if not existing:
+      definitions = [quote_identifier(column) + (' primary key' if column == key else '') for column in columns]
+      conn.execute(f'create table {quote_identifier(table)} ({", ".join(definitions)})')
+    else:
+      for column in columns:
+        if column not in existing:
+          print_warn(f'sqlite: adding column {column} to {table}.')
+          conn.execute(f'alter table {quote_identifier(table)} add column {quote_identifier(column)}')
+      if key not in existing:
+        key = None
+    return key
+
+  def load(self, plan: RulePlan, output, dry_run=False, append=False, upsert_ids: set = None):
+    table = plan.table_name or plan.collection
+    columns, rows = relational_rows(plan, output, self.stats)
+    if dry_run or not rows:
+      print_info(f'sqlite: {len(rows)} rows for {table}{" (dry run, not written)" if dry_run else ""}.')
+      return
+    key = self.ensure_table(table, columns)
+    verb = 'insert or replace' if key else 'insert'
+    statement = f'{verb} into {quote_identifier(table)} ({", ".join(quote_identifier(c) for c in columns)}) values ({", ".join("?" * len(columns))})'
+    conn = self.connect()
+    def write(batch):
+      with conn:
+        conn.executemany(statement, batch)
+    for batch in self.batcher.batches(rows, row_size):
+      self.batcher.send(write, batch, sum(row_size(row) for row in batch))
+    self.stats['written'] += len(rows)
+    print_success(f'sqlite: wrote {len(rows)} rows to {table} in {self.target}.')
+
+  def close(self):
+    self.batcher.summary('sqlite')
+    if self.conn is not None:
+      self.conn.close()
+      self.conn = None
+    print_info(f'sqlite: {self.stats["written"]} rows written, {self.stats["skipped"]} of {self.stats["processed"]} skipped.')
+
+
+class CSVEmitter(LoadBackend):
+  # Writes `<table>.csv` into the target directory, ready for a bulk load such as
+  # COPY <table> FROM '<table>.csv' (FORMAT csv, HEADER, NULL '\N'). Nested values are written as JSON.
+  name = 'csv'
+
+  def __init__(self, target):
+    self.target = target
+    self.stats = { 'processed': 0, 'skipped': 0, 'written': 0 }
+    self.files = set()
+
+  def load(self, plan: RulePlan, output, dry_run=False, append=False, upsert_ids: set = None):
+    table = plan.table_name or plan.collection
+    columns, rows = relational_rows(plan, output, self.stats)
+    if dry_run:
+      print_info(f'csv: {len(rows)} rows for {table} (dry run, not written).')
+      return
+    os.makedirs(self.target, exist_ok=True)
+    filename = os.path.join(self.target, f'{table}.csv')
+    # The file is started over on the first chunk of a run, unless the run resumes from a checkpoint (append).
+    mode = 'a' if filename in self.files or (append and os.path.exists(filename)) else 'w'
+    with open(filename, mode, newline='') as f:
+      writer = csv.writer(f)
+      if mode == 'w':
+        writer.writerow(columns)
+      writer.writerows(tuple(CSV_NULL if v is None else v for v in row) for row in rows)
+    self.files.add(filename)
+    self.stats['written'] += len(rows)
+    print_success(f'csv: wrote {len(rows)} rows to {filename}.')
+
+  def close(self):
+    for filename in sorted(self.files):
+      print_info(f"csv: load with COPY <table> FROM '{os.path.abspath(filename)}' (FORMAT csv, HEADER, NULL '\\N').")
+    print_info(f'csv: {self.stats["written"]} rows written, {self.stats["skipped"]} of {self.stats["processed"]} skipped.')
+
+
+class ParquetEmitter(LoadBackend):
+  # Writes one `<table>.part-NNNNN.parquet` file per chunk into the target directory. Requires pyarrow.
+  name = 'parquet'
+
+  def __init__(self, target):
+    try:
+      import pyarrow
+    except ImportError:
+      raise Exception('--backend parquet requires pyarrow (pip install pyarrow).')
+    self.target = target
+    self.stats = { 'processed': 0, 'skipped': 0, 'written': 0 }
+    self.parts = 0
+
+  def load(self, plan: RulePlan, output, dry_run=False, append=False, upsert_ids: set = None):
+    table = plan.table_name or plan.collection
+    columns, rows = relational_rows(plan, output, self.stats)
+    if dry_run or not rows:
+      print_info(f'parquet: {len(rows)} rows for {table}{" (dry run, not written)" if dry_run else ""}.')
+      return
+    os.makedirs(self.target, exist_ok=True)
+    part = self.parts
+    filename = os.path.join(self.target, f'{table}.part-{part:05d}.parquet')
+    # Don't overwrite parts written by an earlier run that this one resumes.
+    while os.path.exists(filename) and append:
+      part += 1
+      filename = os.path.join(self.target, f'{table}.part-{part:05d}.parquet')
+    pandas.DataFrame.from_records(rows, columns=columns).to_parquet(filename, index=False, engine='pyarrow')
+    self.parts = part + 1
+    self.stats['written'] += len(rows)
+    print_success(f'parquet: wrote {len(rows)} rows to {filename}.')
+
+  def close(self):
+    print_info(f'parquet: {self.stats["written"]} rows written in {self.parts} files, {self.stats["skipped"]} of {self.stats["processed"]} skipped.')
+
+
+BACKENDS = ('edgedb', 'sqlite', 'csv', 'parquet')
+
+
+def create_backend(name, target=None, bulk_insert=False, no_transaction=False, dump_invalid=False, batcher: AdaptiveBatcher = None, artifacts=None):
+  if name == 'edgedb':
+    return EdgeDBBackend(bulk_insert, no_transaction, dump_invalid, batcher, artifacts)
+  if target is None:
+    raise Exception(f'--backend {name} requires --target (a database file for sqlite, an output directory for csv and parquet).')
+  if bulk_insert or no_transaction or dump_invalid:
+    print_warn('--bulk-insert, --no-transaction and --dump-invalid only apply to the edgedb backend.')
+  if name == 'sqlite':
+    return SQLiteBackend(target, batcher)
+  if name == 'csv':
+    return CSVEmitter(target)
+  if name == 'parquet':
+    return ParquetEmitter(target)
+  raise Exception(f'Unknown backend {name}. Available backends: {list(BACKENDS)}')
@@ -0,0 +1,62 @@
+from time import time
+
+from utils import print_info
+
+
+class AdaptiveBatcher:
+  # Splits a load into requests of at most `budget` bytes, and adapts the budget to observed response times:
+  # it grows by a quarter after fast requests which used most of it, and halves after requests slower than
+  # `target_seconds`, staying between `min_bytes` and `max_bytes`.
+
+  def __init__(self, max_bytes=4_000_000, target_seconds=1.0, min_bytes=16_384, initial_bytes=262_144):
+    self.max_bytes = max_bytes
+    self.min_bytes = min(min_bytes, max_bytes)
+    self.target_seconds = target_seconds
+    self.budget = max(self.min_bytes, min(initial_bytes, max_bytes))
+    self.stats = { 'requests': 0, 'bytes': 0, 'seconds': 0.0, 'oversized': 0 }
+
+  def batches(self, items, size_fn=len):
+    # Yields lists of items (at least one per list) whose sizes add up to at most the budget at the time the
+    # list is started, so observe() calls between batches take effect immediately.
+    batch = []
+    batch_bytes = 0
+    for item in items:
+      size = size_fn(item)
+      if batch and batch_bytes + size > self.budget:
+        yield batch
+        batch = []
+        batch_bytes = 0
+      batch.append(item)
+      batch_bytes += size
+    if batch:
+      yield batch
+
+  def observe(self, nbytes, seconds):
+    self.stats['requests'] += 1
+    self.stats['bytes'] += nbytes
+    self.stats['seconds'] += seconds
+    if nbytes > self.max_bytes:
+      self.stats['oversized'] += 1
+    if seconds > self.target_seconds:
+      self.budget = max(self.min_bytes, self.budget // 2)
+    elif seconds < self.target_seconds / 2 and nbytes >= self.budget // 2:
+      self.budget = min(self.max_bytes, self.budget + self.budget // 4)
+
+  def send(self, fn, payload, nbytes=None):
+    # Runs fn(payload), timing it for the budget.
+    start = time()
+    try:
+      return fn(payload)
+    finally:
+      self.observe(len(payload) if nbytes is None else nbytes, time() - start)
+
+  def summary(self, label):
+    requests = self.stats['requests']
+    if not requests:
+      return
+    print_info(
+      f'{label}: {requests} requests, {self.stats["bytes"] / requests / 1000:.1f}KB and '
+      f'{self.stats["seconds"] / requests * 1000:.0f}ms on average, batch budget now {self.budget / 1000:.0f}KB'
+      + (f', {self.stats["oversized"]} over the {self.max_bytes / 1000:.0f}KB limit' if self.stats['oversized'] else '')
+      + '.'
+    )
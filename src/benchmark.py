@@ -0,0 +1,93 @@
+from __future__ import annotations
+from time import time
+
+from edgedb_helpers import build_queries, bulk_payloads, get_client, resolved_queries
+from plan import RulePlan
+from utils import print_info, print_success, print_warn
+
+# --auto-strategy: each load strategy the rule supports is run on the same sample of transformed rows inside a
+# transaction which is then rolled back, and the run continues with the one which loaded the most rows per second.
+# Per-row queries without a transaction (--no-transaction) commit every row, which cannot be undone, so they are
+# not measured; the flag still applies to per-row inserts when given.
+
+
+class Rollback(Exception):
+  # Raised at the end of a benchmark to roll its transaction back.
+  pass
+
+
+def run_inserts(tx, plan: RulePlan, output):
+  for query in build_queries(output, plan.table_name, plan.type_casts, plan.query_suffix, plan.skip_row_if_empty):
+    tx.execute(query['__q'], **query['__v'])
+
+
+def run_bulk(tx, plan: RulePlan, output):
+  # The sample is small enough to send whole (or one request per group).
+  for json_data, _ in bulk_payloads(output, group_by=list(plan.group_by) if plan.group_by else None):
+    tx.query(plan.iterated_query, data=json_data)
+
+
+def run_resolvers(tx, plan: RulePlan, output):
+  for row_resolver, json_data, _ in resolved_queries(output, plan.row_resolver_function, plan.row_resolvers):
+    tx.query(row_resolver, data=json_data)
+
+
+def candidate_strategies(plan: RulePlan):
+  # The strategies EdgeDBBackend can use for the rule: bulk insert, or else row resolvers or per-row inserts.
+  candidates = {}
+  if plan.iterated_query:
+    candidates['bulk-insert'] = run_bulk
+  if plan.row_resolver_function:
+    candidates['row-resolvers'] = run_resolvers
+  elif plan.table_name:
+    candidates['insert'] = run_inserts
+  return candidates
+
+
+def time_rolled_back(run, plan: RulePlan, output):
+  seconds = None
+  try:
+    for tx in get_client().transaction():
+      with tx:
+        start = time()
+        run(tx, plan, output)
+        seconds = time() - start
+        raise Rollback()
+  except Rollback:
+    pass
+  return seconds
+
+
+def benchmark_strategies(plan: RulePlan, output, rows: int, rounds=2, option='--auto-strategy'):
+  # Returns { strategy: rows per second, or None if it failed }, keeping the best of `rounds` runs of each.
+  results = {}
+  for name, run in candidate_strategies(plan).items():
+    best = None
+    for _ in range(rounds):
+      try:
+        seconds = time_rolled_back(run, plan, output)
+      except Exception as e:
+        print_warn(f'{option}: {name} failed on the sample ({e}).')
+        best = None
+        break
+      best = seconds if best is None else min(best, seconds)
+    results[name] = rows / max(best, 1e-6) if best is not None else None
+  return results
+
+
+def choose_strategy(plan: RulePlan, output, rows: int):
+  # Returns (strategy, summary line), or (None, summary line) if no strategy could be measured.
+  candidates = list(candidate_strategies(plan))
+  if len(candidates) == 1:
+    return candidates[0], f'--auto-strategy: {candidates[0]}, the only strategy the rule supports.'
+  results = benchmark_strategies(plan, output, rows)
+  measured = { name: speed for name, speed in results.items() if speed is not None }
+  details = ', '.join(
+    f'{name} {speed:.0f} rows/s' if speed is not None else f'{name} failed'
+    for name, speed in sorted(results.items(), key=lambda item: -(item[1] or 0))
+  )
+  if not measured:
+    return None, f'--auto-strategy: no strategy could be measured on {rows} rows ({details}).'
+  strategy = max(measured, key=measured.get)
+  return strategy, f'--auto-strategy: {strategy} on a sample of {rows} rows ({details}).'
+
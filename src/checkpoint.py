@@ -0,0 +1,59 @@
+import json
+import os
+from datetime import datetime
+from time import time
+
+CHECKPOINT_DIR = os.environ.get('CHECKPOINT_DIR', '.checkpoints')
+
+
+def checkpoint_path(collection_name):
+  return os.path.join(CHECKPOINT_DIR, f'{collection_name}.json')
+
+
+def encode_cursor_value(value):
+  if isinstance(value, datetime):
+    return { '__datetime': value.isoformat() }
+  return value
+
+
+def decode_cursor_value(value):
+  if type(value) == dict and '__datetime' in value:
+    return datetime.fromisoformat(value['__datetime'])
+  return value
+
+
+def write_json_atomic(filename, data):
+  # Write to a temporary file and rename it over the target, so a crash never leaves a partial file behind.
+  os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+  tmp_filename = f'{filename}.tmp'
+  with open(tmp_filename, 'w') as f:
+    json.dump(data, f)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_filename, filename)
+
+
+def save_checkpoint(collection_name, order_by, last_doc: dict, documents_loaded: int):
+  order_value = last_doc.get(order_by[0], None) if order_by else None
+  write_json_atomic(checkpoint_path(collection_name), {
+    'collection': collection_name,
+    'path': '/'.join(last_doc['_path']),
+    'id': last_doc['id'],
+    'order_by': list(order_by) if order_by else None,
+    'order_value': encode_cursor_value(order_value),
+    'documents_loaded': documents_loaded,
+    'saved_at': time(),
+  })
+
+
+def load_checkpoint(collection_name, order_by=None):
+  filename = checkpoint_path(collection_name)
+  if not os.path.exists(filename):
+    return None
+  with open(filename) as f:
+    checkpoint = json.load(f)
+  saved_order = tuple(checkpoint['order_by']) if checkpoint['order_by'] else None
+  if saved_order != (tuple(order_by) if order_by else None):
+    raise Exception(f'Checkpoint {filename} was saved with fetch_order {saved_order}, but the rule uses {order_by}. Remove it to start over.')
+  checkpoint['order_value'] = decode_cursor_value(checkpoint['order_value'])
+  return checkpoint
@@ -1,13 +1,31 @@
+from __future__ import annotations
 from argparse import ArgumentParser
 import json
 import sys
-import pandas
 from time import time
 
 from firestore import rules
-from firestore_helpers import fetch_all, fetch_collection, fetch_collection_group
-from edgedb_helpers import build_queries, run_bulk_inserts, run_bulk_resolved_queries, run_prereq_queries, run_bulk_queries
-from utils import print_err, print_info, transform_source, trim_whitespace
+from advisor import advise_indexes
+from artifacts import ArtifactWriter, replay
+from batching import AdaptiveBatcher
+from backends import BACKENDS, LoadBackend, create_backend
+from benchmark import choose_strategy
+from checkpoint import load_checkpoint, save_checkpoint
+from grouping import make_grouper
+from estimate import extrapolate, format_estimate, measure_load, measure_sample
+from firestore_export import MISSING_METADATA, fetch_export, missing_metadata_columns
+from firestore_helpers import checkpoint_cursor, configure_fetching, count_documents, fetch_all, fetch_collection, fetch_collection_group, iter_pages, listen, resolve_start_after
+from parallel import ParallelTransformer
+from plan import RulePlan, compile_rule
+from replication import Replicator, document_group_fn
+from verify import Verifier
+from sampling import sample_documents, sample_list
+from lookups import LookupMaps
+from hash_store import commit_pending_hashes, load_hashes, open_hash_store, select_changed_rows
+from edgedb_helpers import group_key, measure_round_trip, row_key, run_prereq_queries
+from utils import LOG_LEVELS, configure_logging, lazy_import, print_err, print_info, print_log_summary, print_success, print_warn, transform_source, trim_whitespace
+
+pandas = lazy_import('pandas')
 
 parser = ArgumentParser()
 
@@ -26,14 +44,280 @@ parser.add_argument(
   type=int,
   default=-1
 )
+parser.add_argument(
+  '--sample',
+  action='store',
+  type=int,
+  default=0,
+  help='Dry run on this many documents drawn at random from across the collection, instead of the first ones in fetch_order',
+)
+parser.add_argument(
+  '--export',
+  action='store',
+  dest='export_dir',
+  help='Read documents from a local Firestore managed export (the directory written by `gcloud firestore export`) instead of the live API',
+)
+parser.add_argument('--resume', action='store_true', help='Continue after the last document of the last successfully loaded chunk')
+parser.add_argument(
+  '--chunk-size',
+  action='store',
+  type=int,
+  default=0,
+  help='Fetch, transform and load the collection in chunks of this many documents, saving a checkpoint after each chunk (0 for a single chunk)',
+)
+parser.add_argument(
+  '--spill-partitions',
+  action='store',
+  type=int,
+  default=64,
+  help='--chunk-size with group_by: number of on-disk partitions rows are spread over until all groups are complete',
+)
+parser.add_argument(
+  '--changed-only',
+  action='store_true',
+  help='Only load rows (or groups) whose transformed content changed since the last successful load; changed rows are upserted',
+)
+parser.add_argument('--follow', action='store_true', help='Keep running and replicate changes from a Firestore snapshot listener (implies --changed-only; rules with group_by reload each changed group whole)')
+parser.add_argument('--flush-size', action='store', type=int, default=500, help='--follow: load a micro-batch once this many documents changed')
+parser.add_argument('--flush-interval', action='store', type=float, default=5.0, help='--follow: load a micro-batch once its oldest change is this many seconds old')
 parser.add_argument('--column', action='store', dest='column', help='Fetch and transform a singular column (debug)')
+parser.add_argument('--explain', action='store_true', help='Validate the rule for the collection and print what will run, without fetching anything')
+parser.add_argument(
+  '--verify',
+  action='store',
+  nargs='?',
+  type=int,
+  const=1000,
+  default=0,
+  metavar='CHUNK_ROWS',
+  help='Instead of loading, compare the transformed rows with EdgeDB using per-chunk signatures (one query per chunk of 1000 rows by default)',
+)
+parser.add_argument(
+  '--check-indexes',
+  action='store',
+  nargs='?',
+  const='',
+  metavar='INTROSPECTION_JSON',
+  help='Check that the EdgeDB properties the rule filters or conflicts on have indexes or exclusive constraints, and exit (optionally against a saved introspection result)',
+)
+parser.add_argument(
+  '--auto-strategy',
+  action='store',
+  nargs='?',
+  type=int,
+  const=200,
+  default=0,
+  metavar='DOCUMENTS',
+  help='Time each load strategy the rule supports on the first N documents (200 by default) in a rolled-back transaction, and load with the fastest (overrides --bulk-insert)',
+)
+parser.add_argument(
+  '--save-artifacts',
+  action='store',
+  metavar='FILE',
+  help='Also write every request sent to EdgeDB to a gzipped log, which --replay can send again (with --dry-run, only write it)',
+)
+parser.add_argument('--replay', action='store', metavar='FILE', help='Send the requests of a --save-artifacts log to EdgeDB without fetching or transforming anything')
+parser.add_argument(
+  '--estimate',
+  action='store',
+  type=int,
+  default=0,
+  help='Sample this many documents, run transforms and the query builder on them, and project reads, round trips, payload size and time for the full collection',
+)
+parser.add_argument(
+  '--workers',
+  action='store',
+  type=int,
+  default=0,
+  help='Run transforms in this many worker processes (each chunk is split into shards of at least 500 rows)',
+)
+parser.add_argument('--backend', action='store', choices=BACKENDS, default='edgedb', help='Where to load transformed rows')
+parser.add_argument(
+  '--target',
+  action='store',
+  help='--backend sqlite: the database file; --backend csv/parquet: the directory to write bulk load files to',
+)
+parser.add_argument(
+  '--batch-bytes',
+  action='store',
+  type=int,
+  default=4_000_000,
+  help='Upper limit for the payload of a single bulk request (--bulk-insert, sqlite); the batch size adapts below it',
+)
+parser.add_argument(
+  '--batch-seconds',
+  action='store',
+  type=float,
+  default=1.0,
+  help='Target response time of a single bulk request; batches shrink when requests are slower and grow when faster',
+)
+parser.add_argument(
+  '--max-retries',
+  action='store',
+  type=int,
+  default=5,
+  help='Retries of a Firestore page read after transient errors (deadline exceeded, unavailable, quota), with exponential backoff',
+)
+parser.add_argument(
+  '--reads-per-second',
+  action='store',
+  type=float,
+  default=0,
+  help='Throttle Firestore document reads to this rate, e.g. to share a project quota between migrations (0 for no limit)',
+)
 parser.add_argument('-d', '--dry-run', action='store_true', help='Build queries but do not execute them')
 parser.add_argument('--dump-invalid', action='store_true', help='Dump invalid rows to CSV')
 parser.add_argument('--no-external', action='store_true', help='Do not call external services')
 parser.add_argument('--no-transaction', action='store_true', help='Do not run queries in a transaction')
 parser.add_argument('--bulk-insert', action='store_true', help='Use bulk INSERT and a for..in..union statement instead of individual INSERTs')
+parser.add_argument('--log-level', action='store', choices=list(LOG_LEVELS), default='info', help='Minimum level of log messages to print')
+parser.add_argument(
+  '--log-sample-after',
+  action='store',
+  type=int,
+  default=10,
+  help='Number of repeated per-row messages of each type to print before sampling them',
+)
+parser.add_argument(
+  '--log-sample-every',
+  action='store',
+  type=int,
+  default=0,
+  help='After --log-sample-after, print every Nth repeated message of each type (0 to suppress them)',
+)
+
+def fetch_chunks(collection_name, order_by, is_col_group=False, limit=-1, start_after=None, chunk_size=0, export_dir=None, fields=None, filters=None, sample=0):
+  if sample > 0:
+    if export_dir is not None:
+      yield sample_list(fetch_export(export_dir, collection_name, is_col_group, order_by, None, None, filters), sample)
+    else:
+      yield sample_documents(collection_name, is_col_group, sample, fields, filters)
+    return
+
+  if export_dir is not None:
+    docs = fetch_export(export_dir, collection_name, is_col_group, order_by, limit if limit >= 0 else None, start_after, filters)
+    if chunk_size <= 0:
+      yield list(docs)
+      return
+    chunk = []
+    for doc in docs:
+      chunk.append(doc)
+      if len(chunk) == chunk_size:
+        yield chunk
+        chunk = []
+    if chunk:
+      yield chunk
+    return
+
+  if chunk_size > 0:
+    if start_after is not None:
+      start_after = resolve_start_after(collection_name, start_after, is_col_group)
+    yield from iter_pages(collection_name, order_by, start_after, chunk_size, limit if limit >= 0 else None, is_col_group, fields, filters)
+    return
+
+  docs = []
+  if is_col_group:
+    print_info(f'Fetching {collection_name} as a collection group...')
+    if limit >= 0:
+      docs = fetch_collection_group(collection_name, limit, order_by, start_after, fields, filters).get('result', [])
+    else:
+      docs = fetch_collection_group(collection_name, None, order_by, start_after, fields, filters).get('result', [])
+  else:
+    if limit >= 0:
+      docs = fetch_collection(collection_name, limit, order_by, start_after, fields, filters).get('result', [])
+    else:
+      docs = fetch_all(collection_name, order_by, start_after, fields=fields, filters=filters)
+  yield docs
+
+
+def load_output(
+  plan: RulePlan,
+  output: pandas.DataFrame,
+  timings: dict,
+  backend: LoadBackend,
+  dry_run=False,
+  append=False,
+  hash_state: dict = None,
+  lookups: LookupMaps = None,
+):
+  # Loads transformed (ungrouped) rows. For rules with group_by, output must only contain complete groups.
+  # Returns the keys of rows which failed to load (see LoadBackend).
+  group_by = list(plan.group_by) if plan.group_by else None
+
+  prepare_start = time()
+  if lookups is not None:
+    output = lookups.apply(output)
+  upsert_ids = None
+  if hash_state is not None:
+    total_rows = len(output)
+    group_key_fn = (lambda row: group_key(row, group_by)) if group_by else None
+    output, pending, upsert_ids = select_changed_rows(output, hash_state['stored'], row_key, group_key_fn)
+    hash_state['pending'].update(pending)
+    print_info(f'--changed-only: {len(output)} of {total_rows} rows changed since the last load ({len(upsert_ids)} updated).')
+  if group_by:
+    output = output.groupby(group_by)
+  if backend.runs_prerequisites:
+    output = run_prereq_queries(output, plan.prerequisites)
+  timings['transform'] += time() - prepare_start
+
+  query_start = time()
+  failed = backend.load(plan, output, dry_run, append, upsert_ids) or []
+  timings['query'] += time() - query_start
+  return failed
+
+
+def load_chunk(
+  plan: RulePlan,
+  source_df: pandas.DataFrame,
+  timings: dict,
+  backend: LoadBackend,
+  dry_run=False,
+  no_external=False,
+  column=None,
+  append=False,
+  hash_state: dict = None,
+  grouper=None,
+  transformer: ParallelTransformer = None,
+  lookups: LookupMaps = None,
+):
+  # Returns the keys of rows which failed to load, or None if the chunk could not be loaded at all.
+  group_by = list(plan.group_by) if plan.group_by else None
+
+  DEBUG_single_column = column is not None
+
+  transform_start = time()
+  if DEBUG_single_column:
+    if not column in source_df.columns:
+      print_err(f'Column {column} not found in collection {plan.collection} (specified with --column)')
+      return None
+    if not dry_run:
+      print_err('Cannot fetch a single column without --dry-run since generated queries would insert partial data.')
+      return None
+    output = transform_source(source_df, plan, None, no_external, column)
+    if lookups is not None:
+      output = lookups.apply(output)
+    if group_by:
+      output = output.groupby(group_by)
+    timings['transform'] += time() - transform_start
+    query_start = time()
+    failed = backend.load(plan, output, dry_run, append) or []
+    timings['query'] += time() - query_start
+    return failed
+
+  if transformer is not None:
+    output = transformer.transform(source_df, no_external)
+  else:
+    output = transform_source(source_df, plan, None, no_external)
+  timings['transform'] += time() - transform_start
+  if grouper is None:
+    return load_output(plan, output, timings, backend, dry_run, append, hash_state, lookups)
+  # Rows of groups which may continue in later chunks are held back by the grouper. Lookups (which skip rows) are
+  # only applied to the rows it returns, so it holds one row per fetched document and pending_rows counts documents.
+  failed = []
+  for ready in grouper.add(output):
+    failed += load_output(plan, ready, timings, backend, dry_run, append, hash_state, lookups)
+  return failed
 
-args = parser.parse_args(sys.argv[1:])
 
 def run_task(
   collection_name,
@@ -45,117 +329,362 @@ def run_task(
   column=None,
   limit=-1,
   start_after=None,
+  resume=False,
+  chunk_size=0,
+  changed_only=False,
+  follow=False,
+  flush_size=500,
+  flush_interval=5.0,
+  explain=False,
+  estimate=0,
+  export_dir=None,
+  backend_name='edgedb',
+  target=None,
+  spill_partitions=64,
+  workers=0,
+  batch_bytes=4_000_000,
+  batch_seconds=1.0,
+  sample=0,
+  check_indexes=None,
+  verify=0,
+  save_artifacts=None,
+  replay_path=None,
+  auto_strategy=0,
 ):
   if collection_name not in rules:
     print_err(f'No transformation rules for collection {collection_name}')
     return
 
-  meta = rules[collection_name]
-  order_by = meta['fetch_order']
-  mapping = meta['mapping']
-  group_by = meta.get('group_by', None)
-  is_col_group = meta.get('is_collection_group', False)
-  table_name = meta.get('edgedb_table_name', None)
-  query_suffix = meta.get('edgedb_query_suffix', '')
-  iterated_query = meta.get('edgedb_iterated_query', None)
-  row_resolver_function = meta.get('row_resolver_function', None)
-  row_resolvers = meta.get('edgedb_row_resolvers', {})
-  skip_row_if_empty = meta.get('skip_row_if_empty', [])
-  edgedb_type_casts = meta.get('edgedb_type_casts', {})
-  prerequisites = meta.get('edgedb_prereq_queries', [])
+  plan = compile_rule(collection_name, rules[collection_name])
+  if explain:
+    print(plan.explain())
+    return
+  if check_indexes is not None:
+    introspection = None
+    if check_indexes:
+      with open(check_indexes) as f:
+        introspection = json.load(f)
+    advise_indexes(plan, rules[collection_name], introspection)
+    return
+  if replay_path is not None:
+    if backend_name != 'edgedb' or save_artifacts or verify > 0 or estimate > 0 or sample > 0 or follow or column is not None:
+      print_err('--replay only loads into EdgeDB and cannot be used with --save-artifacts, --verify, --estimate, --sample, --follow or --column.')
+      return
+    # Per-row queries run in one transaction per recorded load, unless --no-transaction.
+    batcher = AdaptiveBatcher(batch_bytes, batch_seconds)
+    replay(replay_path, collection_name, no_transaction, batcher, dry_run)
+    batcher.summary('bulk insert')
+    return
+  order_by = plan.fetch_order
+  group_by = plan.group_by
+  is_col_group = plan.is_collection_group
+  # Field mask for live fetches: only the source fields the mapping (or the --column) reads.
+  fields = plan.projection(column)
+  if fields is not None and export_dir is None:
+    print_info(f'Fetching fields: {", ".join(".".join(path) for path in fields) or "(document keys only)"}')
 
-  DEBUG_single_column = column is not None
+  if export_dir is not None and (estimate > 0 or follow):
+    print_err('--export cannot be used with --estimate or --follow, which read the live collection.')
+    return
+  if export_dir is not None:
+    missing_metadata = missing_metadata_columns(plan)
+    if missing_metadata:
+      print_warn(f'--export: exports have no {" or ".join(MISSING_METADATA)}, so columns {missing_metadata} read None (and fall back to their transform\'s default).')
 
-  fetch_start = time()
-  docs = []
-  if is_col_group:
-    print_info(f'Fetching {collection_name} as a collection group...')
-    if limit >= 0:
-      docs = fetch_collection_group(collection_name, limit, order_by, start_after).get('result', [])
+  if sample > 0:
+    if not dry_run:
+      print_err('--sample requires --dry-run, since it only loads part of the collection.')
+      return
+    if limit >= 0 or start_after or resume or follow or changed_only or estimate > 0:
+      print_err('--sample cannot be used with --limit, --after, --resume, --follow, --changed-only or --estimate.')
+      return
+    # The sample is a single chunk.
+    chunk_size = 0
+
+  if verify > 0:
+    if changed_only or follow or sample > 0 or column is not None:
+      print_err('--verify cannot be used with --changed-only, --follow, --sample or --column.')
+      return
+    # Nothing is written, so no checkpoints are saved either.
+    dry_run = True
+
+  if auto_strategy > 0 and (backend_name != 'edgedb' or verify > 0 or column is not None):
+    print_err('--auto-strategy only chooses between EdgeDB load strategies and cannot be used with --backend, --verify or --column.')
+    return
+
+  if estimate > 0:
+    count, count_reads = count_documents(collection_name, is_col_group, plan.source_filters)
+    fetch_start = time()
+    docs = next(fetch_chunks(collection_name, order_by, is_col_group, estimate, start_after, fields=fields, filters=plan.source_filters))
+    fetch_seconds = time() - fetch_start
+    if not docs:
+      print_err(f'--estimate: no documents found in {collection_name}.')
+      return
+    measured, output = measure_sample(plan, docs, fetch_seconds, no_external)
+    round_trip = None
+    try:
+      round_trip = measure_round_trip()
+      measure_load(plan, measured, output, LookupMaps(plan).load() if plan.lookups else None)
+    except Exception as e:
+      if round_trip is None:
+        print_warn(f'--estimate: could not measure EdgeDB round trip time, query time will not be projected ({e}).')
+      else:
+        print_warn(f'--estimate: could not load the sample, query time is only projected from round trips ({e}).')
+    print(f'\nEstimate for {collection_name} from a sample of {len(docs)} documents:')
+    print(format_estimate(extrapolate(plan, measured, count, count_reads, round_trip, chunk_size)))
+    return
+
+  checkpoint = None
+  if resume:
+    if start_after:
+      print_err('--resume and --after cannot be used together.')
+      return
+    checkpoint = load_checkpoint(collection_name, order_by)
+    if checkpoint is None:
+      print_warn(f'--resume: no checkpoint found for {collection_name}, starting from the beginning.')
     else:
-      docs = fetch_collection_group(collection_name, None, order_by, start_after).get('result', [])
-  else:
-    if limit >= 0:
-      docs = fetch_collection(collection_name, limit, order_by, start_after).get('result', [])
+      print_info(f'--resume: continuing after {checkpoint["path"]} ({checkpoint["documents_loaded"]} documents loaded so far).')
+      if export_dir is not None:
+        start_after = checkpoint
+      else:
+        start_after = checkpoint_cursor(checkpoint['path'], order_by, checkpoint['order_value'])
+  documents_loaded = checkpoint['documents_loaded'] if checkpoint else 0
+
+  grouper = None
+  if group_by and chunk_size > 0 and not follow:
+    if column is not None:
+      print_warn('--column: rules with group_by are transformed as a single chunk.')
+      chunk_size = 0
     else:
-      docs = fetch_all(collection_name, order_by, start_after)
-  source_df = pandas.DataFrame(docs)
-  fetch_end = time()
-  print('Loaded columns: ', list(source_df.columns))
-  print(f'Fetch time: {fetch_end - fetch_start}s')
-
-  # if update_nonce:
-  #   print(f'Updating nonce for {len(source_df.index)} items in {collection_name}...')
-  #   current_nonce = int(time())
-  #   source_df['update_nonce'] = current_nonce
-  #   if not dry_run:
-  #     if update_nonce and limit < 0:
-  #       print_err('Will not call update_nonce without a limit, as this would update all documents in the collection!')
-  #       return
-  #     batch_update_nonce(source_df, collection_name, 'update_nonce', current_nonce)
-  #   return
+      grouper = make_grouper(plan, spill_partitions)
 
-  transform_start = time()
-  if DEBUG_single_column:
-    if not column in source_df.columns:
-      print_err(f'Column {column} not found in collection {collection_name} (specified with --column)')
+  if follow:
+    if start_after or resume or column is not None:
+      print_err('--follow cannot be used with --after, --resume or --column.')
       return
-    if not dry_run:
-      print_err('Cannot fetch a single column without --dry-run since generated queries would insert partial data.')
+    # Changes to grouped rules reload their whole group, found by its source fields.
+    group_fn = document_group_fn(plan) if group_by else None
+    # Modified documents must be upserted rather than discarded on conflict, so follow mode always tracks row hashes.
+    changed_only = True
+
+  hash_state = None
+  if changed_only:
+    if column is not None:
+      print_err('--changed-only cannot be used with --column.')
       return
-    output = transform_source(source_df, mapping, group_by, no_external, column)
-  else:
-    output = transform_source(source_df, mapping, group_by, no_external)
-    output = run_prereq_queries(output, prerequisites)
-  transform_end = time()
-  print(f'Transform time: {transform_end - transform_start}s')
+    hash_store = open_hash_store(collection_name)
+    hash_state = { 'stored': load_hashes(hash_store), 'pending': {} }
+    print_info(f'--changed-only: {len(hash_state["stored"])} row hashes from previous loads.')
 
-  query_start = time()
-  if bulk_insert:
-    print(f'Query: {iterated_query} (with bulk insert)')
-    if not dry_run:
-      print(f'will run on {len(output)} rows')
-      run_bulk_inserts(output, iterated_query)
-  elif row_resolver_function:
-    print(f'Query: {row_resolver_function} (with row resolvers)')
-    if not dry_run:
-      print(f'will run on {len(output)} rows')
-      run_bulk_resolved_queries(output, row_resolver_function, row_resolvers)
+  artifacts = None
+  if save_artifacts:
+    if backend_name != 'edgedb' or verify > 0:
+      print_err('--save-artifacts only records EdgeDB loads and cannot be used with --backend or --verify.')
+      return
+    artifacts = ArtifactWriter(save_artifacts, collection_name, append=checkpoint is not None)
+    print_info(f'--save-artifacts: {"appending" if checkpoint is not None else "writing"} requests to {save_artifacts}.')
+
+  batcher = AdaptiveBatcher(batch_bytes, batch_seconds)
+  if verify > 0:
+    backend = Verifier(verify)
   else:
-    querybuilder_start = time()
-    built_queries = build_queries(
-      output,
-      table_name,
-      edgedb_type_casts,
-      query_suffix,
-      skip_row_if_empty,
-      dump_invalid,
+    backend = create_backend(backend_name, target, bulk_insert, no_transaction, dump_invalid, batcher, artifacts)
+  if plan.prerequisites and not backend.runs_prerequisites:
+    print_warn(f'--backend {backend_name}: edgedb_prereq_queries are not run, rows are loaded without them.')
+  transformer = ParallelTransformer(plan, workers) if workers > 1 and column is None else None
+  lookups = None
+  if plan.lookups:
+    if not backend.runs_prerequisites:
+      print_warn(f'--backend {backend_name}: lookups are not resolved, lookup columns keep their source values.')
+    else:
+      try:
+        lookups = LookupMaps(plan).load()
+      except Exception as e:
+        if not dry_run or verify > 0:
+          raise
+        print_warn(f'--dry-run: could not fetch lookups, lookup columns keep their source values ({e}).')
+
+  strategy_summary = None
+  if auto_strategy > 0:
+    docs = next(fetch_chunks(collection_name, order_by, is_col_group, auto_strategy, start_after, 0, export_dir, fields, plan.source_filters))
+    output = transform_source(pandas.DataFrame(docs), plan, None, no_external)
+    if lookups is not None:
+      output = lookups.apply(output)
+    strategy = None
+    if output.empty:
+      strategy_summary = '--auto-strategy: no rows to measure strategies on.'
+    else:
+      rows = len(output)
+      if group_by:
+        output = output.groupby(list(group_by))
+      output = run_prereq_queries(output, plan.prerequisites)
+      strategy, strategy_summary = choose_strategy(plan, output, rows)
+    if strategy is None:
+      default_strategy = 'bulk-insert' if bulk_insert else 'row-resolvers' if plan.row_resolver_function else 'insert'
+      strategy_summary += f' Using {default_strategy}.'
+      print_warn(strategy_summary)
+    else:
+      print_success(strategy_summary)
+      backend.bulk_insert = strategy == 'bulk-insert'
+  timings = { 'fetch': 0, 'transform': 0, 'query': 0 }
+
+  if follow:
+    def flush(docs):
+      try:
+        failed = load_chunk(
+          plan,
+          pandas.DataFrame(docs),
+          timings,
+          backend,
+          dry_run,
+          no_external,
+          append=True,
+          hash_state=hash_state,
+          transformer=transformer,
+          lookups=lookups,
+        )
+        if failed is None:
+          raise Exception('Chunk was not loaded.')
+      except Exception:
+        commit_pending_hashes(hash_store, hash_state, False)
+        raise
+      commit_pending_hashes(hash_store, hash_state, not dry_run, failed)
+
+    replicator = Replicator(flush, flush_size, flush_interval, group_fn)
+    listen_filtered = lambda name, is_group, callback: listen(name, is_group, callback, plan.source_filters)
+    stats = replicator.follow(listen_filtered, collection_name, is_col_group)
+    backend.close()
+    if transformer is not None:
+      transformer.close()
+    if lookups is not None:
+      lookups.summary()
+    print(f'follow: {stats["changes"]} changes ({stats["removed"]} removals ignored), {stats["documents"]} documents in {stats["flushes"]} flushes.')
+    print(f'Transform time: {timings["transform"]}s')
+    print(f'Query time: {timings["query"]}s')
+    if strategy_summary is not None:
+      print(strategy_summary)
+    return
+
+  documents_fetched = 0
+  # Once rows of a chunk failed to load, the checkpoint stays before it so that --resume retries it.
+  failed_rows = 0
+  last_doc = None
+  fetch_start = time()
+  for i, docs in enumerate(fetch_chunks(collection_name, order_by, is_col_group, limit, start_after, chunk_size, export_dir, fields, plan.source_filters, sample)):
+    timings['fetch'] += time() - fetch_start
+    source_df = pandas.DataFrame(docs)
+    if i == 0:
+      print('Loaded columns: ', list(source_df.columns))
+
+    # if update_nonce:
+    #   print(f'Updating nonce for {len(source_df.index)} items in {collection_name}...')
+    #   current_nonce = int(time())
+    #   source_df['update_nonce'] = current_nonce
+    #   if not dry_run:
+    #     if update_nonce and limit < 0:
+    #       print_err('Will not call update_nonce without a limit, as this would update all documents in the collection!')
+    #       return
+    #     batch_update_nonce(source_df, collection_name, 'update_nonce', current_nonce)
+    #   return
+    if chunk_size > 0:
+      print_info(f'Chunk {i}: {len(docs)} documents')
+
+    failed = load_chunk(
+      plan,
+      source_df,
+      timings,
+      backend,
+      dry_run,
+      no_external,
+      column,
+      append=checkpoint is not None,
+      hash_state=hash_state,
+      grouper=grouper,
+      transformer=transformer,
+      lookups=lookups,
     )
-    querybuilder_end = time()
-    print(f'Query builder time: {querybuilder_end - querybuilder_start}s')
+    if failed is None:
+      backend.close()
+      if transformer is not None:
+        transformer.close()
+      return
 
-    print('\nQueries (head):')
-    print(trim_whitespace(json.dumps(list(built_queries[:5]))))
-    print('\nQueries (tail):')
-    print(trim_whitespace(json.dumps(list(built_queries[-5:]))))
-    if not dry_run:
-      run_bulk_queries(built_queries, no_transaction)
-  query_end = time()
-  print(f'Query time: {query_end - query_start}s')
-
-
-task_start = time()
-run_task(
-  args.collection,
-  args.dry_run,
-  args.dump_invalid,
-  args.no_external,
-  args.no_transaction,
-  args.bulk_insert,
-  args.column,
-  args.limit,
-  args.start_after,
-)
-task_end = time()
-print(f'Task time: {task_end - task_start}s')
+    if hash_state is not None:
+      commit_pending_hashes(hash_store, hash_state, not dry_run, failed)
+    documents_fetched += len(docs)
+    failed_rows += len(failed)
+    # Documents whose rows are held back by the grouper are not loaded yet, so the checkpoint goes before them.
+    pending = grouper.pending_rows if grouper is not None else 0
+    if not dry_run and not failed_rows and pending < len(docs):
+      last_loaded = docs[len(docs) - pending - 1]
+      save_checkpoint(collection_name, order_by, last_loaded, documents_loaded + documents_fetched - pending)
+      print_info(f'Checkpoint saved after {last_loaded["id"]} ({documents_loaded + documents_fetched - pending} documents loaded).')
+    if docs:
+      last_doc = docs[-1]
+    fetch_start = time()
+
+  if grouper is not None:
+    for ready in grouper.finish():
+      failed = load_output(plan, ready, timings, backend, dry_run, checkpoint is not None, hash_state, lookups)
+      failed_rows += len(failed)
+      if hash_state is not None:
+        commit_pending_hashes(hash_store, hash_state, not dry_run, failed)
+    if not dry_run and not failed_rows and last_doc is not None:
+      save_checkpoint(collection_name, order_by, last_doc, documents_loaded + documents_fetched)
+      print_info(f'Checkpoint saved after {last_doc["id"]} ({documents_loaded + documents_fetched} documents loaded).')
+  backend.close()
+  if transformer is not None:
+    transformer.close()
+  if lookups is not None:
+    lookups.summary()
+  if failed_rows and not dry_run:
+    print_warn(f'{failed_rows} rows failed to load; the checkpoint was not advanced past the first chunk with failures, so --resume retries from there.')
+
+  print(f'Fetch time: {timings["fetch"]}s')
+  print(f'Transform time: {timings["transform"]}s')
+  print(f'Query time: {timings["query"]}s')
+  if strategy_summary is not None:
+    print(strategy_summary)
+
+
+if __name__ == '__main__':
+  args = parser.parse_args(sys.argv[1:])
+  configure_logging(args.log_level, args.log_sample_after, args.log_sample_every)
+  configure_fetching(args.max_retries, args.reads_per_second)
+  task_start = time()
+  run_task(
+    args.collection,
+    args.dry_run,
+    args.dump_invalid,
+    args.no_external,
+    args.no_transaction,
+    args.bulk_insert,
+    args.column,
+    args.limit,
+    args.start_after,
+    args.resume,
+    args.chunk_size,
+    args.changed_only,
+    args.follow,
+    args.flush_size,
+    args.flush_interval,
+    args.explain,
+    args.estimate,
+    args.export_dir,
+    args.backend,
+    args.target,
+    args.spill_partitions,
+    args.workers,
+    args.batch_bytes,
+    args.batch_seconds,
+    args.sample,
+    args.check_indexes,
+    args.verify,
+    args.save_artifacts,
+    args.replay,
+    args.auto_strategy,
+  )
+  task_end = time()
+  print_log_summary()
+  print(f'Task time: {task_end - task_start}s')
 
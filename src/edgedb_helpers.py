@@ -1,22 +1,46 @@
+from __future__ import annotations
+import csv
 import json
 import os
+from time import time
 from typing import Callable
-from edgedb import create_client
-from google.api_core import datetime_helpers
-import pandas
 
-from utils import datetime_to_rfc3339, print_err, print_info, print_success, print_warn, row_to_csv, str_escape, is_null
+from batching import AdaptiveBatcher
+from plan import cast_prefix
+from serialization import dumps, join_records
+from utils import datetime_to_rfc3339, iter_rows, lazy_import, print_debug, print_err, print_info, print_success, print_warn, str_escape, is_null
 
-client = create_client(
-  dsn=os.environ['EDGEDB_DSN'],
-  tls_security='insecure',
-)
+edgedb = lazy_import('edgedb')
+pandas = lazy_import('pandas')
+datetime_helpers = lazy_import('google.api_core.datetime_helpers')
+
+_clients = {}
+
+
+def get_client():
+  # The client is created on first use, so modes which never query EdgeDB do not need EDGEDB_DSN.
+  if not 'edgedb' in _clients:
+    _clients['edgedb'] = edgedb.create_client(
+      dsn=os.environ['EDGEDB_DSN'],
+      tls_security='insecure',
+    )
+  return _clients['edgedb']
+
+
+def measure_round_trip(samples=3):
+  # Median latency of a trivial query, in seconds.
+  latencies = []
+  for _ in range(samples):
+    start = time()
+    get_client().query('select 1')
+    latencies.append(time() - start)
+  return sorted(latencies)[len(latencies) // 2]
 
 
 def wrap_expression(expr, edgedb_cast):
   output = ''
   if edgedb_cast:
-    output += f'<{edgedb_cast}>'
+    output += cast_prefix(edgedb_cast)
 
   if type(expr) == str:
     output += f'"{str_escape(expr)}"'
@@ -43,37 +67,61 @@ def row_id(row):
   return None
 
 
+def row_key(row):
+  # row_id as a string, the form in which rows are keyed by the hash store and by load failures.
+  key = row_id(row)
+  return None if is_null(key) else str(key)
+
+
+def group_key(row, group_by: list):
+  # Key of the group a row belongs to (a scalar for a single group_by column, a list otherwise), or None if a
+  # group_by value is null (pandas leaves such rows out of groups).
+  values = [row[column] for column in group_by]
+  if any(is_null(value) for value in values):
+    return None
+  return json.dumps(values[0] if len(values) == 1 else values, default=str)
+
+
 def get_query_builder(
   transformed_df: pandas.DataFrame,
   edgedb_collection: str,
   type_casts: dict,
   query_suffix: str,
   skip_row_if_empty: list,
+  upsert_ids: set = None,
 ):
   # Any scalar field not present in type_casts will be "quoted" and escaped, but not cast to <str>.
   # Any dict- or list-like field will be cast to <json>.
-  columns = transformed_df.columns
+  # Rows whose row_key is in upsert_ids update the existing object on conflict instead of being discarded.
+  # Per-column casts and skip rules are resolved once here rather than looked up for every cell.
+  column_specs = tuple(
+    (field, type_casts.get(field, None), field == 'metadata', field in skip_row_if_empty)
+    for field in transformed_df.columns
+  )
+  can_upsert = 'unless conflict on' in query_suffix and not 'else' in query_suffix
+  if upsert_ids and not can_upsert:
+    print_warn(f'query: Cannot upsert into {edgedb_collection} without an `unless conflict on` query suffix; changed rows will be inserted.')
   def query_builder(row):
     id = row_id(row)
+    key = row_key(row)
     vars = {}
-    query = f'insert {edgedb_collection} {{'
+    body = ''
     stop_triggered = False
 
-    for field in columns:
+    for field, edgedb_cast, is_metadata, skip_if_empty in column_specs:
       expr = row[field]
       subquery = None
-      edgedb_cast = type_casts[field] if field in type_casts else None
-      if (field == 'metadata'):
+      if is_metadata:
         if type(expr) == dict and should_skip(expr):
-          print_warn(f'query: Skipping row {id} due to metadata: {json.dumps(expr)}')
+          print_warn(lambda: f'query: Skipping row {id} due to metadata: {json.dumps(expr)}', key='query_skip_metadata')
           stop_triggered = True
           break
         else:
           continue
 
       if is_null(expr):
-        if field in skip_row_if_empty:
-          print_warn(f'query: Skipping row {id} due to empty field {field}')
+        if skip_if_empty:
+          print_warn(lambda: f'query: Skipping row {id} due to empty field {field}', key=f'query_skip_empty:{field}')
           stop_triggered = True
           break
         else:
@@ -106,36 +154,30 @@ def get_query_builder(
           else:
             raise Exception('Validation: __vars must be specified when using __query.')
         elif len(expr.keys()) > 0:
-          expr = json.dumps(expr)
+          expr = dumps(expr)
           edgedb_cast = 'json'
         else:
           continue
       if type(expr) == pandas.Timestamp or type(expr) == datetime_helpers.DatetimeWithNanoseconds:
         expr = datetime_to_rfc3339(expr)
       if subquery:
-        query += f' {field} {subquery},'
+        body += f' {field} {subquery},'
       else:
-        query += f' {field} := {wrap_expression(expr, edgedb_cast)},'
+        body += f' {field} := {wrap_expression(expr, edgedb_cast)},'
 
     if stop_triggered:
-      return { '__valid': False, '__row': row_to_csv(row) }
+      return { '__valid': False, '__row': row }
 
-    query += '} ' + query_suffix
-    query_info = { '__valid': True, '__q': query, '__v': vars }
+    query = f'insert {edgedb_collection} {{' + body + '} ' + query_suffix
+    if can_upsert and upsert_ids and key in upsert_ids:
+      query += f' else (update {edgedb_collection} set {{' + body + '})'
+    query_info = { '__valid': True, '__q': query, '__v': vars, '__key': key }
     # print(query_info)
     return query_info
 
   return query_builder
 
 
-def row_validator(row):
-  return '__valid' in row and row['__valid'] == True
-
-
-def unnest_row(series):
-  return series.apply(lambda r: r.get('__row', None))
-
-
 def remap_vars(vars, row):
   result = {}
   for k, v in vars.items():
@@ -152,21 +194,20 @@ def remap_vars(vars, row):
 def run_prereq_queries(df: pandas.DataFrame, prereq_queries: list):
   def run_query_on_row(query, vars, row):
     if 'metadata' in row and row['metadata'].get('__prereq_valid', True) == False:
-      print_info(f'Skipping row {row_id(row)} due to metadata: {json.dumps(row["metadata"])}')
+      print_debug(lambda: f'Skipping row {row_id(row)} due to metadata: {json.dumps(row["metadata"])}', key='prereq_skip_metadata')
       return row
 
-    print_info(f'Running prereq query: {query}')
+    print_debug(lambda: f'Running prereq query: {query}', key='prereq_query')
     metadata = {}
     v = remap_vars(vars, row)
     try:
-      res = client.query(query, **v)
+      res = get_client().query(query, **v)
       valid = res[0] > 0
       metadata['__prereq_valid'] = valid
       if not valid:
-        print_warn(f'Prereq query failed, vars: {json.dumps(v)}')
+        print_warn(lambda: f'Prereq query failed, vars: {json.dumps(v)}', key='prereq_failed')
     except Exception as e:
-      print_err(f"Error executing query '{query}' with variables {json.dumps(v)}")
-      print_err(f"Error: {e}")
+      print_err(lambda: f"Error executing query '{query}' with variables {json.dumps(v)}\nError: {e}", key='prereq_error')
       metadata['__prereq_valid'] = False
     row['metadata'] = metadata
     return row
@@ -186,103 +227,178 @@ def build_queries(
   query_suffix: str,
   skip_row_if_empty: list = [],
   dump_invalid: bool = False,
+  stats: dict = None,
+  append_invalid: bool = False,
+  upsert_ids: set = None,
 ):
+  # Generator: builds queries in a single pass over the rows and yields the valid ones lazily.
+  # Invalid rows are streamed to CSV as they are found when dump_invalid is set (appended to when append_invalid is set).
+  # Counts are written to `stats` (if given) and printed once the generator is exhausted.
   builder = get_query_builder(
     transformed_df,
     edgedb_collection,
     type_casts,
     query_suffix,
     skip_row_if_empty,
+    upsert_ids,
   )
-  built_all = transformed_df.apply(builder, axis='columns')
-  built_non_na = built_all.dropna()
-  loc_valid = built_non_na.apply(row_validator)
-  built_valid = built_non_na.loc[loc_valid]
-  built_invalid = built_non_na.loc[loc_valid.apply(lambda x: not x)]
-
-  if dump_invalid and built_invalid.shape[0] > 0:
-    filename = f'{edgedb_collection}_invalid.csv'
-    unnest_row(built_invalid).to_csv(filename, index=False)
-    print_info(f'--dump-invalid: rows dumped to {filename}')
+  stats = {} if stats is None else stats
+  stats.update({ 'processed': 0, 'na': 0, 'invalid': 0, 'valid': 0 })
+  filename = f'{edgedb_collection}_invalid.csv'
+  invalid_file = None
+  invalid_writer = None
 
-
-  print(f'Processed {len(built_all)} rows.')
-  print(f'Skipped {len(built_all) - len(built_non_na)} rows which were NA.')
-  print(f'Skipped {len(built_invalid)} rows which did not pass validation checks.')
-  print_success(f'Built {len(built_valid)} valid queries.')
-  return built_valid
-
-
-def run_bulk_inserts_base(
-  source_df: pandas.DataFrame = None,
-  iterated_query: str = None,
-):
-  json_data = source_df.to_json(orient='records')
   try:
-    client.query(iterated_query, data=json_data)
+    for row in iter_rows(transformed_df):
+      stats['processed'] += 1
+      built = builder(row)
+      if built is None:
+        stats['na'] += 1
+      elif built['__valid']:
+        stats['valid'] += 1
+        yield built
+      else:
+        stats['invalid'] += 1
+        if dump_invalid:
+          if invalid_writer is None:
+            write_header = not (append_invalid and os.path.exists(filename))
+            invalid_file = open(filename, 'a' if append_invalid else 'w', newline='')
+            invalid_writer = csv.writer(invalid_file)
+            if write_header:
+              invalid_writer.writerow(transformed_df.columns)
+          invalid_writer.writerow(None if is_null(v) else v for v in built['__row'].values())
+  finally:
+    if invalid_file is not None:
+      invalid_file.close()
+      print_info(f'--dump-invalid: {stats["invalid"]} rows dumped to {filename}')
+
+  print(f'Processed {stats["processed"]} rows.')
+  print(f'Skipped {stats["na"]} rows which were NA.')
+  print(f'Skipped {stats["invalid"]} rows which did not pass validation checks.')
+  print_success(f'Built {stats["valid"]} valid queries.')
+
+
+def send_bulk_insert(iterated_query: str, json_data: str, batcher: AdaptiveBatcher = None):
+  # Returns whether the request succeeded.
+  try:
+    if batcher is None:
+      get_client().query(iterated_query, data=json_data)
+    else:
+      batcher.send(lambda data: get_client().query(iterated_query, data=data), json_data)
   except Exception as e:
     print_err(f"Error executing query '{iterated_query}' with {json_data}")
     print_err(f"Exception: {e}")
-  return
+    return False
+  return True
 
 
-def run_bulk_inserts(
+def bulk_payloads_base(
+  source_df: pandas.DataFrame = None,
+  batcher: AdaptiveBatcher = None,
+  group_by: list = None,
+):
+  # Yields (JSON array to send to edgedb_iterated_query, keys of the rows in it). With a batcher, rows are split
+  # into batches within its byte budget. A group (group_by given) is always sent whole and keyed by its group_key,
+  # since edgedb_iterated_query is written for a single group.
+  if source_df.empty:
+    return
+  records = ((dumps(row), row_key(row)) for row in iter_rows(source_df))
+  if batcher is None or group_by:
+    records = list(records)
+    json_data = join_records(encoded for encoded, _ in records)
+    if batcher is not None and len(json_data) > batcher.max_bytes:
+      print_warn(f'bulk insert: group of {len(source_df)} rows is {len(json_data)} bytes, over the {batcher.max_bytes} byte limit; sending it whole.', key='bulk_insert_oversized')
+    if group_by:
+      yield json_data, [group_key(next(iter_rows(source_df.head(1))), group_by)]
+    else:
+      yield json_data, [key for _, key in records]
+    return
+  for batch in batcher.batches(records, size_fn=lambda record: len(record[0])):
+    yield join_records(encoded for encoded, _ in batch), [key for _, key in batch]
+
+
+def bulk_payloads(
   source_df: pandas.DataFrame = None,
-  iterated_query: str = None,
+  batcher: AdaptiveBatcher = None,
+  group_by: list = None,
 ):
   if type(source_df) == pandas.core.groupby.DataFrameGroupBy:
     print_info(f'Running bulk inserts for grouped dataframe')
     for group_name, group_df in source_df:
-      print_info(f'Running bulk inserts for group {group_name}')
-      run_bulk_inserts(group_df, iterated_query)
+      print_debug(lambda: f'Running bulk inserts for group {group_name}', key='bulk_insert_group')
+      yield from bulk_payloads_base(group_df, batcher, group_by)
   else:
-    run_bulk_inserts_base(source_df, iterated_query)
+    yield from bulk_payloads_base(source_df, batcher)
 
 
-def run_bulk_resolved_queries(
-  source_df: pandas.DataFrame = None,
-  row_resolver_function: Callable = None,
-  row_resolvers: dict = {}
-):
-  for i, row in source_df.iterrows():
-    print_info(f'Running bulk resolved query for row {i}')
-    run_bulk_resolved_query(row.to_dict(), row_resolver_function, row_resolvers)
+def run_bulk_payloads(payloads, iterated_query: str = None, batcher: AdaptiveBatcher = None):
+  # Payloads are generated lazily, so the batcher's budget adapts between requests.
+  # Returns the keys of the rows (or groups) of failed requests.
+  failed = []
+  for json_data, keys in payloads:
+    if not send_bulk_insert(iterated_query, json_data, batcher):
+      failed.extend(keys)
+  return failed
 
 
-def run_bulk_resolved_query(
-  row: dict = None,
+def resolved_queries(
+  source_df: pandas.DataFrame = None,
   row_resolver_function: Callable = None,
   row_resolvers: dict = {}
 ):
-  json_data = json.dumps(row)
-  row_resolver = None
-  try:
-    resolution = row_resolver_function(row)
+  # Yields (query, JSON row, row key) for each row with a valid resolution.
+  for i, row in enumerate(iter_rows(source_df)):
+    json_data = dumps(row)
+    try:
+      resolution = row_resolver_function(row)
+    except Exception as e:
+      print_err(lambda: f"Error resolving row {json_data}\nException: {e}", key='resolved_query_error')
+      continue
     if resolution not in row_resolvers:
-      print_err(f'Invalid resolution {resolution} for row {json_data}')
-      return
-    row_resolver = row_resolvers[resolution]
-    result = client.query(row_resolver, data=json_data)
-    print_info(f'Row {json_data} resolved to {resolution} with result {result}')
-  except Exception as e:
-    print_err(f"Error executing query '{row_resolver}' with {json_data}")
-    print_err(f"Exception: {e}")
-  return
+      print_err(lambda: f'Invalid resolution {resolution} for row {json_data}', key='resolved_query_invalid')
+      continue
+    print_debug(lambda: f'Row {i} resolved to {resolution}', key='resolved_query_row')
+    yield row_resolvers[resolution], json_data, row_key(row)
+
+
+def run_resolved_queries(queries):
+  # Returns the keys of the rows whose query failed.
+  failed = []
+  for row_resolver, json_data, key in queries:
+    try:
+      result = get_client().query(row_resolver, data=json_data)
+      print_debug(lambda: f'Row {json_data} ran {row_resolver} with result {result}', key='resolved_query_result')
+    except Exception as e:
+      print_err(lambda: f"Error executing query '{row_resolver}' with {json_data}\nException: {e}", key='resolved_query_error')
+      failed.append(key)
+  return failed
 
 
 def run_bulk_queries(queries, no_transaction=False):
+  # Returns the keys of the rows whose query failed. In a transaction, a failing query raises instead.
   if no_transaction:
     print_info('--no-transaction: running queries without transactional guarantees')
+    failed = []
     for q in queries:
       try:
-        client.query(q['__q'], **q['__v'])
+        get_client().query(q['__q'], **q['__v'])
       except Exception as e:
-        print_err(f"Error executing query '{q['__q']}' with variables {json.dumps(q['__v'])}")
-        print_err(f"Exception: {e}")
+        print_err(lambda: f"Error executing query '{q['__q']}' with variables {json.dumps(q['__v'])}\nException: {e}", key='query_error')
+        failed.append(q.get('__key', None))
+    return failed
   else:
-    for tx in client.transaction():
+    # Queries may be a one-shot generator, so keep the ones already sent in case the transaction is retried.
+    sent = []
+    pending = iter(queries)
+    def replay_queries():
+      yield from sent[:]
+      for query_obj in pending:
+        sent.append(query_obj)
+        yield query_obj
+
+    for tx in get_client().transaction():
       with tx:
-        for query_obj in queries:
+        for query_obj in replay_queries():
           query = query_obj['__q']
           vars = query_obj['__v']
           try:
@@ -290,3 +406,4 @@ def run_bulk_queries(queries, no_transaction=False):
           except Exception as e:
             print_err(f"Error executing query '{query}' with variables {json.dumps(vars)}")
             raise e
+    return []
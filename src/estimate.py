@@ -0,0 +1,148 @@
+from __future__ import annotations
+import json
+from math import ceil
+from time import time
+
+from benchmark import benchmark_strategies
+from edgedb_helpers import build_queries, run_prereq_queries
+from lookups import LookupMaps
+from plan import RulePlan
+from serialization import dumps, encode_records, join_records
+from utils import get_or_unnest_col, iter_rows, lazy_import, transform_source
+
+pandas = lazy_import('pandas')
+
+
+def measure_sample(plan: RulePlan, docs: list, fetch_seconds: float, no_external=False):
+  # Runs the rule's transforms and query builder on sampled documents (without sending anything) and measures them.
+  # Returns (sample, transformed rows).
+  sample = { 'documents': len(docs), 'fetch_seconds': fetch_seconds, 'external_calls': {} }
+  source_df = pandas.DataFrame(docs)
+
+  start = time()
+  output = transform_source(source_df, plan, None, no_external)
+  sample['transform_seconds'] = time() - start
+  sample['rows'] = len(output)
+
+  for column in plan.columns:
+    if not column.is_external or no_external:
+      continue
+    if column.kind == 'row':
+      sample['external_calls'][column.name] = len(source_df)
+    else:
+      values = get_or_unnest_col(source_df, column.source).dropna()
+      sample['external_calls'][column.name] = values.map(lambda v: json.dumps(v, sort_keys=True, default=str)).nunique()
+
+  if plan.table_name:
+    start = time()
+    queries = 0
+    payload_bytes = 0
+    for query in build_queries(output, plan.table_name, plan.type_casts, plan.query_suffix, plan.skip_row_if_empty):
+      queries += 1
+      payload_bytes += len(query['__q']) + len(dumps(query['__v']))
+    sample['build_seconds'] = time() - start
+    sample['insert_queries'] = queries
+    sample['insert_bytes'] = payload_bytes
+  if plan.iterated_query:
+    sample['bulk_groups'] = output.groupby(list(plan.group_by)).ngroups if plan.group_by else None
+    sample['bulk_bytes'] = len(join_records(encode_records(iter_rows(output))))
+  if plan.row_resolver_function:
+    sample['resolver_bytes'] = sum(len(record) for record in encode_records(iter_rows(output)))
+  return sample, output
+
+
+def measure_load(plan: RulePlan, sample: dict, output, lookups: LookupMaps = None):
+  # Loads the sample's rows with each strategy the rule supports, in transactions which are rolled back (see
+  # benchmark.py), after resolving lookups and running prerequisite queries as a load would, and records the
+  # time taken: sample['prereq_seconds'], and sample['load_seconds'] per strategy (None if it failed).
+  if lookups is not None:
+    output = lookups.apply(output)
+  rows = len(output)
+  if plan.group_by:
+    output = output.groupby(list(plan.group_by))
+  start = time()
+  output = run_prereq_queries(output, plan.prerequisites)
+  sample['prereq_seconds'] = time() - start
+  rates = benchmark_strategies(plan, output, rows, rounds=1, option='--estimate') if rows else {}
+  sample['load_seconds'] = { name: rows / rate if rate else None for name, rate in rates.items() }
+
+
+def extrapolate(plan: RulePlan, sample: dict, total: int, count_reads: int, round_trip: float = None, chunk_size=0):
+  scale = total / sample['documents'] if sample['documents'] else 0
+  rows = sample['rows'] * scale
+  prereq_round_trips = len(plan.prerequisites) * rows
+
+  # Unchunked fetches of plain collections go through fetch_all, which reads the collection once more to count it.
+  counts_with_full_read = chunk_size <= 0 and not plan.is_collection_group
+  reads = count_reads + total + (total if counts_with_full_read else 0)
+  fetch_seconds = sample['fetch_seconds'] * scale * (2 if counts_with_full_read else 1)
+  transform_seconds = sample['transform_seconds'] * scale
+
+  strategies = {}
+  if plan.table_name:
+    strategies['insert'] = {
+      'round_trips': sample['insert_queries'] * scale + prereq_round_trips,
+      'bytes': sample['insert_bytes'] * scale,
+      'cpu_seconds': sample['build_seconds'] * scale,
+    }
+  if plan.iterated_query:
+    if plan.group_by:
+      # Groups do not grow linearly with documents, so this is an upper bound.
+      requests = sample['bulk_groups'] * scale
+    else:
+      requests = ceil(total / chunk_size) if chunk_size > 0 else 1
+    strategies['bulk-insert'] = {
+      'round_trips': requests + prereq_round_trips,
+      'bytes': sample['bulk_bytes'] * scale,
+      'cpu_seconds': 0,
+    }
+  if plan.row_resolver_function:
+    strategies['row-resolvers'] = {
+      'round_trips': rows + prereq_round_trips,
+      'bytes': sample['resolver_bytes'] * scale,
+      'cpu_seconds': 0,
+    }
+  # Strategies loaded on the sample are projected from the time they took; the others only from the round trip
+  # time of a trivial query, which leaves out server-side work and payload transfer, so that is a lower bound.
+  load_seconds = sample.get('load_seconds', {})
+  for name, strategy in strategies.items():
+    strategy['measured'] = load_seconds.get(name, None) is not None
+    if strategy['measured']:
+      strategy['seconds'] = fetch_seconds + transform_seconds + (sample['prereq_seconds'] + load_seconds[name]) * scale
+    elif round_trip is not None:
+      strategy['seconds'] = fetch_seconds + transform_seconds + strategy['cpu_seconds'] + strategy['round_trips'] * round_trip
+    else:
+      strategy['seconds'] = None
+
+  return {
+    'documents': total,
+    'rows': rows,
+    'reads': reads,
+    'fetch_seconds': fetch_seconds,
+    'transform_seconds': transform_seconds,
+    'external_calls': {name: calls * scale for name, calls in sample['external_calls'].items()},
+    'round_trip': round_trip,
+    'strategies': strategies,
+  }
+
+
+def format_estimate(estimate: dict):
+  lines = [
+    f'Documents: {estimate["documents"]} (~{estimate["rows"]:.0f} rows after transform)',
+    f'Firestore reads: ~{estimate["reads"]:.0f}',
+    f'Fetch time: ~{estimate["fetch_seconds"]:.1f}s',
+    f'Transform time: ~{estimate["transform_seconds"]:.1f}s',
+  ]
+  for name, calls in estimate['external_calls'].items():
+    lines.append(f'External calls for {name}: up to ~{calls:.0f} (distinct inputs)')
+  if estimate['round_trip'] is not None:
+    lines.append(f'EdgeDB round trip: {estimate["round_trip"] * 1000:.1f}ms')
+  for name, strategy in estimate['strategies'].items():
+    if strategy['seconds'] is None:
+      projected = ''
+    elif strategy['measured']:
+      projected = f', ~{strategy["seconds"]:.1f}s total (measured on the sample)'
+    else:
+      projected = f', at least ~{strategy["seconds"]:.1f}s total (round trips only, not measured)'
+    lines.append(f'Strategy {name}: ~{strategy["round_trips"]:.0f} round trips, ~{strategy["bytes"] / 1e6:.1f}MB payload{projected}')
+  return '\n'.join(lines)
@@ -1,6 +1,6 @@
 from resolvers import create, create_or_link, link, resolve_cohost, resolve_guest
 from transforms import attach_metadata, get_and_fix_phone_number, get_created_at, get_flyer_fields, get_guest_uid, get_primary_cost, get_time_zone, get_updated_at, normalize_guest_status, normalize_local_date, simple_get_loc, unpack_tokens
-from utils import datetime_to_rfc3339, fix_int, fix_phone_number, is_null
+from utils import datetime_to_rfc3339_column, fix_int_column, fix_phone_number_column, is_null
 
 
 rules = {
@@ -12,11 +12,11 @@ rules = {
       'dimBackground': 'dimBackground',
       'height': {
         'col': ['dimensions', 'height'],
-        'transform': fix_int,
+        'transform': fix_int_column,
       },
       'width': {
         'col': ['dimensions', 'width'],
-        'transform': fix_int,
+        'transform': fix_int_column,
       },
       'font': 'font',
       'includedFields': {
@@ -42,22 +42,24 @@ rules = {
     'is_collection_group': True,
     'fetch_order': ('paidTime', 'ASCENDING'),
     'mapping': {
-      'event_id': {
-        'col': '_path',
-        'transform': lambda x: x[1],
-      },
-      'phone_number': {
+      'event_id': '_parent_id',
+      'person_id': {
         'col': 'id',
-        'transform': fix_phone_number,
+        'transform': fix_phone_number_column,
+        'lookup': 'person',
       },
       'paid': 'paid',
       'clicked_pay': 'clickedPay',
       'redirect_id': 'redirectId',
       'created_at': {
         'col': 'paidTime',
-        'transform': datetime_to_rfc3339,
+        'transform': datetime_to_rfc3339_column,
       },
     },
+    # Payments are linked to the Person with the payment's phone number; payments without one are skipped.
+    'lookups': {
+      'person': { 'type': 'Person', 'key': 'phone_number' },
+    },
     'group_by': ['event_id'],
     'edgedb_iterated_query': '''
       with json_data := <json>$data,
@@ -67,19 +69,13 @@ rules = {
       filter .firebase_id = event_id set {
         payments := distinct (
           for payment in unpacked_data union (
-            with persons := (
-              select Person filter .phone_number = <str>payment['phone_number']
-              limit 1
-            )
-            for person in persons union (
-              insert Payment {
-                paid := <bool>payment['paid'] ?? false,
-                person := person,
-                clicked_pay := <bool>payment['clicked_pay'],
-                redirect_id := <str>payment['redirect_id'],
-                created_at := to_datetime(<str>payment['created_at']) ?? datetime_current(),
-              }
-            )
+            insert Payment {
+              paid := <bool>payment['paid'] ?? false,
+              person := <Person><uuid>payment['person_id'],
+              clicked_pay := <bool>payment['clicked_pay'],
+              redirect_id := <str>payment['redirect_id'],
+              created_at := to_datetime(<str>payment['created_at']) ?? datetime_current(),
+            }
           )
         )
       }
@@ -89,19 +85,16 @@ rules = {
     'is_collection_group': True,
     'fetch_order': ('createdAt', 'ASCENDING'),
     'mapping': {
-      'event_id': {
-        'col': '_path',
-        'transform': lambda x: x[1],
-      },
+      'event_id': '_parent_id',
       'firebase_id': 'id',
       'message': 'message',
       'created_at': {
         'col': 'create_time',
-        'transform': datetime_to_rfc3339,
+        'transform': datetime_to_rfc3339_column,
       },
       'updated_at': {
         'col': 'update_time',
-        'transform': datetime_to_rfc3339,
+        'transform': datetime_to_rfc3339_column,
       },
       'user_id': 'userId',
       'likes': {
@@ -159,10 +152,7 @@ rules = {
     'is_collection_group': True,
     'fetch_order': ('inviteTime', 'ASCENDING'),
     'mapping': {
-      'event_id': {
-        'col': '_path',
-        'transform': lambda x: x[1],
-      },
+      'event_id': '_parent_id',
       'phone_number': {
         'row': True,
         'transform': get_and_fix_phone_number,
@@ -173,7 +163,7 @@ rules = {
       },
       'invite_time': {
         'col': 'inviteTime',
-        'transform': datetime_to_rfc3339,
+        'transform': datetime_to_rfc3339_column,
       },
       'firebase_uid': {
         'row': True,
@@ -392,6 +382,9 @@ rules = {
   'users': {
     'fetch_order': ('phoneNumber', 'ASCENDING'),
     # 'fetch_order': ('tokens', 'ASCENDING'),
+    # Skips deleted and test accounts in Firestore instead of after transforming them (see attach_metadata),
+    # but also every user document which lacks one of these fields.
+    # 'source_filters': [('isDeleted', '==', False), ('testingAccount', '==', False)],
     'edgedb_table_name': 'User',
     'edgedb_type_casts': {
       'birthday': 'cal::local_date',
@@ -429,7 +422,7 @@ rules = {
       'location': 'location',
       'phone_number': {
         'col': 'phoneNumber',
-        'transform': fix_phone_number,
+        'transform': fix_phone_number_column,
       },
       'profile_image': {
         'col': ['profile_image', 'url'],
@@ -479,31 +472,27 @@ rules = {
     'fetch_order': ('createdAt', 'ASCENDING'),
     'mapping': {
       'user_id': {
-        'col': '_path',
-        'transform': lambda x: x[1],
-      },
-      'device_id': {
-        'col': '_path',
-        'transform': lambda x: x[3],
+        'col': '_path_1',
+        'lookup': 'user',
       },
+      'device_id': '_path_3',
       'token': 'expoToken',
       'created_at': {
         'col': 'create_time',
-        'transform': datetime_to_rfc3339,
+        'transform': datetime_to_rfc3339_column,
       },
     },
+    # Tokens are only added to users who have none yet, as of the start of the run.
+    'lookups': {
+      'user': { 'type': 'User', 'key': 'firebase_uid', 'filter': 'count(.notification_tokens) = 0' },
+    },
     'group_by': ['user_id'],
     'edgedb_iterated_query': '''
       with data := <json>$data,
       unpacked_data := json_array_unpack(data),
-      user_id := <str>array_agg(unpacked_data)[0]['user_id'],
-      user := (
-        select User
-        filter .firebase_uid = user_id
-          and count(.notification_tokens) = 0
-        limit 1
-      )
-      update user set {
+      user_id := <uuid>array_agg(unpacked_data)[0]['user_id']
+      update User
+      filter .id = user_id set {
         notification_tokens := (
           for entry in unpacked_data union (
             insert NotificationToken {
@@ -0,0 +1,277 @@
+from __future__ import annotations
+import glob
+import os
+import struct
+from datetime import datetime, timedelta, timezone
+
+from firestore_helpers import matches_filters, path_columns
+from plan import RulePlan, source_fields
+from utils import g_datetime, lazy_import, print_info, print_warn
+
+firestore = lazy_import('google.cloud.firestore')
+
+# Managed exports (`gcloud firestore export`) are LevelDB log files of serialized Datastore EntityProtos.
+# See https://github.com/google/leveldb/blob/main/doc/log_format.md for the record framing.
+BLOCK_SIZE = 32768
+HEADER_SIZE = 7
+RECORD_FULL, RECORD_FIRST, RECORD_MIDDLE, RECORD_LAST = 1, 2, 3, 4
+
+# Property.meaning values used by Firestore exports.
+MEANING_GD_WHEN = 7
+MEANING_GEORSS_POINT = 9
+MEANING_BLOB = 14
+MEANING_BYTESTRING = 16
+MEANING_ENTITY_PROTO = 19
+MEANING_EMPTY_LIST = 24
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Document metadata which exports do not contain: entities carry no timestamps, so these are always None.
+MISSING_METADATA = ('create_time', 'update_time')
+
+
+def iter_log_records(filename):
+  with open(filename, 'rb') as f:
+    fragments = None
+    while True:
+      block = f.read(BLOCK_SIZE)
+      if not block:
+        break
+      pos = 0
+      while pos + HEADER_SIZE <= len(block):
+        length = int.from_bytes(block[pos + 4:pos + 6], 'little')
+        record_type = block[pos + 6]
+        data = block[pos + HEADER_SIZE:pos + HEADER_SIZE + length]
+        pos += HEADER_SIZE + length
+        if record_type == RECORD_FULL:
+          yield data
+        elif record_type == RECORD_FIRST:
+          fragments = [data]
+        elif record_type == RECORD_MIDDLE and fragments is not None:
+          fragments.append(data)
+        elif record_type == RECORD_LAST and fragments is not None:
+          fragments.append(data)
+          yield b''.join(fragments)
+          fragments = None
+        elif record_type == 0 and length == 0:
+          # Zero-filled trailer of a preallocated block.
+          break
+
+
+def read_varint(buf, pos):
+  result = 0
+  shift = 0
+  while True:
+    b = buf[pos]
+    pos += 1
+    result |= (b & 0x7f) << shift
+    if not b & 0x80:
+      return result, pos
+    shift += 7
+
+
+def parse_fields(buf, pos=0, end=None, group=None):
+  # Minimal protobuf wire format parser: returns [(field_number, value), ...] with groups parsed into nested lists.
+  fields = []
+  end = len(buf) if end is None else end
+  while pos < end:
+    key, pos = read_varint(buf, pos)
+    number, wire_type = key >> 3, key & 7
+    if wire_type == 0:
+      value, pos = read_varint(buf, pos)
+    elif wire_type == 1:
+      value = buf[pos:pos + 8]
+      pos += 8
+    elif wire_type == 2:
+      length, pos = read_varint(buf, pos)
+      value = buf[pos:pos + length]
+      pos += length
+    elif wire_type == 3:
+      value, pos = parse_fields(buf, pos, end, number)
+    elif wire_type == 4:
+      if number != group:
+        raise Exception(f'Export: unexpected end of group {number}.')
+      return fields, pos
+    elif wire_type == 5:
+      value = buf[pos:pos + 4]
+      pos += 4
+    else:
+      raise Exception(f'Export: unsupported wire type {wire_type}.')
+    fields.append((number, value))
+  if group is not None:
+    raise Exception(f'Export: unterminated group {group}.')
+  return fields, pos
+
+
+def to_int64(value):
+  return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def decode_path_elements(elements, type_field, id_field, name_field):
+  path = []
+  for number, element in elements:
+    values = dict(element)
+    path.append(values[type_field].decode('utf-8'))
+    if name_field in values:
+      path.append(values[name_field].decode('utf-8'))
+    else:
+      path.append(str(to_int64(values.get(id_field, 0))))
+  return path
+
+
+def decode_reference_path(buf):
+  # Reference { app = 13; path = 14 (Path { repeated group Element = 1 { type = 2; id = 3; name = 4 } }) }
+  for number, value in parse_fields(buf)[0]:
+    if number == 14:
+      elements = [(n, v) for n, v in parse_fields(value)[0] if n == 1]
+      return decode_path_elements(elements, 2, 3, 4)
+  return []
+
+
+def timestamp_from_micros(micros):
+  value = EPOCH + timedelta(microseconds=micros)
+  return g_datetime.DatetimeWithNanoseconds(
+    value.year, value.month, value.day, value.hour, value.minute, value.second, value.microsecond, tzinfo=timezone.utc,
+  )
+
+
+def decode_value(buf, meaning):
+  # PropertyValue { int64Value = 1; booleanValue = 2; stringValue = 3; doubleValue = 4;
+  #   group PointValue = 5 { x = 6; y = 7 }; group ReferenceValue = 12 { group PathElement = 14 { type = 15; id = 16; name = 17 } } }
+  fields = parse_fields(buf)[0]
+  if not fields:
+    return None
+  number, value = fields[0]
+  if number == 1:
+    value = to_int64(value)
+    return timestamp_from_micros(value) if meaning == MEANING_GD_WHEN else value
+  if number == 2:
+    return bool(value)
+  if number == 3:
+    if meaning == MEANING_ENTITY_PROTO:
+      return decode_entity(value)[1]
+    if meaning in (MEANING_BLOB, MEANING_BYTESTRING):
+      return bytes(value)
+    return value.decode('utf-8')
+  if number == 4:
+    return struct.unpack('<d', value)[0]
+  if number == 5:
+    point = dict(value)
+    latitude = struct.unpack('<d', point[6])[0]
+    longitude = struct.unpack('<d', point[7])[0]
+    return firestore.GeoPoint(latitude, longitude)
+  if number == 12:
+    # Document references are returned as their path, since there is no client to bind a DocumentReference to.
+    elements = [(n, v) for n, v in value if n == 14]
+    return '/'.join(decode_path_elements(elements, 15, 16, 17))
+  raise Exception(f'Export: unsupported property value field {number}.')
+
+
+def decode_entity(buf):
+  # EntityProto { key = 13 (Reference); property = 14; raw_property = 15 }
+  # Property { meaning = 1; name = 3; multiple = 4; value = 5 }
+  path = []
+  data = {}
+  for number, value in parse_fields(buf)[0]:
+    if number == 13:
+      path = decode_reference_path(value)
+    elif number in (14, 15):
+      prop = dict(parse_fields(value)[0])
+      name = prop[3].decode('utf-8')
+      meaning = prop.get(1, 0)
+      if meaning == MEANING_EMPTY_LIST:
+        data[name] = []
+      elif prop.get(4, 0):
+        data.setdefault(name, []).append(decode_value(prop.get(5, b''), meaning))
+      else:
+        data[name] = decode_value(prop.get(5, b''), meaning)
+  return path, data
+
+
+def export_files(export_dir):
+  files = sorted(glob.glob(os.path.join(export_dir, '**', 'output-*'), recursive=True))
+  if not files:
+    raise Exception(f'No export files (output-*) found in {export_dir}.')
+  return files
+
+
+def matches_collection(path, collection_name, is_col_group=False):
+  if is_col_group:
+    return len(path) >= 2 and path[-2] == collection_name
+  return len(path) == 2 and path[0] == collection_name
+
+
+def iter_export_documents(export_dir, collection_name, is_col_group=False):
+  # Yields documents of the collection (group) as encapsulate_metadata would, in file order.
+  for filename in export_files(export_dir):
+    for record in iter_log_records(filename):
+      path, data = decode_entity(record)
+      if not matches_collection(path, collection_name, is_col_group):
+        continue
+      data['id'] = path[-1]
+      # Not part of exports (see MISSING_METADATA).
+      data['create_time'] = None
+      data['update_time'] = None
+      data['_path'] = path
+      data.update(path_columns(path))
+      yield data
+
+
+def missing_metadata_columns(plan: RulePlan):
+  # Columns of a rule which read document metadata an export does not have. Row transforms without declared
+  # `fields` may read anything, and are not reported.
+  return [
+    column.name for column in plan.columns
+    if any(path[0] in MISSING_METADATA for path in source_fields(column) or [])
+  ]
+
+
+TYPE_ORDER = { type(None): 0, bool: 1, int: 2, float: 2, datetime: 3, str: 4, bytes: 5 }
+
+
+def order_key(field):
+  # Approximates Firestore's ordering: by value type first, then value, then document path.
+  def key(doc):
+    value = doc[field]
+    rank = TYPE_ORDER.get(type(value), 3 if isinstance(value, datetime) else 6)
+    return (rank, value if rank < 6 else str(value), doc['_path'])
+  return key
+
+
+def fetch_export(export_dir, collection_name, is_col_group=False, order_by=None, limit=None, start_after=None, filters=None):
+  # Returns the documents sorted by fetch_order. Like a Firestore query ordered by a field, documents without that
+  # field are left out. start_after is a document ID or a checkpoint dict (`path`, `order_value`). filters
+  # (source_filters) are applied as the query would apply them, while reading, so that only the documents to
+  # sort are held in memory.
+  print_info(f'Reading {collection_name} from export {export_dir}...')
+  field = order_by[0]
+  docs = []
+  filtered = 0
+  missing = 0
+  for doc in iter_export_documents(export_dir, collection_name, is_col_group):
+    if filters and not matches_filters(doc, filters):
+      filtered += 1
+    elif field not in doc:
+      missing += 1
+    else:
+      docs.append(doc)
+  if filters:
+    print_info(f'Export: {filtered} documents left out by source_filters.')
+  if missing:
+    print_warn(f'Export: leaving out {missing} documents without {field}, as a query ordered by it would.')
+  key = order_key(field)
+  docs.sort(key=key, reverse=order_by[1] == 'DESCENDING')
+  if start_after is not None:
+    if type(start_after) == str:
+      positions = [i for i, doc in enumerate(docs) if doc['id'] == start_after]
+      if not positions:
+        raise Exception(f'Export: document {start_after} not found in {collection_name}.')
+      docs = docs[positions[0] + 1:]
+    else:
+      path = start_after['path'].split('/')
+      cursor = key({ order_by[0]: start_after['order_value'], '_path': path })
+      docs = [doc for doc in docs if (key(doc) < cursor if order_by[1] == 'DESCENDING' else key(doc) > cursor)]
+  if limit is not None:
+    docs = docs[:limit]
+  print_info(f'Read {len(docs)} documents from export.')
+  return docs
@@ -1,18 +1,91 @@
-from time import sleep
-import firebase_admin
-from google.cloud import firestore
+from __future__ import annotations
+import operator
 
-from utils import print_success, print_warn
+from throttling import TokenBucket, call_with_retry
+from utils import lazy_import, print_info, print_success, print_warn
+
+firebase_admin = lazy_import('firebase_admin')
+firestore = lazy_import('google.cloud.firestore')
+
+_clients = {}
+
+# Page reads are retried on transient errors with exponential backoff (see throttling.call_with_retry), and
+# optionally throttled to `reads_per_second` documents by a token bucket shared by all fetching threads.
+fetch_config = {
+  'max_retries': 5,
+  'base_delay': 0.5,
+  'max_delay': 30.0,
+  'limiter': None,
+}
+
+
+def configure_fetching(max_retries=None, reads_per_second=None, base_delay=None, max_delay=None):
+  if max_retries is not None:
+    fetch_config['max_retries'] = max_retries
+  if base_delay is not None:
+    fetch_config['base_delay'] = base_delay
+  if max_delay is not None:
+    fetch_config['max_delay'] = max_delay
+  if reads_per_second is not None:
+    fetch_config['limiter'] = TokenBucket(reads_per_second) if reads_per_second > 0 else None
+    if reads_per_second > 0:
+      print_info(f'Throttling Firestore reads to {reads_per_second} documents per second.')
+
+
+def throttle(reads):
+  # Charges reads to the limiter, or gives them back if negative.
+  limiter = fetch_config['limiter']
+  if limiter is None:
+    return
+  if reads > 0:
+    limiter.acquire(reads)
+  elif reads < 0:
+    limiter.release(-reads)
+
+
+def read_with_retry(query, description, expected_reads=1):
+  # Runs query.get(), retrying transient errors. Reads are reserved before the request (expected_reads, e.g. the
+  # page size) and settled afterwards: any excess is charged, and reads not used by a short page are given back.
+  # A query is billed at least one read, even when it returns nothing.
+  throttle(expected_reads)
+  result = call_with_retry(
+    query.get,
+    description,
+    fetch_config['max_retries'],
+    fetch_config['base_delay'],
+    fetch_config['max_delay'],
+  )
+  if type(result) == list:
+    throttle(max(len(result), 1) - expected_reads)
+  return result
+
+
+def get_db():
+  # The app and client are initialized on first use, so offline modes do not need credentials.
+  if not 'firestore' in _clients:
+    firebase_admin.initialize_app()
+    _clients['firestore'] = firestore.Client()
+  return _clients['firestore']
+
+
+def path_columns(path):
+  # Split the document path once at ingestion so rules can map segments as plain columns
+  # (e.g. '_parent_id', '_path_3') instead of indexing into '_path' for every row.
+  columns = {f'_path_{i}': segment for i, segment in enumerate(path)}
+  columns['_collection'] = path[-2] if len(path) >= 2 else None
+  columns['_parent_collection'] = path[-4] if len(path) >= 4 else None
+  columns['_parent_id'] = path[-3] if len(path) >= 4 else None
+  return columns
 
-app = firebase_admin.initialize_app()
-db = firestore.Client()
 
 def encapsulate_metadata(obj):
   output_dict = obj.to_dict()
   output_dict['id'] = obj.id
   output_dict['create_time'] = obj.create_time
   output_dict['update_time'] = obj.update_time
-  output_dict['_path'] = list(obj._reference._path)
+  path = list(obj._reference._path)
+  output_dict['_path'] = path
+  output_dict.update(path_columns(path))
   return output_dict
 
 
@@ -20,8 +93,63 @@ def to_list(stream):
   return list(map(encapsulate_metadata, stream))
 
 
-def _fetch(collection: firestore.CollectionReference, limit=None, order_by=None, start_after=None):
+def field_mask(fields):
+  # fields are tuples of path segments (see RulePlan.projection); segments are quoted as needed.
+  return [firestore.FieldPath(*path).to_api_repr() for path in fields]
+
+
+def apply_filters(query, filters):
+  # filters are (field, operator, value) tuples (see RulePlan.source_filters).
+  for field, op, value in filters or ():
+    if hasattr(firestore, 'FieldFilter'):
+      query = query.where(filter=firestore.FieldFilter(field, op, value))
+    else:
+      query = query.where(field, op, value)
+  return query
+
+
+def not_null(compare):
+  return lambda a, b: a is not None and compare(a, b)
+
+
+def contains(values, value):
+  return type(values) == list and value in values
+
+
+FILTER_FUNCTIONS = {
+  '<': operator.lt,
+  '<=': operator.le,
+  '==': operator.eq,
+  '!=': not_null(operator.ne),
+  '>=': operator.ge,
+  '>': operator.gt,
+  'array-contains': contains,
+  'array-contains-any': lambda a, b: any(contains(a, v) for v in b),
+  'in': lambda a, b: a in b,
+  'not-in': not_null(lambda a, b: a not in b),
+}
+
+
+def matches_filters(doc: dict, filters):
+  # Client-side version of apply_filters, for documents which were not fetched with a query (exports, listeners).
+  # As in Firestore, a document without the field never matches, and values of different types never compare.
+  for field, op, value in filters or ():
+    if field not in doc:
+      return False
+    try:
+      if not FILTER_FUNCTIONS[op](doc[field], value):
+        return False
+    except TypeError:
+      return False
+  return True
+
+
+def _fetch(collection: firestore.CollectionReference, limit=None, order_by=None, start_after=None, fields=None, filters=None):
   last_doc = None
+  collection = apply_filters(collection, filters)
+  if fields is not None:
+    # Only the projected fields are transferred; cursors still work since fetch_order is always projected.
+    collection = collection.select(field_mask(fields))
   if order_by:
     collection = collection.order_by(order_by[0], direction=order_by[1])
   if start_after:
@@ -30,7 +158,8 @@ def _fetch(collection: firestore.CollectionReference, limit=None, order_by=None,
     collection = collection.start_after(start_after)
   if limit:
     collection = collection.limit(limit)
-  result = collection.get()
+  # Only this page is retried: the cursor (start_after) stays at the last document of the previous good page.
+  result = read_with_retry(collection, 'fetch page', limit or 1)
   last_doc = result[-1] if result else None
   return {
     'result': to_list(result),
@@ -38,37 +167,76 @@ def _fetch(collection: firestore.CollectionReference, limit=None, order_by=None,
   }
 
 
-def fetch_collection(collection_name, limit=None, order_by=None, start_after=None):
-  collection = db.collection(collection_name)
+def fetch_collection(collection_name, limit=None, order_by=None, start_after=None, fields=None, filters=None):
+  collection = get_db().collection(collection_name)
   last_doc = resolve_start_after(collection_name, start_after) if start_after else None
-  return _fetch(collection, limit, order_by, last_doc)
+  return _fetch(collection, limit, order_by, last_doc, fields, filters)
 
 
-def fetch_collection_group(collection_id, limit=None, order_by=None, start_after=None):
-  collection = db.collection_group(collection_id)
+def fetch_collection_group(collection_id, limit=None, order_by=None, start_after=None, fields=None, filters=None):
+  collection = get_db().collection_group(collection_id)
   last_doc = resolve_start_after(collection_id, start_after, True) if start_after else None
-  return _fetch(collection, limit, order_by, last_doc)
+  return _fetch(collection, limit, order_by, last_doc, fields, filters)
 
 
 
+def iter_pages(collection_name, order_by=None, start_after=None, page_size=100, limit=None, is_col_group=False, fields=None, filters=None):
+  # Yields pages of documents, each page continuing after the last document of the previous one.
+  # start_after must already be resolved to a DocumentSnapshot (see resolve_start_after / checkpoint_cursor).
+  collection = get_db().collection_group(collection_name) if is_col_group else get_db().collection(collection_name)
+  last_doc = start_after
+  remaining = limit
+  while remaining is None or remaining > 0:
+    size = page_size if remaining is None else min(page_size, remaining)
+    response = _fetch(collection, size, order_by, last_doc, fields, filters)
+    docs = response['result']
+    if not docs:
+      return
+    yield docs
+    last_doc = response['last_doc']
+    if remaining is not None:
+      remaining -= len(docs)
+    if len(docs) < size:
+      return
+
+
+def listen(collection_name, is_col_group, callback, filters=None):
+  # Attaches a snapshot listener; callback receives (doc_snapshots, changes, read_time). Returns the watch (call .unsubscribe()).
+  collection = get_db().collection_group(collection_name) if is_col_group else get_db().collection(collection_name)
+  return apply_filters(collection, filters).on_snapshot(callback)
+
+
+def checkpoint_cursor(path, order_by=None, order_value=None):
+  # Builds a cursor snapshot from a saved document path and fetch_order value, so resuming does not re-read the document.
+  data = { order_by[0]: order_value } if order_by else {}
+  return firestore.DocumentSnapshot(
+    get_db().document(path),
+    data,
+    exists=True,
+    read_time=None,
+    create_time=None,
+    update_time=None,
+  )
+
+
 def fetch_single(collection_name, doc_id):
-  doc_ref = db.collection(collection_name).document(doc_id)
-  return doc_ref.get().to_dict()
+  doc_ref = get_db().collection(collection_name).document(doc_id)
+  return read_with_retry(doc_ref, 'fetch_single').to_dict()
 
 
 def resolve_start_after(collection_name: str, doc, is_col_group=False):
   if type(doc) == str:
     print(f'start_after: interpreting "{doc}" as document key and retrieving it from {collection_name}...')
     if is_col_group:
-      return db.collection_group(collection_name).document(doc)
+      return get_db().collection_group(collection_name).document(doc)
     else:
-      return db.collection(collection_name).document(doc).get()
+      return read_with_retry(get_db().collection(collection_name).document(doc), 'start_after')
   else:
     print(f"start_after: interpreting input value as a DocumentSnapshot.")
     return doc
 
 
-def fetch_all(collection_name, order_by=None, start_after=None, page_size=100):
+def fetch_all(collection_name, order_by=None, start_after=None, page_size=100, fields=None, filters=None):
   if start_after and not order_by:
     raise Exception('When using start_after, please specify an order_by field.')
   
@@ -76,7 +244,7 @@ def fetch_all(collection_name, order_by=None, start_after=None, page_size=100):
     raise Exception('order_by must be a tuple of (field, direction) where direction is either "ASCENDING" or "DESCENDING".')
 
   last_doc = resolve_start_after(collection_name, start_after) if start_after else None
-  count = get_collection_count(collection_name, order_by, last_doc)
+  count = get_collection_count(collection_name, order_by, last_doc, filters)
   page = 0
   docs = []
 
@@ -87,7 +255,7 @@ def fetch_all(collection_name, order_by=None, start_after=None, page_size=100):
     print(f'fetch_all: Fetch page {page} of size {page_size}...')
     if last_doc:
       print(f'fetch_all: Will start_after "{last_doc.id}".')
-    response = fetch_collection(collection_name, page_size, order_by, last_doc)
+    response = fetch_collection(collection_name, page_size, order_by, last_doc, fields, filters)
     last_doc = response['last_doc']
     docs.extend(response['result'])
     print(f'fetch_all: Fetched {len(response["result"])} documents in page {page}, {len(docs)} so far.')
@@ -100,8 +268,8 @@ def fetch_all(collection_name, order_by=None, start_after=None, page_size=100):
   return docs
 
 
-def get_collection_count(collection_name, order_by=None, start_after=None):
-  collection = db.collection(collection_name)
+def get_collection_count(collection_name, order_by=None, start_after=None, filters=None):
+  collection = apply_filters(get_db().collection(collection_name), filters)
   if order_by:
     collection = collection.order_by(order_by[0], direction=order_by[1])
   if start_after:
@@ -109,4 +277,17 @@ def get_collection_count(collection_name, order_by=None, start_after=None):
     if not order_by:
       raise Exception('When using start_after, please specify an order_by field.')
     collection = collection.start_after(doc)
-  return len(collection.get())
+  return len(read_with_retry(collection, 'count', 1))
+
+
+def count_documents(collection_name, is_col_group=False, filters=None):
+  # Returns (count, reads). Uses an aggregation query where the client supports it (1 read per 1000 documents),
+  # otherwise a key-only query (1 read per document, but no field data is transferred).
+  collection = get_db().collection_group(collection_name) if is_col_group else get_db().collection(collection_name)
+  collection = apply_filters(collection, filters)
+  if hasattr(collection, 'count'):
+    result = read_with_retry(collection.count(), 'count')
+    count = int(result[0][0].value)
+    return count, max(1, -(-count // 1000))
+  count = len(read_with_retry(collection.select([]), 'count', 1))
+  return count, count
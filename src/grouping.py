@@ -0,0 +1,126 @@
+from __future__ import annotations
+import os
+import pickle
+import shutil
+import tempfile
+import weakref
+
+from plan import RulePlan
+from utils import lazy_import, print_info
+
+pandas = lazy_import('pandas')
+
+# Groupers take transformed chunks (ungrouped DataFrames, rows in fetch order) and return DataFrames which only
+# contain complete groups, so that rules with group_by can be loaded chunk by chunk. `pending_rows` is the number
+# of rows added but not returned yet; they are always the last rows added, so checkpoints can be placed before them
+# (rows must not be dropped before they are added, or they would no longer line up with the fetched documents).
+
+
+def group_keys(df, group_by):
+  if len(group_by) == 1:
+    return df[group_by[0]].astype(str).tolist()
+  return df[group_by].astype(str).agg('\x1f'.join, axis='columns').tolist()
+
+
+class StreamingGrouper:
+  # For fetch orders which cluster rows by the group key: all rows of a group arrive one after another,
+  # so when a chunk ends every group except the last one seen is complete.
+
+  def __init__(self, group_by):
+    self.group_by = list(group_by)
+    self.carry = None
+    self.completed = set()
+
+  @property
+  def pending_rows(self):
+    return 0 if self.carry is None else len(self.carry)
+
+  def add(self, df):
+    if self.carry is not None:
+      df = pandas.concat([self.carry, df], ignore_index=True)
+    if df.empty:
+      self.carry = None
+      return []
+    keys = group_keys(df, self.group_by)
+    tail_start = len(keys)
+    while tail_start > 0 and keys[tail_start - 1] == keys[-1]:
+      tail_start -= 1
+    for key in dict.fromkeys(keys[:tail_start]):
+      if key in self.completed:
+        raise Exception(f'Grouping: rows of group {key} are not consecutive in fetch order, so it cannot be streamed.')
+      self.completed.add(key)
+    ready = df.iloc[:tail_start]
+    self.carry = df.iloc[tail_start:]
+    return [ready] if len(ready) else []
+
+  def finish(self):
+    carry = self.carry
+    self.carry = None
+    if carry is not None and len(carry):
+      yield carry
+
+  def close(self):
+    self.carry = None
+
+
+class SpillGrouper:
+  # For any fetch order: rows are hash-partitioned by group key into files on disk as chunks arrive, and once
+  # everything is fetched each partition is read back and returned whole. Every group is inside one partition,
+  # so memory use is bounded by the largest partition (about 1/partitions of the rows) instead of all rows.
+
+  def __init__(self, group_by, partitions=64, spill_dir=None):
+    self.group_by = list(group_by)
+    self.partitions = partitions
+    self.spill_dir = tempfile.mkdtemp(prefix='group-spill-', dir=spill_dir)
+    self.rows = 0
+    # Also removes the spill files if the run fails before finish().
+    self.cleanup = weakref.finalize(self, shutil.rmtree, self.spill_dir, True)
+
+  @property
+  def pending_rows(self):
+    return self.rows
+
+  def partition_path(self, partition):
+    return os.path.join(self.spill_dir, f'partition-{partition}.pickle')
+
+  def add(self, df):
+    if df.empty:
+      return []
+    hashes = pandas.util.hash_pandas_object(df[self.group_by], index=False).to_numpy()
+    for partition, partition_df in df.groupby(hashes % self.partitions, sort=False):
+      with open(self.partition_path(partition), 'ab') as f:
+        pickle.dump(partition_df, f, protocol=pickle.HIGHEST_PROTOCOL)
+    self.rows += len(df)
+    return []
+
+  def finish(self):
+    print_info(f'Grouping: loading {self.rows} spilled rows from {self.partitions} partitions in {self.spill_dir}.')
+    try:
+      for partition in range(self.partitions):
+        path = self.partition_path(partition)
+        if not os.path.exists(path):
+          continue
+        frames = []
+        with open(path, 'rb') as f:
+          while True:
+            try:
+              frames.append(pickle.load(f))
+            except EOFError:
+              break
+        df = pandas.concat(frames, ignore_index=True)
+        self.rows -= len(df)
+        os.remove(path)
+        yield df
+    finally:
+      self.close()
+
+  def close(self):
+    self.cleanup()
+
+
+def make_grouper(plan: RulePlan, partitions=64, spill_dir=None):
+  if plan.groups_follow_fetch_order:
+    print_info(f'Grouping: {list(plan.group_by)} follows fetch_order, streaming groups.')
+    return StreamingGrouper(plan.group_by)
+  print_info(f'Grouping: spilling rows to disk by {list(plan.group_by)} in {partitions} partitions.')
+  return SpillGrouper(plan.group_by, partitions, spill_dir)
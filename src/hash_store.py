@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+from checkpoint import CHECKPOINT_DIR
+from utils import iter_rows
+
+
+def hash_store_path(collection_name):
+  return os.path.join(CHECKPOINT_DIR, f'{collection_name}.hashes.sqlite')
+
+
+def open_hash_store(collection_name):
+  os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+  conn = sqlite3.connect(hash_store_path(collection_name))
+  conn.execute('create table if not exists row_hashes (key text primary key, hash text not null)')
+  return conn
+
+
+def load_hashes(conn) -> dict:
+  return dict(conn.execute('select key, hash from row_hashes'))
+
+
+def save_hashes(conn, hashes: dict):
+  with conn:
+    conn.executemany('insert or replace into row_hashes (key, hash) values (?, ?)', hashes.items())
+
+
+def commit_pending_hashes(conn, hash_state: dict, save=True, failed=()):
+  # Called once the rows behind the pending hashes have been loaded (save=False discards them, e.g. on --dry-run).
+  # The hashes of failed keys (rows or groups which did not load) are discarded, so they are sent again next time.
+  if save:
+    failed = set(failed)
+    loaded = { key: h for key, h in hash_state['pending'].items() if key not in failed }
+    save_hashes(conn, loaded)
+    hash_state['stored'].update(loaded)
+  hash_state['pending'] = {}
+
+
+def content_hash(record) -> str:
+  encoded = json.dumps(record, sort_keys=True, default=str)
+  return hashlib.blake2b(encoded.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def select_changed_rows(df, stored: dict, key_fn, group_key_fn=None):
+  # Returns (changed_df, pending_hashes, upsert_keys). key_fn returns a row's key as a string (or None); rows
+  # without a key are always kept. With group_key_fn, rows are grouped by its key instead, and a group is kept
+  # (whole) if any of its rows changed.
+  pending = {}
+  upsert_keys = set()
+  keep = [False] * len(df)
+
+  def check(key, h, positions):
+    previous = stored.get(key)
+    if previous == h:
+      return
+    pending[key] = h
+    if previous is not None:
+      upsert_keys.add(key)
+    for i in positions:
+      keep[i] = True
+
+  if group_key_fn is not None:
+    rows = list(iter_rows(df))
+    groups = {}
+    for i, row in enumerate(rows):
+      key = group_key_fn(row)
+      if key is None:
+        keep[i] = True
+        continue
+      groups.setdefault(key, []).append(i)
+    for key, group_positions in groups.items():
+      group_hash = content_hash(sorted(content_hash(rows[i]) for i in group_positions))
+      check(key, group_hash, group_positions)
+  else:
+    for i, row in enumerate(iter_rows(df)):
+      key = key_fn(row)
+      if key is None:
+        keep[i] = True
+        continue
+      check(key, content_hash(row), [i])
+
+  return df.loc[keep], pending, upsert_keys
@@ -0,0 +1,73 @@
+from __future__ import annotations
+from time import time
+
+from edgedb_helpers import get_client
+from plan import RulePlan
+from utils import is_null, lazy_import, print_debug, print_info, print_success, print_warn
+
+pandas = lazy_import('pandas')
+
+
+def lookup_query(lookup):
+  query = f'select {lookup["type"]} {{ id, key := <str>.{lookup["key"]} }} filter exists .{lookup["key"]}'
+  if lookup['filter']:
+    query += f' and ({lookup["filter"]})'
+  return query
+
+
+class LookupMaps:
+  # Foreign keys resolved client-side: each of the rule's lookups is fetched from EdgeDB once per run into a
+  # dict of key -> object id, and columns with `lookup` are mapped through it after the transform, so queries
+  # can reference objects by id instead of running a select per row. Rows whose (non-null) value has no match
+  # are skipped before load and counted.
+
+  def __init__(self, plan: RulePlan):
+    self.plan = plan
+    self.maps = {}
+    self.stats = { column.name: { 'resolved': 0, 'missing': 0 } for column in plan.columns if column.lookup }
+
+  def load(self):
+    for name, lookup in self.plan.lookups.items():
+      start = time()
+      index = {}
+      duplicates = 0
+      for row in get_client().query(lookup_query(lookup)):
+        if row.key in index:
+          duplicates += 1
+          continue
+        index[row.key] = str(row.id)
+      self.maps[name] = index
+      print_info(f'Lookup {name}: {len(index)} {lookup["type"]} objects by .{lookup["key"]} in {time() - start:.2f}s.')
+      if duplicates:
+        print_warn(f'Lookup {name}: {duplicates} {lookup["type"]} objects share a .{lookup["key"]} with another one; the first one is used.')
+    return self
+
+  def apply(self, output: pandas.DataFrame):
+    # Returns output with lookup columns replaced by object ids and rows with missing references left out.
+    skip = pandas.Series(False, index=output.index)
+    for column in self.plan.columns:
+      if not column.lookup or column.name not in output:
+        continue
+      index = self.maps[column.lookup]
+      values = output[column.name]
+      ids = values.map(lambda v: None if is_null(v) else index.get(str(v), None))
+      missing = ~values.map(is_null).astype(bool) & ids.isna()
+      stats = self.stats[column.name]
+      stats['missing'] += int(missing.sum())
+      stats['resolved'] += int(ids.notna().sum())
+      for value in values[missing].head(5):
+        print_debug(lambda: f'Lookup {column.lookup}: no object for {column.name} = {value!r}', key=f'lookup_missing:{column.name}')
+      output[column.name] = ids.astype(object)
+      skip |= missing
+    if skip.any():
+      print_warn(f'Lookups: skipping {int(skip.sum())} of {len(output)} rows with missing references.', key='lookup_skip')
+      output = output[~skip]
+    return output
+
+  def summary(self):
+    for name, stats in self.stats.items():
+      message = f'Lookups: {name} resolved for {stats["resolved"]} rows, {stats["missing"]} rows skipped without a match.'
+      if stats['missing']:
+        print_warn(message)
+      else:
+        print_success(message)
@@ -0,0 +1,56 @@
+from __future__ import annotations
+import importlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from math import ceil
+
+from plan import RulePlan, compile_rule
+from utils import LOG_LEVELS, configure_logging, lazy_import, log_config, print_info, transform_source
+
+pandas = lazy_import('pandas')
+
+# Rules may contain lambdas and closures, which cannot be pickled, so workers never receive the plan:
+# each one imports the rules module by name and compiles the rule itself when it starts.
+_worker = {}
+
+
+def init_worker(rules_module, collection, logging):
+  configure_logging(**logging)
+  rules = importlib.import_module(rules_module).rules
+  _worker['plan'] = compile_rule(collection, rules[collection])
+
+
+def transform_shard(shard, no_external):
+  return transform_source(shard, _worker['plan'], None, no_external)
+
+
+class ParallelTransformer:
+  # Runs transform_source over row shards of a chunk in worker processes. The output keeps the source index
+  # and shards are concatenated in order, so rows come out exactly as the serial transform produces them.
+
+  def __init__(self, plan: RulePlan, workers=None, rules_module='firestore', min_shard_rows=500):
+    self.plan = plan
+    self.workers = workers or os.cpu_count()
+    self.min_shard_rows = min_shard_rows
+    level = next(name for name, value in LOG_LEVELS.items() if value == log_config['level'])
+    logging = { 'level': level, 'sample_after': log_config['sample_after'], 'sample_every': log_config['sample_every'] }
+    self.executor = ProcessPoolExecutor(
+      self.workers,
+      initializer=init_worker,
+      initargs=(rules_module, plan.collection, logging),
+    )
+    print_info(f'Transforming with {self.workers} worker processes.')
+
+  def transform(self, source_df: pandas.DataFrame, no_external=False):
+    shards = min(self.workers, ceil(len(source_df) / self.min_shard_rows))
+    if shards <= 1:
+      # Not worth the round trip through the pool.
+      return transform_source(source_df, self.plan, None, no_external)
+    shard_size = ceil(len(source_df) / shards)
+    shard_dfs = [source_df.iloc[i:i + shard_size] for i in range(0, len(source_df), shard_size)]
+    outputs = list(self.executor.map(transform_shard, shard_dfs, repeat(no_external)))
+    return pandas.concat(outputs)
+
+  def close(self):
+    self.executor.shutdown()
@@ -0,0 +1,383 @@
+import re
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Callable
+
+from utils import build_resolver, build_resolver_for_array, external_callables, is_null, print_warn
+
+FETCH_DIRECTIONS = ('ASCENDING', 'DESCENDING')
+
+# Output columns with special meaning to the query builder.
+METADATA_COLUMN = 'metadata'
+
+# Source columns added by firestore_helpers.encapsulate_metadata rather than read from document fields.
+DOCUMENT_METADATA_FIELDS = ('id', 'create_time', 'update_time', '_path', '_collection', '_parent_collection', '_parent_id')
+path_segment_regex = re.compile(r'^_path_\d+$')
+
+# Value of a rule's fetch_fields which turns off field projection.
+ALL_FIELDS = '*'
+
+# Operators of Firestore `where` filters, usable in a rule's source_filters.
+FILTER_OPERATORS = ('<', '<=', '==', '!=', '>=', '>', 'array-contains', 'array-contains-any', 'in', 'not-in')
+LIST_FILTER_OPERATORS = ('array-contains-any', 'in', 'not-in')
+
+
+@dataclass(frozen=True)
+class ColumnPlan:
+  name: str
+  # One of 'field' (copy a source field), 'literal', 'col' (cell transform), 'row' (row transform), 'empty'.
+  kind: str
+  source: object = None
+  literal: object = None
+  transform: Callable = None
+  transform_name: str = None
+  # Column kernels (utils.column_kernel) take and return the whole input Series.
+  is_kernel: bool = False
+  is_external: bool = False
+  resolver: Callable = None
+  resolver_name: str = None
+  is_array: bool = False
+  # A type name, or an object reference cast (see reference_cast).
+  cast: object = None
+  is_metadata: bool = False
+  skip_if_empty: bool = False
+  # Source fields a row transform reads (`fields`), or None if it was not declared.
+  fields: tuple = None
+  # Name of a lookup in RulePlan.lookups which maps the transformed value to an object id.
+  lookup: str = None
+
+
+@dataclass(frozen=True)
+class RulePlan:
+  collection: str
+  is_collection_group: bool
+  fetch_order: tuple
+  columns: tuple
+  group_by: tuple = None
+  table_name: str = None
+  query_suffix: str = ''
+  iterated_query: str = None
+  row_resolver_function: Callable = None
+  row_resolvers: MappingProxyType = field(default_factory=lambda: MappingProxyType({}))
+  type_casts: MappingProxyType = field(default_factory=lambda: MappingProxyType({}))
+  skip_row_if_empty: tuple = ()
+  prerequisites: tuple = ()
+  # Extra source fields to fetch, or ALL_FIELDS.
+  fetch_fields: object = ()
+  # (field, operator, value) filters pushed into the Firestore query.
+  source_filters: tuple = ()
+  # Lookup maps fetched from EdgeDB once per run: name -> { 'type', 'key', 'filter' }.
+  lookups: MappingProxyType = field(default_factory=lambda: MappingProxyType({}))
+
+  @property
+  def column_names(self):
+    return [column.name for column in self.columns]
+
+  def column(self, name):
+    for column in self.columns:
+      if column.name == name:
+        return column
+    raise Exception(f'Rule {self.collection}: no output column "{name}" in mapping. Available columns: {self.column_names}')
+
+  @property
+  def groups_follow_fetch_order(self):
+    # True if documents fetched in fetch_order arrive clustered by the group key, so chunked groups can be streamed.
+    if not self.group_by or len(self.group_by) != 1:
+      return False
+    column = self.column(self.group_by[0])
+    return column.kind == 'field' and column.source == self.fetch_order[0]
+
+  def projection(self, single_column=None):
+    # Source fields (tuples of path segments) read by the mapping, or by a single column, for a field mask.
+    # Returns None if whole documents are needed: a row transform without `fields`, or fetch_fields = '*'.
+    if self.fetch_fields == ALL_FIELDS:
+      return None
+    columns = self.columns if single_column is None else (self.column(single_column),)
+    paths = [(self.fetch_order[0],)] + [(name,) for name in self.fetch_fields]
+    for column in columns:
+      fields = source_fields(column)
+      if fields is None:
+        return None
+      paths.extend(fields)
+    paths = [path for path in dict.fromkeys(paths) if not is_document_metadata(path[0])]
+    # Firestore rejects overlapping paths, and a parent field includes its keys anyway.
+    return tuple(path for path in paths if not (len(path) > 1 and (path[0],) in paths))
+
+  def strategies(self):
+    strategies = []
+    if self.table_name:
+      strategies.append('insert')
+    if self.iterated_query:
+      strategies.append('bulk-insert')
+    if self.row_resolver_function:
+      strategies.append('row-resolvers')
+    return strategies
+
+  def explain(self):
+    lines = [
+      f'Rule {self.collection} ({"collection group" if self.is_collection_group else "collection"}), '
+      f'ordered by {self.fetch_order[0]} {self.fetch_order[1]}',
+      f'Strategies: {", ".join(self.strategies())}',
+    ]
+    if self.table_name:
+      lines.append(f'  insert: insert {self.table_name} {{ ... }} {self.query_suffix}'.rstrip())
+    if self.row_resolver_function:
+      lines.append(f'  row-resolvers: {callable_name(self.row_resolver_function)} -> {list(self.row_resolvers)}')
+    if self.group_by:
+      grouping = 'streamed in fetch order' if self.groups_follow_fetch_order else 'spilled to disk'
+      lines.append(f'Group by: {list(self.group_by)} (with --chunk-size, {grouping})')
+    if self.prerequisites:
+      lines.append(f'Prerequisite queries: {len(self.prerequisites)} per row')
+    for name, lookup in self.lookups.items():
+      lines.append(f'Lookup {name}: {lookup["type"]} ids by .{lookup["key"]}' + (f' filter {lookup["filter"]}' if lookup['filter'] else ''))
+    if self.source_filters:
+      lines.append(f'Source filters: {" and ".join(f"{f} {op} {value!r}" for f, op, value in self.source_filters)}')
+    projection = self.projection()
+    if projection is None:
+      lines.append('Fetch fields: whole documents')
+    else:
+      lines.append(f'Fetch fields: {", ".join(".".join(path) for path in projection)}')
+    lines.append('Columns:')
+    for column in self.columns:
+      lines.append(f'  {column.name} <- {explain_column(column)}')
+    return '\n'.join(lines)
+
+
+def is_document_metadata(name):
+  return name in DOCUMENT_METADATA_FIELDS or bool(path_segment_regex.match(name))
+
+
+def source_fields(column: ColumnPlan):
+  # Document fields a column reads, as tuples of path segments, or None if it may read any field.
+  if column.kind in ('field', 'col'):
+    return [column.source if type(column.source) == tuple else (column.source,)]
+  if column.kind == 'row':
+    return None if column.fields is None else [(name,) for name in column.fields]
+  return []
+
+
+def reference_cast(target_type, id_type='uuid'):
+  # Cast of an object id to a reference to the object, written <target_type><id_type>"...".
+  return (target_type, id_type)
+
+
+def cast_prefix(cast):
+  # The EdgeQL written before a value for a cast: <type>, or <target_type><id_type> for a reference_cast.
+  if type(cast) == tuple:
+    target_type, id_type = cast
+    return f'<{target_type}><{id_type}>'
+  return f'<{cast}>'
+
+
+def callable_name(fn):
+  return getattr(fn, '__name__', repr(fn))
+
+
+def explain_column(column: ColumnPlan):
+  if column.kind == 'empty':
+    return '(empty)'
+  if column.kind == 'literal':
+    output = f'literal {column.literal!r}'
+  elif column.kind == 'row':
+    output = 'row' if column.fields is None else f'row({", ".join(column.fields)})'
+  else:
+    output = '.'.join(column.source) if type(column.source) == tuple else column.source
+  if column.transform:
+    output += f' | {column.transform_name}{" (column kernel)" if column.is_kernel else ""}'
+  if column.is_external:
+    output += ' (external, skipped with --no-external)'
+  if column.lookup:
+    output += f' | lookup {column.lookup} (rows without a match are skipped)'
+  if column.resolver:
+    output += f' | resolve{"[]" if column.is_array else ""} {column.resolver_name}'
+  if column.cast:
+    output += f' [cast {cast_prefix(column.cast)}]'
+  if column.is_metadata:
+    output += ' [skips rows flagged deleted/testing/failed prereq]'
+  if column.skip_if_empty:
+    output += ' [skip row if empty]'
+  return output
+
+
+def compile_source(collection, name, source):
+  if type(source) == str:
+    return source
+  if type(source) == list and len(source) == 2 and all(type(s) == str for s in source):
+    return tuple(source)
+  raise Exception(f'Rule {collection}: column "{name}" source must be a field name or a [field, key] list, got {source!r}.')
+
+
+def compile_field_names(collection, option, names):
+  if not (type(names) in (list, tuple) and all(type(name) == str for name in names)):
+    raise Exception(f'Rule {collection}: {option} must be a list of field names, got {names!r}.')
+  return tuple(names)
+
+
+def compile_source_filters(collection, fetch_order, filters):
+  compiled = []
+  for source_filter in filters:
+    if not (type(source_filter) in (list, tuple) and len(source_filter) == 3 and type(source_filter[0]) == str):
+      raise Exception(f'Rule {collection}: each of source_filters must be a (field, operator, value) tuple, got {source_filter!r}.')
+    field_name, op, value = source_filter
+    if op not in FILTER_OPERATORS:
+      raise Exception(f'Rule {collection}: unknown operator {op!r} in source_filters. Available operators: {list(FILTER_OPERATORS)}')
+    if op in LIST_FILTER_OPERATORS and type(value) not in (list, tuple):
+      raise Exception(f'Rule {collection}: source filter on {field_name} with {op!r} needs a list of values.')
+    if is_document_metadata(field_name):
+      raise Exception(f'Rule {collection}: source filter on {field_name}, which is not a document field.')
+    if op in LIST_FILTER_OPERATORS:
+      value = list(value)
+    compiled.append((field_name, op, value))
+  inequalities = sorted(set(f for f, op, _ in compiled if op in ('<', '<=', '!=', '>=', '>', 'not-in') and f != fetch_order[0]))
+  if inequalities:
+    print_warn(f'Rule {collection}: inequality source filters on {inequalities} (not the fetch_order field) may be rejected by Firestore or need a composite index; prefer == or in.')
+  return tuple(compiled)
+
+
+def compile_lookups(collection, lookups):
+  if type(lookups) != dict:
+    raise Exception(f'Rule {collection}: lookups must be a dict of name -> {{ "type", "key" }}.')
+  compiled = {}
+  for name, lookup in lookups.items():
+    if not (type(lookup) == dict and type(lookup.get('type', None)) == str and type(lookup.get('key', None)) == str):
+      raise Exception(f'Rule {collection}: lookup {name} must be a dict with the object `type` and the `key` property to index it by.')
+    if type(lookup.get('filter', '')) != str:
+      raise Exception(f'Rule {collection}: the filter of lookup {name} must be an EdgeQL expression string.')
+    compiled[name] = MappingProxyType({ 'type': lookup['type'], 'key': lookup['key'], 'filter': lookup.get('filter', None) })
+  return compiled
+
+
+def compile_column(collection, name, input_source, type_casts, skip_row_if_empty, lookups={}):
+  column = {
+    'name': name,
+    'cast': type_casts.get(name, None),
+    'is_metadata': name == METADATA_COLUMN,
+    'skip_if_empty': name in skip_row_if_empty,
+  }
+  if is_null(input_source):
+    print_warn(f'Rule {collection}: destination column "{name}" is null/empty in source mapping.')
+    return ColumnPlan(kind='empty', **column)
+  if type(input_source) == str:
+    return ColumnPlan(kind='field', source=input_source, **column)
+  if type(input_source) != dict:
+    raise Exception(f'Rule {collection}: unrecognized input source for column "{name}": {input_source!r}')
+
+  if 'transform' in input_source:
+    transform = input_source['transform']
+    if not callable(transform):
+      raise Exception(f'Rule {collection}: transform for column "{name}" is not callable.')
+    column['transform'] = transform
+    column['transform_name'] = callable_name(transform)
+    column['is_external'] = column['transform_name'] in external_callables
+    column['is_kernel'] = getattr(transform, 'is_column_kernel', False)
+
+  if 'literal' in input_source:
+    kind = 'literal'
+    column['literal'] = input_source['literal']
+  elif 'col' in input_source:
+    kind = 'col'
+    column['source'] = compile_source(collection, name, input_source['col'])
+  elif 'row' in input_source:
+    kind = 'row'
+    if not 'transform' in column:
+      raise Exception(f'Rule {collection}: a transform function must be specified when using `row` (column "{name}").')
+    if column['is_kernel']:
+      raise Exception(f'Rule {collection}: column kernel {column["transform_name"]} can only be used with `col` (column "{name}").')
+    if 'fields' in input_source:
+      column['fields'] = compile_field_names(collection, f'`fields` of column "{name}"', input_source['fields'])
+  else:
+    raise Exception(f'Rule {collection}: unrecognized input source for column "{name}": {input_source!r}')
+
+  if 'resolve' in input_source:
+    resolver_info = input_source['resolve']
+    if not (type(resolver_info) == list and len(resolver_info) == 2):
+      raise Exception(f'Rule {collection}: resolver for column "{name}" should be a list of length 2 with the first element being a callable and the second element being a dict of resolutions.')
+    if not callable(resolver_info[0]):
+      raise Exception(f'Rule {collection}: the resolver function at index 0 must be callable (column "{name}").')
+    if not type(resolver_info[1]) == dict:
+      raise Exception(f'Rule {collection}: resolutions must be a dict in order to map return values of the resolver function to strings (column "{name}").')
+    column['is_array'] = input_source.get('type', None) == 'array'
+    column['resolver'] = build_resolver_for_array(name, resolver_info) if column['is_array'] else build_resolver(name, resolver_info)
+    column['resolver_name'] = callable_name(resolver_info[0])
+
+  if 'lookup' in input_source:
+    if input_source['lookup'] not in lookups:
+      raise Exception(f'Rule {collection}: column "{name}" uses lookup {input_source["lookup"]!r}, which is not in lookups: {list(lookups)}')
+    if 'resolve' in input_source:
+      raise Exception(f'Rule {collection}: column "{name}" cannot use both `lookup` and `resolve`.')
+    column['lookup'] = input_source['lookup']
+    if column['cast'] is None:
+      column['cast'] = reference_cast(lookups[column['lookup']]['type'])
+
+  return ColumnPlan(kind=kind, **column)
+
+
+def compile_rule(collection, rule: dict) -> RulePlan:
+  # Validates a rule from firestore.py once, up front, and resolves everything the hot loops need.
+  if type(rule) != dict:
+    raise Exception(f'Rule {collection}: must be a dict.')
+  fetch_order = rule.get('fetch_order', None)
+  if not (type(fetch_order) == tuple and len(fetch_order) == 2 and fetch_order[1] in FETCH_DIRECTIONS):
+    raise Exception(f'Rule {collection}: fetch_order must be a tuple of (field, direction) where direction is either "ASCENDING" or "DESCENDING".')
+  mapping = rule.get('mapping', None)
+  if type(mapping) != dict or not mapping:
+    raise Exception(f'Rule {collection}: mapping must be a non-empty dict.')
+
+  type_casts = rule.get('edgedb_type_casts', {})
+  skip_row_if_empty = rule.get('skip_row_if_empty', [])
+  group_by = rule.get('group_by', None)
+  for option, names in (('skip_row_if_empty', skip_row_if_empty), ('group_by', group_by or [])):
+    unknown = [name for name in names if name not in mapping]
+    if unknown:
+      raise Exception(f'Rule {collection}: {option} refers to columns not in mapping: {unknown}')
+  unused_casts = [name for name in type_casts if name not in mapping]
+  if unused_casts:
+    print_warn(f'Rule {collection}: edgedb_type_casts for columns not in mapping will be ignored: {unused_casts}')
+
+  row_resolver_function = rule.get('row_resolver_function', None)
+  row_resolvers = rule.get('edgedb_row_resolvers', {})
+  if row_resolver_function is not None and not callable(row_resolver_function):
+    raise Exception(f'Rule {collection}: row_resolver_function must be callable.')
+  if type(row_resolvers) != dict:
+    raise Exception(f'Rule {collection}: edgedb_row_resolvers must be a dict.')
+
+  prerequisites = rule.get('edgedb_prereq_queries', [])
+  for prerequisite in prerequisites:
+    if not (type(prerequisite) == dict and 'query' in prerequisite and type(prerequisite.get('vars', None)) == dict):
+      raise Exception(f'Rule {collection}: each of edgedb_prereq_queries must be a dict with `query` and `vars`.')
+
+  fetch_fields = rule.get('fetch_fields', ())
+  if fetch_fields != ALL_FIELDS:
+    fetch_fields = compile_field_names(collection, f'fetch_fields (or "{ALL_FIELDS}")', fetch_fields)
+
+  source_filters = rule.get('source_filters', [])
+  if type(source_filters) not in (list, tuple):
+    raise Exception(f'Rule {collection}: source_filters must be a list of (field, operator, value) tuples.')
+
+  lookups = compile_lookups(collection, rule.get('lookups', {}))
+  columns = tuple(
+    compile_column(collection, name, input_source, type_casts, skip_row_if_empty, lookups)
+    for name, input_source in mapping.items()
+  )
+
+  plan = RulePlan(
+    collection=collection,
+    is_collection_group=rule.get('is_collection_group', False),
+    fetch_order=fetch_order,
+    columns=columns,
+    group_by=tuple(group_by) if group_by else None,
+    table_name=rule.get('edgedb_table_name', None),
+    query_suffix=rule.get('edgedb_query_suffix', ''),
+    iterated_query=rule.get('edgedb_iterated_query', None),
+    row_resolver_function=row_resolver_function,
+    row_resolvers=MappingProxyType(dict(row_resolvers)),
+    type_casts=MappingProxyType({ **type_casts, **{ column.name: column.cast for column in columns if column.lookup } }),
+    skip_row_if_empty=tuple(skip_row_if_empty),
+    prerequisites=tuple(prerequisites),
+    fetch_fields=fetch_fields,
+    source_filters=compile_source_filters(collection, fetch_order, source_filters),
+    lookups=MappingProxyType(lookups),
+  )
+  if not plan.strategies():
+    raise Exception(f'Rule {collection}: one of edgedb_table_name, edgedb_iterated_query or row_resolver_function is required.')
+  return plan
@@ -0,0 +1,161 @@
+import threading
+from time import monotonic
+
+from firestore_helpers import encapsulate_metadata
+from plan import RulePlan
+from utils import print_err, print_info, safe_get_key
+
+
+class Replicator:
+  # Buffers documents from snapshot listener callbacks and passes them to `flush_fn` in micro-batches of at most
+  # `flush_size` documents, once `flush_size` documents are buffered or the oldest buffered change is
+  # `flush_interval` seconds old. Only the latest version of each document is kept while buffered. Removed
+  # documents are counted but not loaded.
+  # Listener callbacks run on the Firestore watch thread, so they only buffer and signal; flush_fn always runs on
+  # the thread calling follow(), which owns the load backend and hash store.
+  # With group_fn (rules with group_by, see document_group_fn), the current documents of every group are kept and
+  # the buffer holds the keys of changed groups instead: a change reloads its whole group, and micro-batches are
+  # made of whole groups (a group larger than flush_size is sent on its own).
+
+  def __init__(self, flush_fn, flush_size=500, flush_interval=5.0, group_fn=None):
+    self.flush_fn = flush_fn
+    self.flush_size = flush_size
+    self.flush_interval = flush_interval
+    self.group_fn = group_fn
+    self.groups = {}
+    self.document_groups = {}
+    self.buffer = {}
+    self.oldest = None
+    self.stats = { 'changes': 0, 'removed': 0, 'flushes': 0, 'documents': 0 }
+    self.error = None
+    self.buffer_lock = threading.Lock()
+    self.wakeup = threading.Event()
+
+  def on_snapshot(self, doc_snapshots, changes, read_time):
+    with self.buffer_lock:
+      for change in changes:
+        self.stats['changes'] += 1
+        if change.type.name == 'REMOVED':
+          self.stats['removed'] += 1
+          if self.group_fn is not None:
+            # Not reloaded by itself, but left out when its group is next reloaded.
+            self.remove_from_group('/'.join(change.document._reference._path))
+          continue
+        doc = encapsulate_metadata(change.document)
+        path = '/'.join(doc['_path'])
+        if self.group_fn is None:
+          self.buffer[path] = doc
+        else:
+          self.buffer[self.add_to_group(path, doc)] = None
+      if self.buffer and self.oldest is None:
+        self.oldest = monotonic()
+      if self.buffered_documents() >= self.flush_size:
+        self.wakeup.set()
+
+  def add_to_group(self, path, doc):
+    # Returns the key of the document's group. A document which moved to another group changes both.
+    key = self.group_fn(doc)
+    previous = self.document_groups.get(path, key)
+    if previous != key:
+      self.remove_from_group(path)
+      self.buffer[previous] = None
+    self.groups.setdefault(key, {})[path] = doc
+    self.document_groups[path] = key
+    return key
+
+  def remove_from_group(self, path):
+    key = self.document_groups.pop(path, None)
+    if key is not None:
+      self.groups[key].pop(path, None)
+      if not self.groups[key]:
+        del self.groups[key]
+
+  def buffered_documents(self):
+    # Number of documents the buffered changes will load (called with buffer_lock held).
+    if self.group_fn is None:
+      return len(self.buffer)
+    return sum(len(self.groups.get(key, ())) for key in self.buffer)
+
+  def take(self):
+    # Pops the next micro-batch: (buffer entries, documents). Called with buffer_lock held.
+    if self.group_fn is None:
+      entries = [(path, self.buffer.pop(path)) for path in list(self.buffer)[:self.flush_size]]
+      return entries, [doc for _, doc in entries]
+    entries = []
+    docs = []
+    while self.buffer and len(docs) < self.flush_size:
+      key = next(iter(self.buffer))
+      entries.append((key, self.buffer.pop(key)))
+      docs += self.groups.get(key, {}).values()
+    return entries, docs
+
+  def due(self):
+    with self.buffer_lock:
+      if self.buffered_documents() >= self.flush_size:
+        return True
+      return self.oldest is not None and monotonic() - self.oldest >= self.flush_interval
+
+  def flush(self):
+    # Flushes one micro-batch (the documents, or groups, buffered first) and returns whether it was loaded.
+    with self.buffer_lock:
+      entries, docs = self.take()
+      if not self.buffer:
+        self.oldest = None
+    if not docs:
+      return True
+    try:
+      self.flush_fn(docs)
+    except Exception as e:
+      # Put the batch back (unless a newer version arrived meanwhile) so it is retried on the next flush.
+      with self.buffer_lock:
+        for key, value in entries:
+          self.buffer.setdefault(key, value)
+        self.oldest = monotonic()
+      self.error = e
+      print_err(f'follow: flush of {len(docs)} documents failed: {e}')
+      return False
+    self.error = None
+    self.stats['flushes'] += 1
+    self.stats['documents'] += len(docs)
+    print_info(f'follow: flushed {len(docs)} documents ({self.stats["documents"]} total).')
+    return True
+
+  def flush_due(self):
+    # Flushes micro-batches while a trigger holds; a failed flush waits for the next poll.
+    while self.due():
+      if not self.flush():
+        return
+
+  def follow(self, listen_fn, collection_name, is_col_group=False, stop_event: threading.Event = None, poll_interval=0.2):
+    # Attaches the listener and flushes on the size and time triggers until stop_event is set (or
+    # KeyboardInterrupt), then flushes what is left.
+    stop_event = stop_event or threading.Event()
+    watch = listen_fn(collection_name, is_col_group, self.on_snapshot)
+    print_info(f'follow: listening for changes to {collection_name}...')
+    try:
+      while not stop_event.is_set():
+        self.wakeup.wait(poll_interval)
+        self.wakeup.clear()
+        self.flush_due()
+    except KeyboardInterrupt:
+      print_info('follow: stopping...')
+    finally:
+      watch.unsubscribe()
+      while self.buffer and self.flush():
+        pass
+    return self.stats
+
+
+def document_group_fn(plan: RulePlan):
+  # Returns a function computing the group of a source document for --follow, from the fields the group_by
+  # columns copy. Columns computed by a transform are not supported, as their group is only known once transformed.
+  sources = []
+  for name in plan.group_by:
+    column = next(column for column in plan.columns if column.name == name)
+    if column.kind not in ('field', 'col') or column.transform is not None or column.resolver is not None:
+      raise Exception(f'--follow: group_by column "{name}" of {plan.collection} must copy a source field (optionally through a lookup), not be computed by a transform.')
+    sources.append(column.source)
+
+  def group_fn(doc):
+    return tuple(str(doc.get(source) if type(source) == str else safe_get_key(doc.get(source[0]), source[1])) for source in sources)
+  return group_fn
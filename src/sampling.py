@@ -0,0 +1,104 @@
+from __future__ import annotations
+import random
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+
+from firestore_helpers import apply_filters, checkpoint_cursor, field_mask, get_db, read_with_retry, to_list
+from utils import print_info, print_warn
+
+# Random samples are drawn with key-range probes: each probe starts at a random document key and reads the next
+# few documents in key order, so a sample of N costs about N reads however large the collection is. Random keys
+# follow the shape of the keys at both ends of the collection (per character position, the range of characters
+# seen there), which covers auto-IDs as well as e.g. phone numbers. Documents after large gaps in the key space
+# are somewhat more likely to be picked, so the sample is close to, but not exactly, uniform.
+SEED_DOCUMENTS = 20
+
+
+def base_query(collection_name, is_col_group=False, filters=None):
+  collection = get_db().collection_group(collection_name) if is_col_group else get_db().collection(collection_name)
+  return apply_filters(collection, filters)
+
+
+def seed_paths(query, seeds=SEED_DOCUMENTS):
+  # Paths of the first and last documents by key, reading only their keys.
+  paths = []
+  for direction in ('ASCENDING', 'DESCENDING'):
+    docs = read_with_retry(query.select([]).order_by('__name__', direction=direction).limit(seeds), 'sample seeds', seeds)
+    paths.extend(list(doc.reference._path) for doc in docs)
+  return paths
+
+
+class KeySpace:
+  # Generates random document paths shaped like the seed paths. Path segments which are the same for all seeds
+  # (collection IDs, or the parent of a plain collection) are kept; the others are random strings whose n-th
+  # character lies between the lowest and highest n-th character among the seeds.
+
+  def __init__(self, paths):
+    depth = Counter(len(path) for path in paths).most_common(1)[0][0]
+    paths = [path for path in paths if len(path) == depth]
+    self.segments = []
+    for i in range(depth):
+      values = [path[i] for path in paths]
+      if len(set(values)) == 1:
+        self.segments.append(values[0])
+        continue
+      alphabet = sorted(set(''.join(values)))
+      length = max(len(value) for value in values)
+      positions = []
+      for n in range(length):
+        chars = [value[n] for value in values if len(value) > n]
+        positions.append([c for c in alphabet if min(chars) <= c <= max(chars)])
+      self.segments.append(positions)
+
+  def random_path(self, rng: random.Random):
+    return '/'.join(
+      segment if type(segment) == str else ''.join(rng.choice(chars) for chars in segment)
+      for segment in self.segments
+    )
+
+
+def probe(query, path, size):
+  # Reads up to `size` documents starting at the key `path`.
+  cursor = checkpoint_cursor(path)
+  return to_list(read_with_retry(query.order_by('__name__').start_at(cursor).limit(size), 'sample probe', size))
+
+
+def sample_documents(collection_name, is_col_group=False, size=100, fields=None, filters=None, docs_per_probe=10, threads=8, rng: random.Random = None):
+  rng = rng or random.Random()
+  query = base_query(collection_name, is_col_group, filters)
+  if fields is not None:
+    query = query.select(field_mask(fields))
+  seeds = seed_paths(base_query(collection_name, is_col_group, filters))
+  if len(seeds) < 2 * SEED_DOCUMENTS:
+    # Fewer documents than seeds: the collection is small enough to read whole.
+    docs = to_list(read_with_retry(query, 'sample', len(seeds)))
+    print_info(f'--sample: {collection_name} only has {len(docs)} documents, using all of them.')
+    return rng.sample(docs, min(size, len(docs)))
+
+  key_space = KeySpace(seeds)
+  docs_per_probe = max(1, min(docs_per_probe, size))
+  sampled = {}
+  probes = 0
+  # Probes past the last key come back empty, so allow some more than the minimum.
+  max_probes = 3 * ceil(size / docs_per_probe) + threads
+  with ThreadPoolExecutor(threads) as executor:
+    while len(sampled) < size and probes < max_probes:
+      count = min(threads, max_probes - probes, ceil((size - len(sampled)) / docs_per_probe))
+      paths = [key_space.random_path(rng) for _ in range(count)]
+      for docs in executor.map(lambda path: probe(query, path, docs_per_probe), paths):
+        for doc in docs:
+          sampled.setdefault('/'.join(doc['_path']), doc)
+      probes += count
+  docs = list(sampled.values())
+  if len(docs) < size:
+    print_warn(f'--sample: found {len(docs)} of {size} documents after {probes} probes.')
+  print_info(f'--sample: {min(size, len(docs))} documents from {probes} random key-range probes of {collection_name}.')
+  return rng.sample(docs, min(size, len(docs)))
+
+
+def sample_list(docs, size, rng: random.Random = None):
+  # For documents already in memory (exports).
+  rng = rng or random.Random()
+  print_info(f'--sample: {min(size, len(docs))} of {len(docs)} documents.')
+  return rng.sample(docs, min(size, len(docs)))
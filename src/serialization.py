@@ -0,0 +1,72 @@
+from __future__ import annotations
+import json
+from datetime import datetime
+
+from utils import datetime_to_rfc3339
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+# Encodes load payloads (rows, groups, query variables) as JSON. Datetimes of any flavour (DatetimeWithNanoseconds,
+# pandas.Timestamp, datetime) become RFC 3339 strings, NaN/NaT/None become null and numpy values plain numbers
+# or lists. Uses orjson when it is installed, and the standard library otherwise; both produce compact output.
+
+
+def datetime_to_json(value):
+  if type(value) == datetime:
+    return value.isoformat()
+  try:
+    return datetime_to_rfc3339(value)
+  except Exception:
+    return value.isoformat()
+
+
+def default(value):
+  if isinstance(value, datetime):
+    return datetime_to_json(value)
+  if type(value).__module__ == 'numpy':
+    return normalize(value.tolist())
+  raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def normalize(value):
+  # The standard library writes NaN, which is not valid JSON, and cannot be hooked for floats.
+  if type(value) == dict:
+    return {k: normalize(v) for k, v in value.items()}
+  if type(value) == list or type(value) == tuple:
+    return [normalize(v) for v in value]
+  if isinstance(value, float) and value != value:
+    return None
+  return value
+
+
+if orjson is not None:
+  ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+  def dumpb(value) -> bytes:
+    return orjson.dumps(value, default=default, option=ORJSON_OPTIONS)
+
+  def dumps(value) -> str:
+    return orjson.dumps(value, default=default, option=ORJSON_OPTIONS).decode('utf-8')
+else:
+  encoder = json.JSONEncoder(default=default, separators=(',', ':'), ensure_ascii=False)
+
+  def dumps(value) -> str:
+    return encoder.encode(normalize(value))
+
+  def dumpb(value) -> bytes:
+    return encoder.encode(normalize(value)).encode('utf-8')
+
+
+def encode_records(records):
+  # Lazily encodes each record separately, e.g. to batch them by size before joining with join_records,
+  # so only the records of the batch being built are held encoded.
+  for record in records:
+    yield dumps(record)
+
+
+def join_records(encoded) -> str:
+  return '[' + ','.join(encoded) + ']'
+
@@ -0,0 +1,74 @@
+from __future__ import annotations
+import random
+from threading import Lock
+from time import monotonic, sleep
+
+from utils import lazy_import, print_warn
+
+api_exceptions = lazy_import('google.api_core.exceptions')
+
+# Errors worth retrying: timeouts, unavailability and quota (RESOURCE_EXHAUSTED) are transient on Firestore's side.
+TRANSIENT_ERRORS = (
+  'DeadlineExceeded',
+  'ServiceUnavailable',
+  'ResourceExhausted',
+  'TooManyRequests',
+  'InternalServerError',
+  'Aborted',
+  'GatewayTimeout',
+)
+
+
+def is_transient(error):
+  return isinstance(error, tuple(getattr(api_exceptions, name) for name in TRANSIENT_ERRORS))
+
+
+class TokenBucket:
+  # Limits a rate (e.g. document reads per second) across threads. Up to `rate` tokens can be spent at once
+  # after an idle period; acquire(n) reserves n tokens, going into debt if needed, and sleeps until the debt is
+  # paid back, so callers asking for more than the capacity (a page of 500 at 100/s) still go through, just later.
+
+  def __init__(self, rate, capacity=None):
+    self.rate = float(rate)
+    self.capacity = float(capacity or rate)
+    self.tokens = self.capacity
+    self.updated = monotonic()
+    self.lock = Lock()
+    self.waited = 0.0
+
+  def acquire(self, n=1):
+    with self.lock:
+      now = monotonic()
+      self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      self.tokens -= n
+      wait = -self.tokens / self.rate if self.tokens < 0 else 0
+      self.waited += wait
+    if wait > 0:
+      sleep(wait)
+
+  def release(self, n):
+    # Gives back tokens reserved by acquire() but not spent (e.g. the rest of a short page).
+    with self.lock:
+      self.tokens = min(self.capacity, self.tokens + n)
+
+
+def backoff_delay(attempt, base_delay=0.5, max_delay=30.0):
+  # Exponential backoff with full jitter: uniform in [0, min(max_delay, base_delay * 2^attempt)].
+  return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def call_with_retry(fn, description, max_retries=5, base_delay=0.5, max_delay=30.0):
+  # Calls fn() until it succeeds, retrying transient errors up to max_retries times. fn must be safe to repeat,
+  # e.g. a single page query whose cursor is only advanced by the caller once the page has been returned.
+  attempt = 0
+  while True:
+    try:
+      return fn()
+    except Exception as e:
+      if attempt >= max_retries or not is_transient(e):
+        raise
+      delay = backoff_delay(attempt, base_delay, max_delay)
+      print_warn(f'{description}: {type(e).__name__} ({e}), retry {attempt + 1} of {max_retries} in {delay:.1f}s.', key='fetch_retry')
+      sleep(delay)
+      attempt += 1
@@ -1,14 +1,33 @@
-import json
+from __future__ import annotations
+import importlib
 from math import isnan
 import re
-import numpy
-import pandas
-from google.api_core import datetime_helpers as g_datetime
-from proto import datetime_helpers as p_datetime
-from google.protobuf.timestamp_pb2 import Timestamp as p2_Timestamp
+import sys
+from types import ModuleType
 from colorama import Fore, Style
 
 
+class LazyModule(ModuleType):
+  # Stands in for a module until one of its attributes is first used, then copies the module's namespace
+  # so later attribute lookups are plain dict hits. Keeps pandas/numpy/google imports off the startup path.
+  def __getattr__(self, attr):
+    module = importlib.import_module(self.__name__)
+    self.__dict__.update(module.__dict__)
+    return getattr(module, attr)
+
+
+def lazy_import(name):
+  return sys.modules.get(name) or LazyModule(name)
+
+
+numpy = lazy_import('numpy')
+pandas = lazy_import('pandas')
+g_datetime = lazy_import('google.api_core.datetime_helpers')
+p_datetime = lazy_import('proto.datetime_helpers')
+serialization = lazy_import('serialization')
+timestamp_pb2 = lazy_import('google.protobuf.timestamp_pb2')
+
+
 LIST_MIN_VALID = 0
 LIST_MAX_VALID = 1024
 
@@ -30,6 +49,13 @@ def row_to_csv(row):
   return ','.join(row_string)
 
 
+def iter_rows(df):
+  # Yields each row as a dict without materializing a Series per row (as DataFrame.apply does).
+  columns = list(df.columns)
+  for values in df.itertuples(index=False, name=None):
+    yield dict(zip(columns, values))
+
+
 def to_list_of_dicts(df):
   l = df.to_dict('records')
   output = []
@@ -41,30 +67,138 @@ def to_list_of_dicts(df):
   return output
 
 
-def print_err(msg):
-  print(Fore.RED + msg + Style.RESET_ALL)
+LOG_LEVELS = {
+  'debug': 10,
+  'info': 20,
+  'success': 20,
+  'warn': 30,
+  'err': 40,
+}
+
+LOG_COLORS = {
+  'debug': Style.DIM,
+  'info': Fore.CYAN,
+  'success': Fore.GREEN,
+  'warn': Fore.YELLOW,
+  'err': Fore.RED,
+}
+
+# Messages passed with a `key` are rate limited per key: the first `sample_after` are written,
+# then only every `sample_every`-th one (0 suppresses the rest). Counts are reported by print_log_summary.
+# A message can also be a callable returning it, which is only called if the message is written, so per-row
+# messages which are expensive to build (e.g. dumping a row) cost nothing when filtered out.
+log_config = {
+  'level': LOG_LEVELS['info'],
+  'sample_after': 10,
+  'sample_every': 0,
+  'stream': None,
+  'color': None,
+}
+log_counts = {}
+
+
+def configure_logging(level=None, sample_after=None, sample_every=None, stream=None):
+  if level is not None:
+    if level not in LOG_LEVELS:
+      raise Exception(f'Log level must be one of {list(LOG_LEVELS)}, got "{level}".')
+    log_config['level'] = LOG_LEVELS[level]
+  if sample_after is not None:
+    log_config['sample_after'] = sample_after
+  if sample_every is not None:
+    log_config['sample_every'] = sample_every
+  if stream is not None:
+    log_config['stream'] = stream
+    log_config['color'] = None
+
+
+def log_enabled(level):
+  return LOG_LEVELS[level] >= log_config['level']
+
+
+def _log_sink():
+  stream = log_config['stream'] or sys.stdout
+  if log_config['color'] is None:
+    # Only colorize (and flush per line) when writing to a terminal; otherwise the stream's own buffering applies.
+    log_config['color'] = hasattr(stream, 'isatty') and stream.isatty()
+  return stream
+
+
+def log(level, msg, key=None):
+  if key is not None:
+    counts = log_counts.get(key)
+    if counts is None:
+      counts = log_counts[key] = { 'level': level, 'total': 0, 'written': 0 }
+    counts['total'] += 1
+    if not log_enabled(level):
+      return
+    n = counts['total']
+    sample_every = log_config['sample_every']
+    if n > log_config['sample_after'] and not (sample_every > 0 and n % sample_every == 0):
+      return
+    counts['written'] += 1
+  elif not log_enabled(level):
+    return
+
+  if callable(msg):
+    msg = msg()
+  stream = _log_sink()
+  if log_config['color']:
+    stream.write(LOG_COLORS[level] + msg + Style.RESET_ALL + '\n')
+    stream.flush()
+  else:
+    stream.write(msg + '\n')
+
+
+def print_log_summary():
+  suppressed = {key: c for key, c in log_counts.items() if c['total'] > c['written']}
+  if suppressed:
+    print_info('Log summary (rate-limited messages):')
+    for key, counts in suppressed.items():
+      print_info(f"  {key} ({counts['level']}): {counts['total']} messages, {counts['total'] - counts['written']} suppressed")
+  _log_sink().flush()
+
+
+def print_err(msg, key=None):
+  log('err', msg, key)
+
+
+def print_warn(msg, key=None):
+  log('warn', msg, key)
+
 
+def print_info(msg, key=None):
+  log('info', msg, key)
 
-def print_warn(msg):
-  print(Fore.YELLOW + msg + Style.RESET_ALL)
 
+def print_success(msg, key=None):
+  log('success', msg, key)
 
-def print_info(msg):
-  print(Fore.CYAN + msg + Style.RESET_ALL)
 
+def print_debug(msg, key=None):
+  log('debug', msg, key)
 
-def print_success(msg):
-  print(Fore.GREEN + msg + Style.RESET_ALL)
+
+def column_kernel(fn):
+  # Marks a transform as a column kernel: transform_source calls it once with the whole input Series
+  # (and uses the Series it returns) instead of calling it for every cell.
+  fn.is_column_kernel = True
+  return fn
+
+
+def kernel_output(values, output):
+  # Infers the dtype (and null representation) from the values, as Series.apply does for per-cell results.
+  return pandas.Series(output.tolist(), index=values.index, name=values.name)
 
 
 # Transform function generator that returns first regex group match.
 def regex_matcher(regex, default_none=False):
   if (not regex):
     raise Exception('Regex supplied to generator missing or invalid')
+  pattern = re.compile(regex)
   def built_function(haystack=''):
     if (type(haystack) != str):
       return None
-    match = re.search(regex, haystack)
+    match = pattern.search(haystack)
     if match:
       return match.groups()[0]
     else:
@@ -72,24 +206,26 @@ def regex_matcher(regex, default_none=False):
   return built_function
 
 
-def has_callable_transform(input_source):
-  return 'transform' in input_source and callable(input_source['transform'])
-
-
-def has_callable_resolver(input_source):
-  if not ('resolve' in input_source):
-    return False
-  resolver_info = input_source['resolve']
-  if not (type(resolver_info) == list and len(resolver_info) == 2):
-    print('Resolver should be a list of length 2 with the first element being a callable and the second element being a dict of resolutions.')
-    return False
-  if not callable(resolver_info[0]):
-    print('The resolver function at index 0 must be callable.')
-    return False
-  if not type(resolver_info[1]) == dict:
-    print('Resolutions must be a dict in order to map return values of the resolver function to strings.') 
-    return False
-  return True
+# Column kernel version of regex_matcher, with the same output.
+def regex_extractor(regex, default_none=False):
+  if (not regex):
+    raise Exception('Regex supplied to generator missing or invalid')
+  pattern = re.compile(regex)
+  @column_kernel
+  def built_function(values):
+    output = pandas.Series(None, index=values.index, dtype=object)
+    is_str = values.map(type) == str
+    haystacks = values[is_str]
+    if haystacks.empty:
+      return kernel_output(values, output)
+    matches = haystacks.map(pattern.search)
+    matched = matches.notna()
+    output[matched[matched].index] = matches[matched].map(lambda match: match.groups()[0])
+    if not default_none:
+      output[matched[~matched].index] = haystacks[~matched]
+    return kernel_output(values, output)
+  built_function.__name__ = f'regex_extractor({regex!r})'
+  return built_function
 
 
 def build_resolver(field, resolver_info):
@@ -113,16 +249,7 @@ def build_resolver(field, resolver_info):
 
 
 def jsonify(entries: list) -> str:
-  source = entries
-  output = []
-  for entry in source:
-    entry_resolved = entry
-    if type(entry) == dict:
-      for key, value in entry.items():
-        if is_datetimewithnano(value):
-          entry_resolved[key] = datetime_to_rfc3339(value)
-    output.append(entry_resolved)
-  return json.dumps(output)
+  return serialization.dumps(entries)
 
 
 def build_resolver_for_array(field_name, resolver_info):
@@ -135,7 +262,7 @@ def build_resolver_for_array(field_name, resolver_info):
     if len(values) <= LIST_MIN_VALID:
       return None
     if len(values) > LIST_MAX_VALID:
-      print_warn(f'Will not build `{field_name}` subquery (len {len(values)} exceeds list size bounds)')
+      print_warn(lambda: f'Will not build `{field_name}` subquery (len {len(values)} exceeds list size bounds)', key=f'resolver_bounds:{field_name}')
       return None
     source_values = []
     query = ':= assert_distinct({'
@@ -146,7 +273,7 @@ def build_resolver_for_array(field_name, resolver_info):
       resolution_key = resolve(entry)
       if is_null(resolution_key):
         entry_id = entry.get('id', '<missing id>')
-        print_err(f'Null resolution key for entry i={i} {entry_id} (resolving {field_name}).')
+        print_err(lambda: f'Null resolution key for entry i={i} {entry_id} (resolving {field_name}).', key=f'resolver_null_key:{field_name}')
         source_values.append(None)
         continue
       if resolution_key in resolutions:
@@ -156,7 +283,7 @@ def build_resolver_for_array(field_name, resolver_info):
         raise Exception(f'Resolution key `{resolution_key}` not in dict, value: `{entry}`')
     query += '})'
     if all(is_null(v) for v in source_values):
-      print_info(f'All null values for `{field_name}` subquery, skipping')
+      print_debug(lambda: f'All null values for `{field_name}` subquery, skipping', key=f'resolver_all_null:{field_name}')
       return None
     return {
       '__sourceValues': source_values,
@@ -186,7 +313,7 @@ def get_or_unnest_col(df, path):
       return df[path]
     else:
       raise Exception(f'Column `{path}` not found in dataframe. Available columns: {list(df.columns)}')
-  elif type(path) == list and len(path) == 2:
+  elif type(path) in (list, tuple) and len(path) == 2:
     return df[path[0]].apply(lambda v: safe_get_key(v, path[1]))
   else:
     raise Exception('Path for value access on df must be string or list of length 2.')
@@ -208,58 +335,41 @@ external_callables = ['get_time_zone', 'get_location']
 
 def transform_source(
   source_df: pandas.DataFrame,
-  source_mapping: dict,
+  plan,
   group_by: list,
   no_external: bool = False,
   single_column: str = None,
 ) -> pandas.DataFrame:
+  # plan is a compiled RulePlan (see plan.py); all validation has already happened there.
   output_df = pandas.DataFrame()
 
-  def transform_col(col: str):
+  def transform_col(column):
+    col = column.name
     append_col_to_df(output_df, col)
-    input_source = source_mapping[col]
-    if is_null(input_source):
-      print_warn(f'Destination column "{col}" is null/empty in source mapping.')
+    if column.kind == 'empty':
       return
-    if type(input_source) == str:
-      output_df[col] = get_or_unnest_col(source_df, input_source)
-    elif 'literal' in input_source:
-      output_df[col] = input_source['literal']
-    elif 'col' in input_source:
-      input_col = get_or_unnest_col(source_df, input_source['col'])
-      input_col_transformed = input_col
-      if has_callable_transform(input_source):
-        transform = input_source['transform']
-        name = transform.__name__
-        if not (name in external_callables and no_external):
-          input_col_transformed = input_col.apply(transform)
-      output_df[col] = input_col_transformed
-    elif 'row' in input_source:
-      transform = input_source.get('transform', None)
-      if has_callable_transform(input_source):
-        name = transform.__name__
-        if name in external_callables and no_external:
-          print_info(f'Skipping transform {name} because it calls an external service and --no-external was specified.')
-          return
-        output_df[col] = source_df.apply(transform, axis='columns')[col]
-      else:
-        raise Exception('A transform function must be specified when using `row`.')
-    else:
-      print_err('Unrecognized input source: {}'.format(input_source))
-    if has_callable_resolver(input_source):
-      resolver_info = input_source['resolve']
-      resolver = None
-      if 'type' in input_source and input_source['type'] == 'array':
-        resolver = build_resolver_for_array(col, resolver_info)
-      else:
-        resolver = build_resolver(col, resolver_info)
-      output_df[col] = output_df[col].apply(resolver)
+    if column.kind == 'field':
+      output_df[col] = get_or_unnest_col(source_df, column.source)
+    elif column.kind == 'literal':
+      output_df[col] = column.literal
+    elif column.kind == 'col':
+      input_col = get_or_unnest_col(source_df, column.source)
+      if column.transform and not (column.is_external and no_external):
+        input_col = column.transform(input_col) if column.is_kernel else input_col.apply(column.transform)
+      output_df[col] = input_col
+    elif column.kind == 'row':
+      if column.is_external and no_external:
+        print_info(f'Skipping transform {column.transform_name} because it calls an external service and --no-external was specified.')
+        return
+      output_df[col] = source_df.apply(column.transform, axis='columns')[col]
+    if column.resolver:
+      output_df[col] = output_df[col].apply(column.resolver)
 
   if is_null(single_column):
-    for col in source_mapping:
-      transform_col(col)
+    for column in plan.columns:
+      transform_col(column)
   else:
-    transform_col(single_column)
+    transform_col(plan.column(single_column))
 
   if not is_null(group_by):
     output_df = output_df.groupby(group_by)
@@ -291,7 +401,7 @@ def fix_phone_number(value: str):
   if is_null(value) or is_phone_number(value):
     return value
   else:
-    print_warn(f'fix_phone_number: will attempt to fix "{value}"')
+    print_warn(lambda: f'fix_phone_number: will attempt to fix "{value}"', key='fix_phone_number')
     value = value.strip()
     if not value.startswith('+'):
       value = '+' + value
@@ -302,8 +412,41 @@ def fix_phone_number(value: str):
       raise ValueError(f'fix_phone_number: "{value}" is not a valid phone number')
 
 
+@column_kernel
+def fix_phone_number_column(values):
+  # Column kernel version of fix_phone_number. Instead of failing on the first invalid number,
+  # it raises one ValueError listing every value which could not be fixed.
+  output = values.astype(object).copy()
+  present = values.map(lambda v: not is_null(v))
+  invalid = values[present & (values.map(type) != str)]
+  numbers = values[present & (values.map(type) == str)]
+  to_fix = numbers[~numbers.str.match(phone_regex)]
+  if len(to_fix):
+    print_warn(f'fix_phone_number: will attempt to fix {len(to_fix)} values, e.g. "{to_fix.iloc[0]}"', key='fix_phone_number')
+    fixed = to_fix.str.strip()
+    fixed = fixed.where(fixed.str.startswith('+'), '+' + fixed)
+    fixed = fixed.str.replace(phone_noncompliant_chars, '', regex=True)
+    is_valid = fixed.str.match(phone_regex)
+    invalid = pandas.concat([invalid, fixed[~is_valid]])
+    output[fixed.index] = fixed
+  if len(invalid):
+    examples = ', '.join(f'"{v}"' for v in invalid.iloc[:20])
+    raise ValueError(f'fix_phone_number: {len(invalid)} values are not valid phone numbers: {examples}{", ..." if len(invalid) > 20 else ""}')
+  return kernel_output(values, output)
+
+
 def is_null(expr):
-  return type(expr) != list and (pandas.isnull(expr) or expr == '')
+  # Common scalar types are answered without calling into pandas (which also avoids importing it in offline modes).
+  expr_type = type(expr)
+  if expr_type == str:
+    return expr == ''
+  if expr is None:
+    return True
+  if expr_type == float:
+    return expr != expr
+  if expr_type in (list, dict, bool, int):
+    return False
+  return bool(pandas.isnull(expr) or expr == '')
 
 
 def fix_zulu_offset(value):
@@ -313,11 +456,21 @@ def fix_zulu_offset(value):
     return value
 
 
+def fix_zulu_offset_column(values):
+  return values.str.replace(zulu_regex, '+00:00', regex=True)
+
+
 def fix_int(floating_int):
   value = numpy.nan_to_num(floating_int)
   return int(value)
 
 
+@column_kernel
+def fix_int_column(values):
+  # Column kernel version of fix_int (None in an object column counts as NaN here, where fix_int raises).
+  return pandas.Series(numpy.nan_to_num(values.to_numpy(dtype='float64')).astype('int64'), index=values.index, name=values.name)
+
+
 def has_dict_values(dictlike):
   if is_null(dictlike) or type(dictlike) != dict:
     return False
@@ -338,7 +491,7 @@ def datetime_to_rfc3339(value):
     return fix_zulu_offset(g_datetime.to_rfc3339(value))
   elif type(value) == p_datetime.DatetimeWithNanoseconds:
     return fix_zulu_offset(value.rfc3339())
-  elif type(value) == p2_Timestamp:
+  elif type(value) == timestamp_pb2.Timestamp:
     return fix_zulu_offset(value.ToJsonString())
   elif type(value) == pandas.Timestamp:
     return fix_zulu_offset(value.isoformat(timespec='microseconds'))
@@ -354,3 +507,48 @@ def datetime_to_rfc3339(value):
   else:
     raise Exception(f'Value "{value}" is not a supported type ({type(value)})')
 
+
+@column_kernel
+def datetime_to_rfc3339_column(values):
+  # Column kernel version of datetime_to_rfc3339: dispatches on each value type once per column
+  # and formats datetime64 columns without touching individual Timestamps.
+  if pandas.api.types.is_datetime64_any_dtype(values):
+    if values.dt.tz is None:
+      # Naive values lose their fraction to fix_zulu_offset in the per-value version.
+      output = pandas.Series(numpy.datetime_as_string(values.to_numpy(dtype='datetime64[s]'), unit='s'), index=values.index) + '+00:00'
+    else:
+      wall_time = values.dt.tz_localize(None).to_numpy(dtype='datetime64[us]')
+      utc_time = values.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy(dtype='datetime64[us]')
+      with numpy.errstate(invalid='ignore'):
+        # NaT offsets become NaN, and are nulled below.
+        offsets = pandas.Series((wall_time - utc_time) // numpy.timedelta64(1, 'm'), index=values.index)
+      offset_strings = {
+        minutes: f'{"-" if minutes < 0 else "+"}{abs(int(minutes)) // 60:02d}:{abs(int(minutes)) % 60:02d}'
+        for minutes in offsets.dropna().unique()
+      }
+      output = pandas.Series(numpy.datetime_as_string(wall_time, unit='us'), index=values.index) + offsets.map(offset_strings)
+    return kernel_output(values, output.astype(object).where(values.notna(), None))
+
+  output = pandas.Series(None, index=values.index, dtype=object)
+  types = values.map(type)
+  for value_type in types.unique():
+    mask = types == value_type
+    subset = values[mask]
+    if value_type == str:
+      subset = subset[subset != '']
+    elif value_type == g_datetime.DatetimeWithNanoseconds:
+      subset = subset.map(g_datetime.to_rfc3339)
+    elif value_type == p_datetime.DatetimeWithNanoseconds:
+      subset = subset.map(lambda v: v.rfc3339())
+    elif value_type == timestamp_pb2.Timestamp:
+      subset = subset.map(lambda v: v.ToJsonString())
+    elif value_type == pandas.Timestamp:
+      subset = subset.map(lambda v: v.isoformat(timespec='microseconds'))
+    else:
+      # Nulls, dicts and unsupported types take the per-value path.
+      output[mask] = subset.map(datetime_to_rfc3339)
+      continue
+    if len(subset):
+      output[subset.index] = fix_zulu_offset_column(subset)
+  return kernel_output(values, output)
+
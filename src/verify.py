@@ -0,0 +1,155 @@
+from __future__ import annotations
+import hashlib
+import json
+from math import ceil
+
+from backends import KEY_COLUMNS, LoadBackend, loaded_rows
+from edgedb_helpers import get_client
+from plan import RulePlan
+from utils import is_null, lazy_import, print_info, print_success, print_warn
+
+pandas = lazy_import('pandas')
+
+# Compares transformed rows with what is stored in EdgeDB, chunk by chunk: for each chunk of keys, a single query
+# returns the stored values ordered by key, and a SHA-256 digest of them is compared with the digest of the
+# transformed rows. EdgeQL has no digest function, so both digests are computed client-side, from values brought
+# to the same form by `canonical` (e.g. datetimes as UTC timestamps, whatever their offset or precision). Rows
+# of chunks whose digests differ are then compared one by one.
+
+DATETIME_CASTS = ('datetime', 'cal::local_datetime', 'cal::local_date')
+INT_CASTS = ('int16', 'int32', 'int64', 'bigint')
+FLOAT_CASTS = ('float32', 'float64')
+
+
+def plain_value(value):
+  if hasattr(value, 'item') and not isinstance(value, str):
+    # numpy scalars
+    return value.item()
+  return value
+
+
+def is_set(value):
+  # Whether the query builder sets the property for a value (it leaves out nulls and empty dicts).
+  return not is_null(value) and not (type(value) == dict and not value)
+
+
+def canonical(value, cast):
+  # The form a value is compared in, the same for a transformed value and its stored JSON (None if not set).
+  value = plain_value(value)
+  if not is_set(value):
+    return None
+  if type(cast) == str and cast.startswith('std::'):
+    cast = cast[len('std::'):]
+  if cast in DATETIME_CASTS:
+    try:
+      timestamp = pandas.Timestamp(value)
+    except (TypeError, ValueError):
+      return str(value)
+    if cast == 'cal::local_date':
+      return timestamp.date().isoformat()
+    if timestamp.tzinfo is not None:
+      timestamp = timestamp.tz_convert('UTC')
+    return timestamp.isoformat()
+  if cast in INT_CASTS and type(value) in (float, str):
+    try:
+      value = int(value)
+    except ValueError:
+      pass
+  if cast in FLOAT_CASTS and type(value) in (int, float, str):
+    value = float(value)
+    return f'{value:.6g}' if cast == 'float32' else repr(value)
+  return json.dumps(value, sort_keys=True, default=str)
+
+
+def chunk_query(table, key, casts: dict):
+  fields = [f'key := .{key}'] + [f'c{i} := .{name}' for i, name in enumerate(casts)]
+  return f'select {table} {{ {", ".join(fields)} }} filter .{key} in array_unpack(<array<str>>$keys) order by .{key}'
+
+
+def local_values(key, row, casts: dict):
+  return [key] + [canonical(row[name], cast) for name, cast in casts.items()]
+
+
+def stored_values(obj, casts: dict):
+  return [obj['key']] + [canonical(obj[f'c{i}'], cast) for i, cast in enumerate(casts.values())]
+
+
+def digest(values):
+  # values: the rows of a chunk (lists of canonical values), ordered by key.
+  sha = hashlib.sha256()
+  for row_values in values:
+    sha.update(json.dumps(row_values).encode('utf-8') + b'\n')
+  return sha.hexdigest()
+
+
+class Verifier(LoadBackend):
+  # Used in place of a load backend by --verify: "loading" a chunk compares it with the database.
+  # Only rules with edgedb_table_name and a firebase_uid/firebase_id column can be verified.
+  name = 'verify'
+  # Rows failing prerequisites were skipped by the load, so they are skipped here too.
+  runs_prerequisites = True
+
+  def __init__(self, chunk_size=1000):
+    self.chunk_size = chunk_size
+    self.stats = { 'processed': 0, 'skipped': 0, 'rows': 0, 'chunks': 0, 'mismatched_chunks': 0, 'missing': 0, 'different': 0 }
+
+  def load(self, plan: RulePlan, output, dry_run=False, append=False, upsert_ids: set = None):
+    if not plan.table_name:
+      raise Exception(f'--verify: rule {plan.collection} has no edgedb_table_name; only rules inserting one object per row can be verified.')
+    columns, rows = loaded_rows(plan, output, self.stats)
+    key = next((column for column in KEY_COLUMNS if column in columns), None)
+    if key is None:
+      raise Exception(f'--verify: rule {plan.collection} needs a {" or ".join(KEY_COLUMNS)} column to match rows with objects.')
+    # Resolver and lookup columns are links, which are not compared.
+    compared = [
+      column.name for column in plan.columns
+      if column.name in columns and column.name != key and not column.resolver and not column.lookup
+    ]
+    # Rows with the same key were inserted once (the first one) thanks to `unless conflict`.
+    by_key = {}
+    for row in rows:
+      if not is_null(row[key]):
+        by_key.setdefault(str(row[key]), row)
+    keys = sorted(by_key)
+    casts = { name: plan.type_casts.get(name, None) for name in compared }
+    query = chunk_query(plan.table_name, key, casts)
+    for start in range(0, len(keys), self.chunk_size):
+      chunk_keys = keys[start:start + self.chunk_size]
+      expected = [local_values(k, by_key[k], casts) for k in chunk_keys]
+      # Sorted here too, as the database may collate keys differently.
+      actual = sorted((stored_values(obj, casts) for obj in json.loads(get_client().query_json(query, keys=chunk_keys))), key=lambda values: values[0])
+      self.stats['chunks'] += 1
+      self.stats['rows'] += len(chunk_keys)
+      if digest(actual) != digest(expected):
+        self.stats['mismatched_chunks'] += 1
+        print_warn(f'--verify: chunk {chunk_keys[0]}..{chunk_keys[-1]} differs ({len(expected)} rows expected, {len(actual)} found), comparing rows.', key='verify_chunk')
+        self.compare_rows(plan, key, casts, expected, actual)
+    print_info(f'--verify: compared {len(keys)} rows of {plan.table_name} in {ceil(len(keys) / self.chunk_size)} chunks.')
+
+  def compare_rows(self, plan: RulePlan, key, casts: dict, expected: list, actual: list):
+    stored = { values[0]: values for values in actual }
+    for values in expected:
+      k = values[0]
+      stored_row = stored.get(k, None)
+      if stored_row is None:
+        self.stats['missing'] += 1
+        print_warn(lambda: f'--verify: {plan.table_name} with {key} = {k} is missing.', key='verify_missing')
+        continue
+      differences = [
+        f'{name}: expected {values[i]!r}, found {stored_row[i]!r}'
+        for i, name in enumerate(casts, 1) if values[i] != stored_row[i]
+      ]
+      if differences:
+        self.stats['different'] += 1
+        print_warn(lambda: f'--verify: {plan.table_name} {k} differs: {"; ".join(differences)}', key='verify_different')
+
+  def close(self):
+    stats = self.stats
+    message = (
+      f'--verify: {stats["rows"]} rows in {stats["chunks"]} chunks ({stats["skipped"]} skipped rows not expected), '
+      f'{stats["mismatched_chunks"]} chunks differ: {stats["missing"]} rows missing, {stats["different"]} rows different.'
+    )
+    if stats['mismatched_chunks']:
+      print_warn(message)
+    else:
+      print_success(message)
@@ -0,0 +1,109 @@
+import io
+
+from advisor import advise_indexes, check_keys, query_keys, rule_keys
+from plan import compile_rule
+from utils import log_config
+
+RULE = {
+  'fetch_order': ('created_at', 'ASCENDING'),
+  'mapping': {
+    'firebase_id': 'id',
+    'phone_number': 'phone',
+    'host': 'host_uid',
+  },
+  'edgedb_table_name': 'Event',
+  'edgedb_query_suffix': ' unless conflict on .firebase_id',
+  'edgedb_row_resolvers': {
+    'host': '(select User filter .firebase_uid = <str>$host limit 1)',
+    'guest': '(insert Person { phone_number := <str>$phone_number } unless conflict on .phone_number else (select Person))',
+    'person': '(select Person { name } filter .phone_number = <str>$phone_number)',
+    'self': '(select Event filter .id = <uuid>$id)',
+  },
+}
+
+# The result of INTROSPECTION_QUERY for the rule's types: Event.firebase_id and User.firebase_uid are exclusive
+# (on the property, and as a type constraint), Person.phone_number has neither an index nor a constraint.
+INTROSPECTION = [
+  {
+    'name': 'default::Event',
+    'properties': [{'name': 'id', 'constraints': [{'name': 'std::exclusive'}]}, {'name': 'firebase_id', 'constraints': [{'name': 'std::exclusive'}]}],
+    'constraints': [],
+    'indexes': [],
+  },
+  {
+    'name': 'default::User',
+    'properties': [{'name': 'firebase_uid', 'constraints': []}],
+    'constraints': [{'name': 'std::exclusive', 'subjectexpr': '(.firebase_uid)'}],
+    'indexes': [],
+  },
+  {
+    'name': 'default::Person',
+    'properties': [{'name': 'phone_number', 'constraints': []}, {'name': 'name', 'constraints': []}],
+    'constraints': [],
+    'indexes': [],
+  },
+]
+
+
+def findings_by_key(findings):
+  return {(f['type'], f['property'], f['usage']): f for f in findings}
+
+
+def test_query_keys_extracts_filters_and_conflicts():
+  query = '(insert Person { phone_number := <str>$p, owner := (select User { id } filter .firebase_uid = <str>$u) } unless conflict on .phone_number else (select Person))'
+  assert sorted(query_keys(query)) == [
+    ('Person', 'phone_number', 'conflict'),
+    ('User', 'firebase_uid', 'filter'),
+  ]
+
+
+def test_rule_keys_counts_keys_and_skips_implicit_ones():
+  plan = compile_rule('events', RULE)
+  assert rule_keys(plan, RULE) == {
+    ('User', 'firebase_uid', 'filter'): 1,
+    ('Person', 'phone_number', 'conflict'): 1,
+    ('Person', 'phone_number', 'filter'): 1,
+    ('Event', 'firebase_id', 'conflict'): 1,
+  }
+
+
+def test_check_keys_reports_missing_and_present_indexes():
+  plan = compile_rule('events', RULE)
+  findings = findings_by_key(check_keys(rule_keys(plan, RULE), INTROSPECTION))
+
+  assert findings[('Event', 'firebase_id', 'conflict')]['status'] == 'ok'
+  assert findings[('User', 'firebase_uid', 'filter')]['status'] == 'ok'
+
+  missing = findings[('Person', 'phone_number', 'filter')]
+  assert missing['status'] == 'missing index'
+  assert missing['fix'] == 'alter type Person { create index on (.phone_number); };'
+  conflict = findings[('Person', 'phone_number', 'conflict')]
+  assert conflict['status'] == 'missing exclusive constraint'
+  assert conflict['fix'] == 'alter type Person { alter property phone_number { create constraint exclusive; } };'
+
+
+def test_check_keys_accepts_an_index_and_flags_unknown_names():
+  keys = {('Person', 'phone_number', 'filter'): 2, ('Person', 'email', 'filter'): 1, ('Guest', 'uid', 'filter'): 1}
+  introspection = [{**INTROSPECTION[2], 'indexes': [{'expr': '.phone_number'}]}]
+  findings = findings_by_key(check_keys(keys, introspection))
+  assert findings[('Person', 'phone_number', 'filter')]['status'] == 'ok'
+  assert findings[('Person', 'phone_number', 'filter')]['count'] == 2
+  assert findings[('Person', 'email', 'filter')]['status'] == 'unknown property'
+  assert findings[('Guest', 'uid', 'filter')]['status'] == 'unknown type'
+
+
+def test_advise_indexes_reports_problems(monkeypatch):
+  stream = io.StringIO()
+  monkeypatch.setitem(log_config, 'stream', stream)
+  monkeypatch.setitem(log_config, 'color', False)
+  plan = compile_rule('events', RULE)
+  problems = advise_indexes(plan, RULE, INTROSPECTION)
+
+  assert sorted((p['type'], p['property'], p['status']) for p in problems) == [
+    ('Person', 'phone_number', 'missing exclusive constraint'),
+    ('Person', 'phone_number', 'missing index'),
+  ]
+  report = stream.getvalue()
+  assert 'Person.phone_number (filter, 1x): missing index\n  alter type Person { create index on (.phone_number); };' in report
+  assert 'User.firebase_uid (filter, 1x): ok' in report
+  assert 'Rule events: 2 of 4 lookup properties need attention.' in report
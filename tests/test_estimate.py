@@ -0,0 +1,70 @@
+from time import sleep
+
+import pandas
+
+import benchmark
+from estimate import extrapolate, format_estimate, measure_load, measure_sample
+from plan import compile_rule
+
+RULE = {
+  'fetch_order': ('createdAt', 'ASCENDING'),
+  'mapping': { 'firebase_uid': 'id', 'name': 'name' },
+  'edgedb_iterated_query': 'for user in json_array_unpack(<json>$data) union (insert User { name := <str>user["name"] })',
+}
+
+
+class FakeTransaction:
+  # Takes 50ms per query, and records whether it was rolled back.
+
+  def __init__(self, client):
+    self.client = client
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, error_type, error, traceback):
+    self.client.rolled_back.append(error_type is benchmark.Rollback)
+
+  def query(self, query, **variables):
+    self.client.queries += 1
+    sleep(0.05)
+
+
+class FakeClient:
+
+  def __init__(self):
+    self.queries = 0
+    self.rolled_back = []
+
+  def transaction(self):
+    yield FakeTransaction(self)
+
+
+def test_load_time_is_projected_from_queries_run_on_the_sample(monkeypatch):
+  client = FakeClient()
+  monkeypatch.setattr(benchmark, 'get_client', lambda: client)
+  plan = compile_rule('users', RULE)
+  docs = [{ 'id': f'u{i}', 'name': f'n{i}' } for i in range(10)]
+
+  sample, output = measure_sample(plan, docs, fetch_seconds=0.5)
+  measure_load(plan, sample, output)
+  # The sample is sent as a single bulk request.
+  assert client.queries == 1 and client.rolled_back == [True]
+  assert sample['load_seconds']['bulk-insert'] >= 0.05
+
+  estimate = extrapolate(plan, sample, total=1000, count_reads=1, round_trip=0.0001)
+  bulk = estimate['strategies']['bulk-insert']
+  assert bulk['measured']
+  # 100 times the sample: at least 100 x 50ms of loading, where one round trip would only account for 0.1ms.
+  assert bulk['seconds'] >= 50 + 5
+  assert 'measured on the sample' in format_estimate(estimate)
+
+
+def test_unmeasured_strategies_are_lower_bounds():
+  plan = compile_rule('users', RULE)
+  sample, _ = measure_sample(plan, [{ 'id': 'u1', 'name': 'n1' }], fetch_seconds=0.1)
+  estimate = extrapolate(plan, sample, total=100, count_reads=1, round_trip=0.01)
+  bulk = estimate['strategies']['bulk-insert']
+  assert not bulk['measured']
+  assert bulk['seconds'] >= 0.01
+  assert 'at least' in format_estimate(estimate)
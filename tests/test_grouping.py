@@ -0,0 +1,56 @@
+import pandas
+
+from cli import load_chunk, load_output
+from grouping import StreamingGrouper
+from lookups import LookupMaps
+from plan import compile_rule
+
+RULE = {
+  'fetch_order': ('event_id', 'ASCENDING'),
+  'mapping': {
+    'firebase_id': 'id',
+    'event': 'event_id',
+    'person': { 'col': 'phone', 'lookup': 'person' },
+  },
+  'group_by': ['event'],
+  'lookups': { 'person': { 'type': 'Person', 'key': 'phone_number' } },
+  'edgedb_table_name': 'Payment',
+}
+
+
+class RecordingBackend:
+  runs_prerequisites = False
+
+  def __init__(self):
+    self.loaded = []
+
+  def load(self, plan, output, dry_run=False, append=False, upsert_ids=None):
+    self.loaded += list(output.obj['firebase_id'])
+    return []
+
+
+def test_rows_skipped_by_lookups_stay_in_held_back_groups():
+  plan = compile_rule('payments', RULE)
+  lookups = LookupMaps(plan)
+  lookups.maps = { 'person': { '+100': 'uuid-a', '+200': 'uuid-b' } }
+  grouper = StreamingGrouper(plan.group_by)
+  backend = RecordingBackend()
+  timings = { 'transform': 0, 'query': 0 }
+  # The last group continues in the next chunk, and its second document refers to a person which does not exist.
+  docs = pandas.DataFrame([
+    { 'id': 'a', 'event_id': 'e1', 'phone': '+100' },
+    { 'id': 'b', 'event_id': 'e2', 'phone': '+200' },
+    { 'id': 'c', 'event_id': 'e2', 'phone': '+999' },
+  ])
+
+  failed = load_chunk(plan, docs, timings, backend, grouper=grouper, lookups=lookups)
+
+  assert failed == []
+  assert backend.loaded == ['a']
+  # Both documents of the held-back group are pending, so the checkpoint goes after 'a', not after 'b'.
+  assert grouper.pending_rows == 2
+
+  for ready in grouper.finish():
+    load_output(plan, ready, timings, backend, lookups=lookups)
+  assert backend.loaded == ['a', 'b']
+  assert lookups.stats['person'] == { 'resolved': 2, 'missing': 1 }
@@ -0,0 +1,151 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from plan import compile_rule
+from replication import Replicator, document_group_fn
+
+
+def fake_document(doc_id, **data):
+  return SimpleNamespace(
+    id=doc_id,
+    create_time=None,
+    update_time=None,
+    _reference=SimpleNamespace(_path=('users', doc_id)),
+    to_dict=lambda: dict(data),
+  )
+
+
+def change(doc_id, kind='ADDED', **data):
+  return SimpleNamespace(type=SimpleNamespace(name=kind), document=fake_document(doc_id, **data))
+
+
+class FakeListener:
+  # Stands in for Query.on_snapshot: delivers each snapshot's changes from a background thread, as the
+  # Firestore watch does.
+
+  def __init__(self, snapshots):
+    self.snapshots = snapshots
+    self.unsubscribed = False
+    self.delivered = threading.Event()
+
+  def listen(self, collection_name, is_col_group, callback):
+    def deliver():
+      for changes in self.snapshots:
+        callback(None, changes, None)
+      self.delivered.set()
+    threading.Thread(target=deliver, daemon=True).start()
+    return self
+
+  def unsubscribe(self):
+    self.unsubscribed = True
+
+
+def follow_until(replicator, listener, done, timeout=5.0):
+  stop_event = threading.Event()
+  def watchdog():
+    done.wait(timeout)
+    stop_event.set()
+  threading.Thread(target=watchdog, daemon=True).start()
+  return replicator.follow(listener.listen, 'users', stop_event=stop_event, poll_interval=0.01)
+
+
+def test_initial_snapshot_is_flushed_in_micro_batches_on_the_following_thread():
+  batches = []
+  threads = set()
+  done = threading.Event()
+  def flush(docs):
+    batches.append(len(docs))
+    threads.add(threading.current_thread())
+    if sum(batches) == 1200:
+      done.set()
+  listener = FakeListener([[change(f'u{i:04d}', name=f'n{i}') for i in range(1200)]])
+  stats = follow_until(Replicator(flush, flush_size=500, flush_interval=0.05), listener, done)
+  assert batches == [500, 500, 200]
+  assert threads == { threading.current_thread() }
+  assert listener.unsubscribed
+  assert stats['flushes'] == 3 and stats['documents'] == 1200
+
+
+def test_latest_version_is_kept_and_removals_are_counted():
+  flushed = []
+  done = threading.Event()
+  def flush(docs):
+    flushed.extend(docs)
+    done.set()
+  listener = FakeListener([
+    [change('u1', name='old'), change('u2', name='gone')],
+    [change('u1', 'MODIFIED', name='new'), change('u3', 'REMOVED')],
+  ])
+  replicator = Replicator(flush, flush_size=100, flush_interval=0.05)
+  stats = follow_until(replicator, listener, done)
+  assert sorted((doc['id'], doc['name']) for doc in flushed) == [('u1', 'new'), ('u2', 'gone')]
+  assert flushed[0]['_path'] == ['users', 'u1']
+  assert stats['changes'] == 4 and stats['removed'] == 1
+
+
+def test_failed_flush_is_retried():
+  attempts = []
+  done = threading.Event()
+  def flush(docs):
+    attempts.append(len(docs))
+    if len(attempts) == 1:
+      raise Exception('EdgeDB unavailable')
+    done.set()
+  listener = FakeListener([[change('u1', name='a'), change('u2', name='b')]])
+  replicator = Replicator(flush, flush_size=2, flush_interval=0.01)
+  stats = follow_until(replicator, listener, done)
+  assert attempts == [2, 2]
+  assert replicator.error is None
+  assert stats['flushes'] == 1 and stats['documents'] == 2
+
+
+def test_buffered_documents_are_flushed_on_stop():
+  flushed = []
+  listener = FakeListener([[change('u1', name='a')]])
+  replicator = Replicator(flushed.extend, flush_size=100, flush_interval=60)
+  stats = follow_until(replicator, listener, listener.delivered)
+  assert [doc['id'] for doc in flushed] == ['u1']
+  assert stats['flushes'] == 1
+
+
+def test_grouped_changes_reload_whole_groups():
+  batches = []
+  replicator = Replicator(lambda docs: batches.append(sorted(doc['id'] for doc in docs)), flush_size=3, flush_interval=60, group_fn=lambda doc: (doc['event'],))
+  replicator.on_snapshot(None, [
+    change('p1', event='e1'),
+    change('p2', event='e2'),
+    change('p3', event='e1'),
+    change('p4', event='e2'),
+    change('p5', event='e3'),
+    change('p6', event='e1'),
+  ], None)
+  # Micro-batches are made of whole groups of at least the flush size, if there are enough.
+  replicator.flush_due()
+  assert batches == [['p1', 'p3', 'p6'], ['p2', 'p4', 'p5']]
+
+  # A change reloads the current documents of its group; a removed document is left out of the reload.
+  replicator.on_snapshot(None, [change('p3', 'MODIFIED', event='e1'), change('p1', 'REMOVED')], None)
+  replicator.flush()
+  assert batches[2:] == [['p3', 'p6']]
+
+  # A document moving to another group reloads both.
+  replicator.on_snapshot(None, [change('p4', 'MODIFIED', event='e3')], None)
+  replicator.flush()
+  assert batches[3:] == [['p2', 'p4', 'p5']]
+
+
+def test_document_groups_come_from_source_fields():
+  rule = {
+    'fetch_order': ('paidTime', 'ASCENDING'),
+    'mapping': { 'event_id': '_parent_id', 'host': { 'col': ['host', 'uid'] }, 'paid': 'paid' },
+    'group_by': ['event_id', 'host'],
+    'edgedb_iterated_query': 'select 1',
+  }
+  group_fn = document_group_fn(compile_rule('payments', rule))
+  assert group_fn({ '_parent_id': 'e1', 'host': { 'uid': 'u1' }, 'paid': True }) == ('e1', 'u1')
+
+  rule['mapping']['event_id'] = { 'col': '_parent_id', 'transform': str.lower }
+  with pytest.raises(Exception, match='group_by column "event_id"'):
+    document_group_fn(compile_rule('payments', rule))
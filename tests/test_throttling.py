@@ -0,0 +1,24 @@
+from types import SimpleNamespace
+
+import firestore_helpers
+from firestore_helpers import read_with_retry
+from throttling import TokenBucket
+
+
+def test_release_returns_unused_tokens_up_to_capacity():
+  bucket = TokenBucket(1000, 100)
+  bucket.acquire(60)
+  bucket.release(50)
+  assert 89 < bucket.tokens <= 100
+  bucket.release(500)
+  assert bucket.tokens == 100
+
+
+def test_short_pages_only_spend_the_reads_they_return(monkeypatch):
+  bucket = TokenBucket(0.001, 1000)
+  monkeypatch.setitem(firestore_helpers.fetch_config, 'limiter', bucket)
+  read_with_retry(SimpleNamespace(get=lambda: ['doc'] * 3), 'page', 100)
+  assert round(bucket.tokens) == 997
+  # A query with no results is still billed one read.
+  read_with_retry(SimpleNamespace(get=lambda: []), 'page', 100)
+  assert round(bucket.tokens) == 996
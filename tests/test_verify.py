@@ -0,0 +1,80 @@
+import json
+from types import SimpleNamespace
+
+import pandas
+
+import verify
+from plan import compile_rule
+from verify import Verifier, canonical
+
+RULE = {
+  'fetch_order': ('createdAt', 'ASCENDING'),
+  'mapping': {
+    'firebase_uid': 'id',
+    'phone_number': 'phone',
+    'age': 'age',
+    'created_at': 'createdAt',
+  },
+  'edgedb_type_casts': { 'created_at': 'datetime', 'age': 'int16' },
+  'edgedb_table_name': 'User',
+}
+
+
+class FakeClient:
+  # Answers the chunk query with stored objects (as EdgeDB returns them in JSON), for the keys asked for.
+
+  def __init__(self, objects):
+    self.objects = objects
+
+  def query_json(self, query, keys):
+    fields = [field.split(' := .')[1] for field in query.split('{ ')[1].split(' }')[0].split(', ')]
+    rows = [obj for obj in self.objects if obj['firebase_uid'] in keys]
+    return json.dumps([{ 'key': obj[fields[0]], **{ f'c{i}': obj.get(field) for i, field in enumerate(fields[1:]) } } for obj in rows])
+
+
+def verify_rows(monkeypatch, rows, stored):
+  monkeypatch.setattr(verify, 'get_client', lambda: FakeClient(stored))
+  verifier = Verifier(chunk_size=2)
+  verifier.load(compile_rule('users', RULE), pandas.DataFrame(rows))
+  return verifier.stats
+
+
+ROWS = [
+  { 'firebase_uid': 'u1', 'phone_number': '+15550001', 'age': 30, 'created_at': '2024-01-02T03:04:05.000Z' },
+  { 'firebase_uid': 'u2', 'phone_number': '+15550002', 'age': None, 'created_at': '2024-01-02T05:00:00+02:00' },
+  { 'firebase_uid': 'u3', 'phone_number': '+15550003', 'age': 41, 'created_at': '2024-02-01T00:00:00Z' },
+]
+STORED = [
+  { 'firebase_uid': 'u1', 'phone_number': '+15550001', 'age': 30, 'created_at': '2024-01-02T03:04:05+00:00' },
+  { 'firebase_uid': 'u2', 'phone_number': '+15550002', 'age': None, 'created_at': '2024-01-02T03:00:00+00:00' },
+  { 'firebase_uid': 'u3', 'phone_number': '+15550003', 'age': 41, 'created_at': '2024-02-01T00:00:00+00:00' },
+]
+
+
+def test_matching_rows_pass_whatever_the_datetime_format(monkeypatch):
+  stats = verify_rows(monkeypatch, ROWS, STORED)
+  assert stats['chunks'] == 2 and stats['rows'] == 3
+  assert stats['mismatched_chunks'] == 0
+
+
+def test_same_length_edits_are_detected(monkeypatch):
+  stored = [dict(obj) for obj in STORED]
+  stored[0]['phone_number'] = '+15550009'
+  stored[2]['created_at'] = '2024-02-01T00:00:01+00:00'
+  stats = verify_rows(monkeypatch, ROWS, stored)
+  assert stats['mismatched_chunks'] == 2
+  assert stats['different'] == 2 and stats['missing'] == 0
+
+
+def test_swapped_and_missing_objects_are_detected(monkeypatch):
+  stored = [dict(STORED[0], firebase_uid='u2'), dict(STORED[1], firebase_uid='u1')]
+  stats = verify_rows(monkeypatch, ROWS, stored)
+  assert stats['mismatched_chunks'] == 2
+  assert stats['different'] == 2 and stats['missing'] == 1
+
+
+def test_canonical_values():
+  assert canonical('2024-01-02T05:00:00+02:00', 'datetime') == canonical('2024-01-02T03:00:00.000Z', 'std::datetime')
+  assert canonical('7', 'int64') == canonical(7, 'int64')
+  assert canonical({ 'b': 1, 'a': 2 }, 'json') == canonical({ 'a': 2, 'b': 1 }, 'json')
+  assert canonical({}, 'json') is None and canonical('', None) is None